@@ -1,19 +1,35 @@
 import asyncio
 import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import socket
-from datetime import datetime
+import ssl
+import statistics
+import traceback
+from datetime import datetime, time, timedelta
+from time import perf_counter
+from bisect import bisect_right
 from collections import defaultdict
-
-from aiogram import Bot, Dispatcher, types, F
+from functools import lru_cache
+from typing import NamedTuple
+
+import certifi
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiogram import Bot, Dispatcher, types, F, __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, Update
 from dotenv import load_dotenv
 
 from db_manager import (
+    utcnow,
     find_participant_by_telegram_id,
     find_participant_by_ozon_id,
     find_participant_by_username,
@@ -29,9 +45,12 @@ from db_manager import (
     get_bonus_settings,
     update_bonus_settings,
     get_available_bonuses_for_withdrawal,
+    check_and_update_bonus_availability,
     clear_bonus_settings_cache,
     get_last_sync_timestamp,
-    get_daily_bonus_summary,
+    add_sync_stat,
+    get_sync_durations_by_slot,
+    get_daily_bonus_totals,
     get_all_participants,
     get_withdrawal_settings,
     update_withdrawal_settings,
@@ -57,10 +76,9 @@ from db_manager import (
 
 from states import Registration, BonusSettings, LeavingProgram, Withdrawal, WithdrawalRejection, ParticipantAnalytics, WithdrawalSettings
 # ИМПОРТ ДЛЯ СИНХРОНИЗАЦИИ ЗАКАЗОВ
-from orders_updater import update_orders_sheet 
+from orders_updater import update_orders_sheet, SyncResult
 
 # грузим переменные из .env
-from datetime import datetime, timedelta
 load_dotenv()
 API_TOKEN = os.getenv("BOT_TOKEN")
 
@@ -75,8 +93,64 @@ if admin_ids_str:
 else:
     # Если не указано в .env, можно задать здесь
     ADMIN_IDS = [419985638]  # Artem (ID: 419985638)
+# Множество для проверки прав (is_admin вызывается на каждый ответ с клавиатурой)
+ADMIN_IDS_SET = frozenset(ADMIN_IDS)
 
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def start_log_listener() -> logging.handlers.QueueListener:
+    """
+    Переводит корневой логгер на запись через очередь.
+    
+    Хендлеры, настроенные basicConfig (вывод в консоль), переезжают в QueueListener и пишут
+    из отдельного потока, поэтому event loop не блокируется на выводе логов.
+    
+    Returns:
+        logging.handlers.QueueListener: Запущенный слушатель очереди (остановить через stop())
+    """
+    root_logger = logging.getLogger()
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+class IPv4AiohttpSession(AiohttpSession):
+    """
+    AiohttpSession с принудительным IPv4 и переиспользованием соединений.
+    
+    TCPConnector создается явно в create_session (через публичный метод сессии aiogram),
+    без правки приватных атрибутов AiohttpSession: обновление aiogram их не сломает.
+    aiohttp-сессия создается лениво при первом запросе к Telegram и живет до close().
+    """
+    
+    def __init__(self, limit: int = 100, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        self._ipv4_limit = limit
+        # Тот же SSL-контекст, что aiogram создает для своего connector'а (сертификаты certifi)
+        self._ipv4_ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self._ipv4_session: ClientSession | None = None
+    
+    async def create_session(self) -> ClientSession:
+        if self._ipv4_session is None or self._ipv4_session.closed:
+            self._ipv4_session = ClientSession(
+                connector=TCPConnector(
+                    family=socket.AF_INET,
+                    limit=self._ipv4_limit,
+                    limit_per_host=30,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=75,
+                    ssl=self._ipv4_ssl_context,
+                ),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+            )
+        return self._ipv4_session
+    
+    async def close(self):
+        if self._ipv4_session is not None and not self._ipv4_session.closed:
+            await self._ipv4_session.close()
+        await super().close()
 
 # Создаем Bot без кастомной сессии (сессия будет создана внутри async контекста в main())
 bot = Bot(token=API_TOKEN)
@@ -87,7 +161,7 @@ dp = Dispatcher(storage=MemoryStorage())
 # =========================================================
 def is_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором."""
-    return user_id in ADMIN_IDS
+    return user_id in ADMIN_IDS_SET
 
 # =========================================================
 # КОНСТАНТЫ ДЛЯ ВАЛИДАЦИИ
@@ -102,6 +176,16 @@ MIN_BONUS_PERCENT = 0.0  # Минимальный процент бонуса
 MAX_LEVELS = 5  # Максимальное количество уровней
 MIN_LEVELS = 1  # Минимальное количество уровней
 
+# Названия статусов заказов Ozon для отображения пользователям
+STATUS_NAMES = {
+    "delivered": "✅ Доставлено",
+    "delivering": "🚚 В доставке",
+    "awaiting_packaging": "📦 Ожидает упаковки",
+    "awaiting_deliver": "⏳ Ожидает доставки",
+    "cancelled": "❌ Отменено",
+    "unknown": "❓ Неизвестный статус",
+}
+
 # =========================================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ БЕЗОПАСНОСТИ
 # =========================================================
@@ -192,6 +276,28 @@ def validate_numeric_range(value: float, min_val: float, max_val: float, field_n
     
     return True, None
 
+# Формы слова "заказ" для plural_ru
+ORDER_FORMS = ("заказ", "заказа", "заказов")
+
+def plural_ru(n: int, forms: tuple[str, str, str]) -> str:
+    """
+    Возвращает форму слова для числа по правилам русского языка.
+    
+    Args:
+        n: Число
+        forms: Формы слова для 1, 2-4 и 5+ (например, ("заказ", "заказа", "заказов"))
+        
+    Returns:
+        str: Подходящая форма слова (21 заказ, 22 заказа, 11 заказов)
+    """
+    n = abs(int(n))
+    m10, m100 = n % 10, n % 100
+    if m10 == 1 and m100 != 11:
+        return forms[0]
+    if 2 <= m10 <= 4 and not 12 <= m100 <= 14:
+        return forms[1]
+    return forms[2]
+
 # =========================================================
 # СОЗДАНИЕ КЛАВИАТУР С КНОПКАМИ
 # =========================================================
@@ -213,11 +319,14 @@ async def get_admin_contact_info(bot: Bot, admin_id: int) -> dict:
             "has_username": chat.username is not None
         }
     except Exception as e:
-        print(f"Ошибка при получении информации об админе: {e}")
+        logger.error("Ошибка при получении информации об админе: %s", e)
         return None
 
+@lru_cache(maxsize=1)
 def get_user_keyboard() -> ReplyKeyboardMarkup:
-    """Создает клавиатуру для обычных пользователей."""
+    """Создает клавиатуру для обычных пользователей.
+    Клавиатура создается один раз и берется из кэша: возвращается общий для всех объект,
+    изменять его нельзя (правки попадут в клавиатуру всех пользователей)."""
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
             [
@@ -241,8 +350,11 @@ def get_user_keyboard() -> ReplyKeyboardMarkup:
     )
     return keyboard
 
+@lru_cache(maxsize=1)
 def get_admin_keyboard() -> ReplyKeyboardMarkup:
-    """Создает клавиатуру для администраторов."""
+    """Создает клавиатуру для администраторов.
+    Клавиатура создается один раз и берется из кэша: возвращается общий для всех объект,
+    изменять его нельзя (правки попадут в клавиатуру всех пользователей)."""
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
             [
@@ -303,9 +415,9 @@ async def start_handler(message: types.Message, state: FSMContext):
             )
             if referrer_participant:
                 referrer_ozon_id = referrer_participant.get("Ozon ID")
-                print(f"✅ Реферер найден при /start: Telegram ID={referrer_telegram_id}, Ozon ID={referrer_ozon_id}")
+                logger.info("✅ Реферер найден при /start: Telegram ID=%s, Ozon ID=%s", referrer_telegram_id, referrer_ozon_id)
             else:
-                print(f"⚠️ Реферер не найден при /start: Telegram ID={referrer_telegram_id} (будет попытка найти при регистрации)")
+                logger.warning("⚠️ Реферер не найден при /start: Telegram ID=%s (будет попытка найти при регистрации)", referrer_telegram_id)
 
     # пробуем найти участника по Telegram ID
     # ИСПРАВЛЕНО: Оборачиваем синхронную функцию Sheets в asyncio.to_thread
@@ -383,18 +495,10 @@ async def sync_orders_handler(message: types.Message):
     try:
         result = await asyncio.to_thread(update_orders_sheet)
         
-        # Проверка структуры результата
-        if not isinstance(result, dict):
-            await message.answer(
-                "❌ Ошибка: неверный формат результата синхронизации.",
-                reply_markup=get_keyboard(message.from_user.id)
-            )
-            return
-        
         # Форматируем период для отображения
         
-        period_start = result.get("period_start")
-        period_end = result.get("period_end")
+        period_start = result.period_start
+        period_end = result.period_end
         
         if period_start is None or period_end is None:
             await message.answer(
@@ -404,11 +508,11 @@ async def sync_orders_handler(message: types.Message):
             return
         
         # Форматируем даты в читаемый вид (DD.MM.YYYY HH:MM)
-        period_start_str = period_start.strftime("%d.%m.%Y %H:%M")
-        period_end_str = period_end.strftime("%d.%m.%Y %H:%M")
+        period_start_str = format_datetime(period_start)
+        period_end_str = format_datetime(period_end)
         
         # Получаем статистику по статусам за первый день периода
-        first_day_stats = result.get("first_day_stats", {})
+        first_day_stats = result.first_day_stats
         
         # Формируем строку со статистикой по статусам
         status_stats_text = ""
@@ -423,25 +527,19 @@ async def sync_orders_handler(message: types.Message):
                 sorted_statuses = sorted(statuses.items(), key=lambda x: x[1], reverse=True)
                 for status, count in sorted_statuses:
                     percentage = (count / first_day_stats['total']) * 100
-                    status_name = {
-                        "delivered": "✅ Доставлено",
-                        "delivering": "🚚 В доставке",
-                        "awaiting_packaging": "📦 Ожидает упаковки",
-                        "awaiting_deliver": "⏳ Ожидает доставки",
-                        "cancelled": "❌ Отменено"
-                    }.get(status, status)
+                    status_name = STATUS_NAMES.get(status, status)
                     status_stats_text += f"{status_name}: <b>{count}</b> ({percentage:.1f}%)\n"
             
             if first_day_stats.get("active_count", 0) > 0:
                 status_stats_text += f"\n⚠️ Активных заказов: <b>{first_day_stats['active_count']}</b>"
         
-        if result["count"] > 0:
+        if result.count > 0:
             text = (
                 f"🎉 Синхронизация завершена! 🎉\n\n"
-                f"✅ Добавлено <b>{result['count']}</b> новых заказов\n"
-                f"👥 Обработано <b>{result['customers_count']}</b> клиентов "
-                f"(новых: <b>{result['new_customers_count']}</b>)\n"
-                f"🎯 Участников программы совершивших покупку: <b>{result.get('participants_with_orders_count', 0)}</b>\n\n"
+                f"✅ Добавлено <b>{result.count}</b> новых заказов\n"
+                f"👥 Обработано <b>{result.customers_count}</b> клиентов "
+                f"(новых: <b>{result.new_customers_count}</b>)\n"
+                f"🎯 Участников программы совершивших покупку: <b>{result.participants_with_orders_count}</b>\n\n"
                 f"📅 <b>Период синхронизации:</b>\n"
                 f"С: {period_start_str}\n"
                 f"По: {period_end_str}"
@@ -498,17 +596,20 @@ async def my_stats_handler(message: types.Message):
     if reg_date and reg_date != 'Не указана':
         try:
             # Преобразуем YYYY-MM-DD в DD.MM.YYYY
-            from datetime import datetime
             dt = datetime.strptime(reg_date, "%Y-%m-%d")
             reg_date = dt.strftime("%d.%m.%Y")
         except:
             pass
     
     try:
-        # Получаем статистику
-        user_stats = await asyncio.to_thread(get_user_orders_stats, ozon_id)
-        
-        referrals_by_level = await asyncio.to_thread(get_referrals_by_level, ozon_id, max_level=3)
+        # Получаем статистику, рефералов, бонусы пользователя и доступные к выводу бонусы
+        # (независимые запросы выполняются параллельно)
+        user_stats, referrals_by_level, user_bonuses, available_bonuses = await asyncio.gather(
+            asyncio.to_thread(get_user_orders_stats, ozon_id),
+            asyncio.to_thread(get_referrals_by_level, ozon_id, max_level=3),
+            asyncio.to_thread(get_user_bonuses, ozon_id),
+            asyncio.to_thread(get_available_bonuses_for_withdrawal, ozon_id),
+        )
         
         # Функция для форматирования чисел с пробелами
         def format_number(num):
@@ -517,12 +618,6 @@ async def my_stats_handler(message: types.Message):
             except (ValueError, TypeError) as e:
                 return "0"
         
-        # Получаем бонусы пользователя
-        user_bonuses = await asyncio.to_thread(get_user_bonuses, ozon_id)
-        
-        # Получаем доступные к выводу бонусы
-        available_bonuses = await asyncio.to_thread(get_available_bonuses_for_withdrawal, ozon_id)
-        
         # Формируем текст
         text = (
             f"📊 Моя статистика\n\n"
@@ -544,10 +639,20 @@ async def my_stats_handler(message: types.Message):
         total_bonuses = 0.0
         
         # Получаем максимальное количество уровней из настроек
-        from db_manager import get_bonus_settings
         settings = await asyncio.to_thread(get_bonus_settings)
         max_levels = settings.max_levels if settings else 3
         
+        # Статистика заказов и бонусов всех уровней запрашивается параллельно (запросы независимы)
+        levels_with_referrals = [level for level in range(1, max_levels + 1) if referrals_by_level.get(level)]
+        level_results = await asyncio.gather(*(
+            asyncio.gather(
+                asyncio.to_thread(get_referrals_orders_stats, referrals_by_level[level]),
+                asyncio.to_thread(get_referrals_bonuses_stats, referrals_by_level[level], level),
+            )
+            for level in levels_with_referrals
+        ))
+        level_stats = dict(zip(levels_with_referrals, level_results))
+        
         for level in range(1, max_levels + 1):
             referral_ids = referrals_by_level.get(level, [])
             
@@ -558,8 +663,7 @@ async def my_stats_handler(message: types.Message):
             }.get(level, f"Уровень {level}")
             
             if referral_ids:
-                referrals_stats = await asyncio.to_thread(get_referrals_orders_stats, referral_ids)
-                referrals_bonuses = await asyncio.to_thread(get_referrals_bonuses_stats, referral_ids, level)
+                referrals_stats, referrals_bonuses = level_stats[level]
                 
                 total_referrals += len(referral_ids)
                 total_referral_orders += referrals_stats['orders_count']
@@ -634,7 +738,6 @@ async def my_orders_handler(message: types.Message):
         reg_date = summary.get("registration_date")
         if reg_date:
             try:
-                from datetime import datetime
                 dt = datetime.strptime(reg_date, "%Y-%m-%d")
                 reg_date_str = dt.strftime("%d.%m.%Y")
             except:
@@ -663,16 +766,6 @@ async def my_orders_handler(message: types.Message):
                 f"• Общая сумма: <b>{format_float(total_sum)}</b> ₽\n\n"
             )
             
-            # Словарь для перевода статусов на русский
-            status_names = {
-                "delivered": "✅ Доставлено",
-                "delivering": "🚚 В доставке",
-                "awaiting_packaging": "📦 Ожидает упаковки",
-                "awaiting_deliver": "⏳ Ожидает доставки",
-                "cancelled": "❌ Отменено",
-                "unknown": "❓ Неизвестный статус"
-            }
-            
             # Показываем разбивку по статусам
             if by_status:
                 text += f"📋 <b>По статусам:</b>\n"
@@ -685,18 +778,10 @@ async def my_orders_handler(message: types.Message):
                 )
                 
                 for status, data in sorted_statuses:
-                    status_name = status_names.get(status, f"❓ {status}")
+                    status_name = STATUS_NAMES.get(status, f"❓ {status}")
                     count = data.get("count", 0)
                     sum_amount = data.get("sum", 0.0)
-                    text += f"• {status_name}: <b>{count}</b> заказ"
-                    
-                    # Правильное склонение слова "заказ"
-                    if count == 1:
-                        text += f" — {format_float(sum_amount)} ₽\n"
-                    elif count < 5:
-                        text += f"а — {format_float(sum_amount)} ₽\n"
-                    else:
-                        text += f"ов — {format_float(sum_amount)} ₽\n"
+                    text += f"• {status_name}: <b>{count}</b> {plural_ru(count, ORDER_FORMS)} — {format_float(sum_amount)} ₽\n"
         
         await message.answer(text, parse_mode="HTML", reply_markup=get_keyboard(user.id))
     except Exception as e:
@@ -818,8 +903,6 @@ async def process_withdrawal_button_in_state(message: types.Message, state: FSMC
     await state.clear()
     
     # Вызываем обработчик кнопки через диспетчер
-    from aiogram.types import Update
-    
     new_update = Update(update_id=message.message_id, message=message)
     
     try:
@@ -1001,7 +1084,7 @@ async def withdrawal_confirm_handler(callback: types.CallbackQuery, state: FSMCo
             try:
                 await bot.send_message(admin_id, admin_text, parse_mode="HTML", reply_markup=keyboard)
             except Exception as e:
-                print(f"⚠️ Не удалось отправить уведомление админу: {e}")
+                logger.warning("⚠️ Не удалось отправить уведомление админу: %s", e)
         
     except ValueError as e:
         # Ошибка валидации
@@ -1461,7 +1544,7 @@ async def admin_withdrawal_approve_confirm_handler(callback: types.CallbackQuery
                     )
                     await bot.send_message(int(user_telegram_id), user_text, parse_mode="HTML")
                 except Exception as e:
-                    print(f"⚠️ Не удалось отправить уведомление пользователю: {e}")
+                    logger.warning("⚠️ Не удалось отправить уведомление пользователю: %s", e)
         else:
             await callback.message.edit_text(
                 "❌ Не удалось одобрить заявку. Возможно, недостаточно средств на балансе пользователя.",
@@ -1627,7 +1710,7 @@ async def process_withdrawal_rejection_reason(message: types.Message, state: FSM
                     )
                     await bot.send_message(int(user_telegram_id), user_text, parse_mode="HTML")
                 except Exception as e:
-                    print(f"⚠️ Не удалось отправить уведомление пользователю: {e}")
+                    logger.warning("⚠️ Не удалось отправить уведомление пользователю: %s", e)
         else:
             await message.answer(
                 "❌ Не удалось отклонить заявку. Заявка не найдена или уже обработана.",
@@ -1678,8 +1761,6 @@ async def process_analytics_button_in_state(message: types.Message, state: FSMCo
     await state.clear()
     
     # Вызываем обработчик кнопки через диспетчер
-    from aiogram.types import Update
-    
     new_update = Update(update_id=message.message_id, message=message)
     
     try:
@@ -2375,17 +2456,17 @@ async def process_ozon_id(message: types.Message, state: FSMContext):
     # Если Ozon ID реферера не был найден при /start, но есть Telegram ID,
     # пытаемся найти реферера еще раз (возможно, он зарегистрировался между /start и вводом Ozon ID)
     if not referrer_id and referrer_telegram_id:
-        print(f"🔄 Повторная попытка найти реферера по Telegram ID={referrer_telegram_id}")
+        logger.info("🔄 Повторная попытка найти реферера по Telegram ID=%s", referrer_telegram_id)
         referrer_participant = await asyncio.to_thread(
             find_participant_by_telegram_id, referrer_telegram_id
         )
         if referrer_participant:
             referrer_id = referrer_participant.get("Ozon ID")
-            print(f"✅ Реферер найден при регистрации: Telegram ID={referrer_telegram_id}, Ozon ID={referrer_id}")
+            logger.info("✅ Реферер найден при регистрации: Telegram ID=%s, Ozon ID=%s", referrer_telegram_id, referrer_id)
         else:
-            print(f"⚠️ Реферер все еще не найден: Telegram ID={referrer_telegram_id}")
+            logger.warning("⚠️ Реферер все еще не найден: Telegram ID=%s", referrer_telegram_id)
     
-    print(f"🔍 Создание участника {ozon_id} с referrer_id={referrer_id}")
+    logger.info("🔍 Создание участника %s с referrer_id=%s", ozon_id, referrer_id)
 
     # создаём участника
     await asyncio.to_thread( 
@@ -2415,10 +2496,10 @@ async def process_ozon_id(message: types.Message, state: FSMContext):
                         )
                     except (ValueError, Exception) as e:
                         # Не критично, просто логируем
-                        print(f"⚠️ Не удалось отправить уведомление рефереру: {e}")
+                        logger.warning("⚠️ Не удалось отправить уведомление рефереру: %s", e)
         except Exception as e:
             # Не критично, просто логируем
-            print(f"⚠️ Ошибка при поиске реферера для уведомления: {e}")
+            logger.warning("⚠️ Ошибка при поиске реферера для уведомления: %s", e)
 
     await state.clear()
 
@@ -2438,8 +2519,8 @@ async def process_ozon_id(message: types.Message, state: FSMContext):
 
 # Глобальный флаг для отслеживания процесса синхронизации
 _sync_in_progress = False
-_sync_task: asyncio.Task = None
-_notification_task: asyncio.Task = None
+# Синхронизации, запущенные через run_auto_sync_with_timeout (храним ссылки, пока они не завершатся)
+_auto_sync_tasks: set[asyncio.Task] = set()
 
 # Время синхронизации заказов: 13:00 и 19:30 по московскому времени каждый день
 SYNC_TIMES = [
@@ -2447,12 +2528,83 @@ SYNC_TIMES = [
     (19, 30),  # 19:30 МСК
 ]
 
-async def perform_auto_sync(notify_admins: bool = False) -> bool:
+# Подстройка расписания по замерам длительности синхронизаций (см. choose_sync_times):
+# если первая синхронизация дня стабильно идет в SYNC_SHIFT_RATIO раз дольше остальных,
+# остальные сдвигаются на SYNC_SHIFT_MINUTES позже, чтобы не пересекаться с нагрузкой
+SYNC_SHIFT_MIN_SAMPLES = 3  # Минимум замеров по каждому слоту для принятия решения
+SYNC_SHIFT_RATIO = 2
+SYNC_SHIFT_MINUTES = 30
+
+# Действующее расписание (заполняется set_sync_schedule):
+# времена в виде объектов time, отсортированные по возрастанию (для get_next_sync_time),
+# и индекс слота в SYNC_TIMES для каждого времени (для статистики длительности)
+_sync_clock_times: list[time] = []
+_sync_slots: dict[time, int] = {}
+# Окно "свежести": если последняя синхронизация была недавно (меньше половины минимального
+# промежутка между запусками по расписанию), при старте бота она не повторяется
+_sync_freshness = timedelta(0)
+
+def set_sync_schedule(sync_times: list[tuple[int, int]]):
+    """
+    Устанавливает действующее расписание синхронизаций.
+    
+    Args:
+        sync_times: Времена (час, минута) МСК в том же порядке слотов, что и SYNC_TIMES
+    """
+    global _sync_clock_times, _sync_slots, _sync_freshness
+    
+    _sync_slots = {time(h, m): slot for slot, (h, m) in enumerate(sync_times)}
+    _sync_clock_times = sorted(_sync_slots)
+    
+    minutes = [t.hour * 60 + t.minute for t in _sync_clock_times]
+    _sync_freshness = timedelta(minutes=min(
+        (later - earlier) % (24 * 60) or 24 * 60
+        for earlier, later in zip(minutes, minutes[1:] + minutes[:1])
+    ) / 2)
+
+set_sync_schedule(SYNC_TIMES)
+
+def choose_sync_times(durations: dict[int, list[float]]) -> list[tuple[int, int]]:
+    """
+    Подбирает расписание синхронизаций по сохраненным длительностям.
+    
+    Если медианная длительность первого слота больше медианы другого слота в SYNC_SHIFT_RATIO раз,
+    этот слот сдвигается на SYNC_SHIFT_MINUTES позже (не дальше 23:59). Сдвиг всегда считается
+    от базового SYNC_TIMES, поэтому при каждом старте не накапливается.
+    
+    Args:
+        durations: {индекс слота: [длительность в секундах, ...]} (см. get_sync_durations_by_slot)
+    
+    Returns:
+        list[tuple[int, int]]: Времена (час, минута) в порядке слотов SYNC_TIMES
+    """
+    sync_times = list(SYNC_TIMES)
+    primary = durations.get(0, [])
+    if len(primary) < SYNC_SHIFT_MIN_SAMPLES:
+        return sync_times
+    
+    primary_median = statistics.median(primary)
+    for slot in range(1, len(SYNC_TIMES)):
+        secondary = durations.get(slot, [])
+        if len(secondary) < SYNC_SHIFT_MIN_SAMPLES:
+            continue
+        if primary_median > SYNC_SHIFT_RATIO * statistics.median(secondary):
+            sync_hour, sync_minute = SYNC_TIMES[slot]
+            shifted = divmod(min(sync_hour * 60 + sync_minute + SYNC_SHIFT_MINUTES, 23 * 60 + 59), 60)
+            # Не допускаем совпадения с другим временем синхронизации
+            if shifted not in sync_times:
+                sync_times[slot] = shifted
+    
+    return sync_times
+
+async def perform_auto_sync(notify_admins: bool = False, slot: int | None = None) -> bool:
     """
     Выполняет автоматическую синхронизацию заказов.
     
     Args:
         notify_admins: Если True, отправляет уведомления админам о результате
+        slot: Индекс времени в SYNC_TIMES, если синхронизация идет по расписанию
+            (ее длительность сохраняется для choose_sync_times)
     
     Returns:
         True если синхронизация успешна, False в случае ошибки
@@ -2461,30 +2613,34 @@ async def perform_auto_sync(notify_admins: bool = False) -> bool:
     
     # Проверяем, не идет ли уже синхронизация
     if _sync_in_progress:
-        print("⚠️ Синхронизация уже выполняется, пропускаем...")
+        logger.warning("⚠️ Синхронизация уже выполняется, пропускаем...")
         return False
     
     _sync_in_progress = True
     
     try:
-        print(f"🔄 Начало автоматической синхронизации в {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.info("🔄 Начало автоматической синхронизации в %s", datetime.now().isoformat(sep=' ', timespec='seconds'))
+        started_at = utcnow()
+        started = perf_counter()
         result = await asyncio.to_thread(update_orders_sheet)
+        duration = perf_counter() - started
         
-        if isinstance(result, dict) and result.get("count", 0) >= 0:
-            print(f"✅ Автоматическая синхронизация завершена успешно. Добавлено заказов: {result.get('count', 0)}")
-            
-            # Уведомляем админов всегда, если запрошено (даже если заказов нет)
-            if notify_admins:
-                await notify_admins_about_sync(result)
-            
-            return True
-        else:
-            print(f"⚠️ Автоматическая синхронизация завершена, но результат неожиданный: {result}")
-            return False
+        logger.info("✅ Автоматическая синхронизация завершена успешно за %.1f сек. Добавлено заказов: %s", duration, result.count)
+        
+        # Сохраняем длительность для подбора расписания (ошибка записи не влияет на результат синхронизации)
+        try:
+            await asyncio.to_thread(add_sync_stat, slot, duration, started_at)
+        except Exception as e:
+            logger.warning("⚠️ Не удалось сохранить длительность синхронизации: %s", e)
+        
+        # Уведомляем админов всегда, если запрошено (даже если заказов нет)
+        if notify_admins:
+            await notify_admins_about_sync(result)
+        
+        return True
             
     except Exception as e:
-        error_msg = f"❌ Ошибка при автоматической синхронизации: {e}"
-        print(error_msg)
+        logger.error("❌ Ошибка при автоматической синхронизации: %s", e)
         
         # Уведомляем админов об ошибке
         if notify_admins:
@@ -2494,22 +2650,57 @@ async def perform_auto_sync(notify_admins: bool = False) -> bool:
     finally:
         _sync_in_progress = False
 
-async def notify_admins_about_sync(result: dict):
+# Максимальное время ожидания одной автоматической синхронизации
+SYNC_MAX_SECONDS = 15 * 60
+
+async def run_auto_sync_with_timeout(notify_admins: bool = False, slot: int | None = None):
+    """
+    Запускает perform_auto_sync и ждет ее не дольше SYNC_MAX_SECONDS.
+    
+    Зависшая синхронизация не отменяется (asyncio.shield) и доработает в фоне, но не задерживает
+    вызывающий код; пока она не завершится, _sync_in_progress не даст запустить следующую.
+    
+    Args:
+        notify_admins: Отправлять ли уведомления админам
+        slot: Индекс времени в SYNC_TIMES, если синхронизация идет по расписанию
+    """
+    sync_task = asyncio.create_task(perform_auto_sync(notify_admins=notify_admins, slot=slot))
+    _auto_sync_tasks.add(sync_task)
+    sync_task.add_done_callback(_auto_sync_tasks.discard)
+    
+    try:
+        await asyncio.wait_for(asyncio.shield(sync_task), SYNC_MAX_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ Синхронизация не завершилась за %s сек, продолжаем без ожидания", SYNC_MAX_SECONDS)
+
+async def _broadcast_to_admins(text: str, kind: str):
+    """Отправляет одно и то же сообщение всем админам параллельно (по одному сообщению на админа)."""
+    global bot
+    
+    async def send(admin_id: int):
+        try:
+            await bot.send_message(admin_id, text, parse_mode="HTML")
+        except Exception as e:
+            logger.warning("⚠️ Не удалось отправить %s админу %s: %s", kind, admin_id, e)
+    
+    await asyncio.gather(*(send(admin_id) for admin_id in ADMIN_IDS))
+
+async def notify_admins_about_sync(result: SyncResult):
     """Отправляет уведомление админам об успешной синхронизации с детальной статистикой."""
     global bot
     try:
-        period_start = result.get("period_start")
-        period_end = result.get("period_end")
+        period_start = result.period_start
+        period_end = result.period_end
         
         if period_start is None or period_end is None:
             period_start_str = "не указано"
             period_end_str = "не указано"
         else:
-            period_start_str = period_start.strftime("%d.%m.%Y %H:%M")
-            period_end_str = period_end.strftime("%d.%m.%Y %H:%M")
+            period_start_str = format_datetime(period_start)
+            period_end_str = format_datetime(period_end)
         
         # Получаем статистику по статусам за первый день периода
-        first_day_stats = result.get("first_day_stats", {})
+        first_day_stats = result.first_day_stats
         
         # Формируем строку со статистикой по статусам
         status_stats_text = ""
@@ -2532,26 +2723,20 @@ async def notify_admins_about_sync(result: dict):
                     sorted_statuses = sorted(statuses.items(), key=lambda x: x[1], reverse=True)
                     for status, count in sorted_statuses:
                         percentage = (count / first_day_stats['total']) * 100
-                        status_name = {
-                            "delivered": "✅ Доставлено",
-                            "delivering": "🚚 В доставке",
-                            "awaiting_packaging": "📦 Ожидает упаковки",
-                            "awaiting_deliver": "⏳ Ожидает доставки",
-                            "cancelled": "❌ Отменено"
-                        }.get(status, status)
+                        status_name = STATUS_NAMES.get(status, status)
                         status_stats_text += f"{status_name}: <b>{count}</b> ({percentage:.1f}%)\n"
                 
                 if first_day_stats.get("active_count", 0) > 0:
                     status_stats_text += f"\n⚠️ Активных заказов: <b>{first_day_stats['active_count']}</b>"
         
         # Формируем основное сообщение
-        if result.get("count", 0) > 0:
+        if result.count > 0:
             text = (
                 f"🤖 <b>Автоматическая синхронизация завершена</b>\n\n"
-                f"🎉 Добавлено <b>{result.get('count', 0)}</b> новых заказов\n"
-                f"👥 Обработано <b>{result.get('customers_count', 0)}</b> клиентов "
-                f"(новых: <b>{result.get('new_customers_count', 0)}</b>)\n"
-                f"🎯 Участников программы совершивших покупку: <b>{result.get('participants_with_orders_count', 0)}</b>\n\n"
+                f"🎉 Добавлено <b>{result.count}</b> новых заказов\n"
+                f"👥 Обработано <b>{result.customers_count}</b> клиентов "
+                f"(новых: <b>{result.new_customers_count}</b>)\n"
+                f"🎯 Участников программы совершивших покупку: <b>{result.participants_with_orders_count}</b>\n\n"
                 f"📅 <b>Период синхронизации:</b>\n"
                 f"С: {period_start_str}\n"
                 f"По: {period_end_str}"
@@ -2568,13 +2753,9 @@ async def notify_admins_about_sync(result: dict):
                 f"{status_stats_text}"
             )
         
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(admin_id, text, parse_mode="HTML")
-            except Exception as e:
-                print(f"⚠️ Не удалось отправить уведомление админу {admin_id}: {e}")
+        await _broadcast_to_admins(text, "уведомление")
     except Exception as e:
-        print(f"⚠️ Ошибка при отправке уведомлений админам: {e}")
+        logger.warning("⚠️ Ошибка при отправке уведомлений админам: %s", e)
 
 async def notify_admins_about_sync_error(error_msg: str):
     """Отправляет уведомление админам об ошибке синхронизации."""
@@ -2588,13 +2769,9 @@ async def notify_admins_about_sync_error(error_msg: str):
             f"💡 Попробуйте проверить подключение к интернету или выполнить синхронизацию вручную командой /sync_orders"
         )
         
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(admin_id, text, parse_mode="HTML")
-            except Exception as e:
-                print(f"⚠️ Не удалось отправить уведомление об ошибке админу {admin_id}: {e}")
+        await _broadcast_to_admins(text, "уведомление об ошибке")
     except Exception as e:
-        print(f"⚠️ Ошибка при отправке уведомлений об ошибке админам: {e}")
+        logger.warning("⚠️ Ошибка при отправке уведомлений об ошибке админам: %s", e)
 
 async def notify_referrer_about_new_registration(
     referrer_telegram_id: int,
@@ -2631,7 +2808,7 @@ async def notify_referrer_about_new_registration(
         await bot.send_message(referrer_telegram_id, text, parse_mode="HTML")
         return True
     except Exception as e:
-        print(f"⚠️ Не удалось отправить уведомление рефереру {referrer_telegram_id}: {e}")
+        logger.warning("⚠️ Не удалось отправить уведомление рефереру %s: %s", referrer_telegram_id, e)
         return False
 
 async def notify_admin_about_chat_request(admin_id: int, user: types.User, participant: dict):
@@ -2652,7 +2829,7 @@ async def notify_admin_about_chat_request(admin_id: int, user: types.User, parti
         
         await bot.send_message(admin_id, text, parse_mode="HTML")
     except Exception as e:
-        print(f"⚠️ Не удалось отправить уведомление админу: {e}")
+        logger.warning("⚠️ Не удалось отправить уведомление админу: %s", e)
 
 def format_number(num):
     """Форматирует число с пробелами."""
@@ -2668,6 +2845,90 @@ def format_int(num):
     except (ValueError, TypeError):
         return "0"
 
+def format_datetime(dt: datetime) -> str:
+    """Форматирует дату и время как DD.MM.YYYY HH:MM без вызова strftime."""
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year} {dt.hour:02d}:{dt.minute:02d}"
+
+# =========================================================
+# ШАБЛОНЫ АНАЛИТИКИ ПО УЧАСТНИКУ
+# =========================================================
+# Статичные части текста собираются один раз при импорте модуля,
+# в generate_participant_analytics подставляются только динамические значения
+ANALYTICS_HEADER = (
+    "=" * 50 + "\n"
+    "📊 ПОДРОБНАЯ АНАЛИТИКА ПО УЧАСТНИКУ\n"
+    + "=" * 50 + "\n\n"
+)
+
+ANALYTICS_BASE_INFO_TMPL = (
+    "👤 <b>БАЗОВАЯ ИНФОРМАЦИЯ</b>\n\n"
+    "Ozon ID: <code>{ozon_id}</code>\n"
+    "Имя / ник: {name}\n"
+    "Telegram @: {username}\n"
+    "Telegram ID: <code>{telegram_id}</code>\n"
+    "Дата регистрации: {registration_date}\n"
+)
+
+ANALYTICS_REFERRER_TMPL = "Реферер: {name} (Ozon ID: {referrer_id})\n\n"
+ANALYTICS_REFERRER_NOT_FOUND_TMPL = "Реферер: Ozon ID {referrer_id} (не найден в базе)\n\n"
+ANALYTICS_NO_REFERRER = "Реферер: Нет реферера\n\n"
+
+ANALYTICS_ORDERS_TMPL = (
+    "📦 <b>СТАТИСТИКА ПО ЗАКАЗАМ</b>\n\n"
+    "Всего доставлено заказов: <b>{delivered_count}</b>\n"
+    "Общая сумма доставленных: <b>{delivered_sum}</b> ₽\n"
+    "Всего заказов (с даты регистрации): <b>{total_orders}</b>\n"
+    "Общая сумма всех заказов: <b>{total_sum}</b> ₽\n\n"
+)
+ANALYTICS_STATUSES_HDR = "Распределение по статусам:\n"
+ANALYTICS_STATUS_LINE_TMPL = "  {status_name}: {count} заказ(ов) — {sum_amount} ₽\n"
+
+ANALYTICS_LAST_ORDERS_HDR = "📋 <b>ПОСЛЕДНИЕ 10 ЗАКАЗОВ</b>\n\n"
+ANALYTICS_LAST_ORDER_TMPL = (
+    "{index}. <b>{order_date}</b>\n"
+    "   Статус: {status_name}\n"
+    "   Сумма: {price} ₽\n"
+    "   Номер заказа: <code>{order_id}</code>\n\n"
+)
+ANALYTICS_NO_ORDERS = "Заказы не найдены\n\n"
+
+ANALYTICS_BONUS_TMPL = (
+    "💰 <b>БОНУСЫ</b>\n\n"
+    "Всего начислено бонусов: <b>{total_bonuses}</b> ₽\n\n"
+    "Бонусы по уровням:\n"
+)
+ANALYTICS_BONUS_LEVEL_TMPL = "  Уровень {level}: {amount} ₽\n"
+
+ANALYTICS_REF_HDR = "👥 <b>РЕФЕРАЛЬНАЯ ПРОГРАММА</b>\n\n"
+ANALYTICS_REF_LEVEL_TMPL = (
+    "{level_name}:\n"
+    "  Участников: <b>{count}</b>\n"
+    "  Кол-во заказов: <b>{orders_count}</b>\n"
+    "  Их сумма: <b>{total_sum}</b> ₽\n"
+    "  Начислено бонусов: <b>{bonuses}</b> ₽\n\n"
+)
+ANALYTICS_REF_EMPTY_LEVEL_TMPL = (
+    "{level_name}:\n"
+    "  Участников: 0\n"
+    "  Кол-во заказов: 0\n"
+    "  Их сумма: 0 ₽\n"
+    "  Начислено бонусов: 0 ₽\n\n"
+)
+ANALYTICS_REF_FOOTER_TMPL = (
+    "─" * 50 + "\n"
+    "<b>ИТОГО ПО РЕФЕРАЛЬНОЙ ПРОГРАММЕ:</b>\n"
+    "Всего рефералов: <b>{total_referrals}</b>\n"
+    "Всего заказов рефералов: <b>{total_orders}</b>\n"
+    "Общая сумма заказов рефералов: <b>{total_sum}</b> ₽\n"
+    "Всего бонусов от программы: <b>{total_bonuses}</b> ₽\n"
+)
+
+ANALYTICS_LEVEL_NAMES = {
+    1: "Уровень 1 (прямые друзья)",
+    2: "Уровень 2 (друзья друзей)",
+    3: "Уровень 3 (друзья друзей друзей)",
+}
+
 async def generate_participant_analytics(ozon_id: str) -> list[str]:
     """Генерирует подробную аналитику по участнику. Возвращает список строк для отправки."""
     
@@ -2676,21 +2937,31 @@ async def generate_participant_analytics(ozon_id: str) -> list[str]:
         if len(text) <= max_length:
             return [text]
         
+        # Копим строки в буфере и считаем длину на ходу, чтобы не пересоздавать строку на каждой итерации
         parts = []
-        current_part = ""
+        buf = []
+        size = 0
         
         for line in text.split('\n'):
-            if len(current_part) + len(line) + 1 <= max_length:
-                current_part += line + '\n'
-            else:
-                if current_part:
-                    parts.append(current_part.strip())
-                current_part = line + '\n'
+            # Строку длиннее max_length режем на куски, иначе Telegram не примет сообщение
+            while len(line) > max_length:
+                if buf:
+                    parts.append('\n'.join(buf).strip())
+                    buf, size = [], 0
+                parts.append(line[:max_length])
+                line = line[max_length:]
+            
+            line_size = len(line) + 1
+            if size + line_size > max_length and buf:
+                parts.append('\n'.join(buf).strip())
+                buf, size = [], 0
+            buf.append(line)
+            size += line_size
         
-        if current_part:
-            parts.append(current_part.strip())
+        if buf:
+            parts.append('\n'.join(buf).strip())
         
-        return parts
+        return [part for part in parts if part]
     
     try:
         # Получаем базовую информацию
@@ -2698,59 +2969,52 @@ async def generate_participant_analytics(ozon_id: str) -> list[str]:
         if not participant:
             return ["❌ Участник не найден"]
         
-        # Получаем статистику
-        user_stats = await asyncio.to_thread(get_user_orders_stats, ozon_id)
-        summary = await asyncio.to_thread(get_user_orders_summary, ozon_id)
-        total_bonuses = await asyncio.to_thread(get_user_bonuses, ozon_id)
-        settings = await asyncio.to_thread(get_bonus_settings)
+        # Получаем статистику: независимые запросы выполняются параллельно
+        # (SQLite в режиме WAL допускает одновременных читателей)
+        user_stats, summary, total_bonuses, settings = await asyncio.gather(
+            asyncio.to_thread(get_user_orders_stats, ozon_id),
+            asyncio.to_thread(get_user_orders_summary, ozon_id),
+            asyncio.to_thread(get_user_bonuses, ozon_id),
+            asyncio.to_thread(get_bonus_settings),
+        )
         max_levels = settings.max_levels if settings else 3
         referrals_by_level = await asyncio.to_thread(get_referrals_by_level, ozon_id, max_level=max_levels)
         
-        # Формируем аналитику
-        analytics_text = ""
+        # Формируем аналитику: собираем фрагменты в список и склеиваем один раз
+        parts = [ANALYTICS_HEADER]
         
         # 1. Базовая информация
-        analytics_text += "=" * 50 + "\n"
-        analytics_text += f"📊 ПОДРОБНАЯ АНАЛИТИКА ПО УЧАСТНИКУ\n"
-        analytics_text += "=" * 50 + "\n\n"
-        
-        analytics_text += "👤 <b>БАЗОВАЯ ИНФОРМАЦИЯ</b>\n\n"
-        analytics_text += f"Ozon ID: <code>{participant.get('Ozon ID', 'Не указан')}</code>\n"
-        analytics_text += f"Имя / ник: {participant.get('Имя / ник', 'Не указано')}\n"
-        analytics_text += f"Telegram @: {participant.get('Телеграм @', 'Не указан')}\n"
-        analytics_text += f"Telegram ID: <code>{participant.get('Telegram ID', 'Не указан')}</code>\n"
-        analytics_text += f"Дата регистрации: {participant.get('Дата регистрации', 'Не указана')}\n"
+        parts.append(ANALYTICS_BASE_INFO_TMPL.format(
+            ozon_id=participant.get('Ozon ID', 'Не указан'),
+            name=participant.get('Имя / ник', 'Не указано'),
+            username=participant.get('Телеграм @', 'Не указан'),
+            telegram_id=participant.get('Telegram ID', 'Не указан'),
+            registration_date=participant.get('Дата регистрации', 'Не указана'),
+        ))
         
         referrer_id = participant.get('ID пригласившего')
         if referrer_id:
             referrer = await asyncio.to_thread(find_participant_by_ozon_id, referrer_id)
             if referrer:
-                analytics_text += f"Реферер: {referrer.get('Имя / ник', 'Не указано')} (Ozon ID: {referrer_id})\n"
+                parts.append(ANALYTICS_REFERRER_TMPL.format(
+                    name=referrer.get('Имя / ник', 'Не указано'),
+                    referrer_id=referrer_id,
+                ))
             else:
-                analytics_text += f"Реферер: Ozon ID {referrer_id} (не найден в базе)\n"
+                parts.append(ANALYTICS_REFERRER_NOT_FOUND_TMPL.format(referrer_id=referrer_id))
         else:
-            analytics_text += "Реферер: Нет реферера\n"
-        
-        analytics_text += "\n"
+            parts.append(ANALYTICS_NO_REFERRER)
         
         # 2. Статистика по заказам
-        analytics_text += "📦 <b>СТАТИСТИКА ПО ЗАКАЗАМ</b>\n\n"
-        analytics_text += f"Всего доставлено заказов: <b>{user_stats['delivered_count']}</b>\n"
-        analytics_text += f"Общая сумма доставленных: <b>{format_number(user_stats['total_sum'])}</b> ₽\n"
-        analytics_text += f"Всего заказов (с даты регистрации): <b>{summary['total_orders']}</b>\n"
-        analytics_text += f"Общая сумма всех заказов: <b>{format_number(summary['total_sum'])}</b> ₽\n\n"
-        
-        # Словарь для перевода статусов
-        status_names = {
-            "delivered": "✅ Доставлено",
-            "delivering": "🚚 В доставке",
-            "awaiting_packaging": "📦 Ожидает упаковки",
-            "awaiting_deliver": "⏳ Ожидает доставки",
-            "cancelled": "❌ Отменено",
-        }
+        parts.append(ANALYTICS_ORDERS_TMPL.format(
+            delivered_count=user_stats['delivered_count'],
+            delivered_sum=format_number(user_stats['total_sum']),
+            total_orders=summary['total_orders'],
+            total_sum=format_number(summary['total_sum']),
+        ))
         
         if summary.get('by_status'):
-            analytics_text += "Распределение по статусам:\n"
+            parts.append(ANALYTICS_STATUSES_HDR)
             
             sorted_statuses = sorted(
                 summary['by_status'].items(),
@@ -2759,12 +3023,13 @@ async def generate_participant_analytics(ozon_id: str) -> list[str]:
             )
             
             for status, data in sorted_statuses:
-                status_name = status_names.get(status, f"❓ {status}")
-                count = data.get('count', 0)
-                sum_amount = data.get('sum', 0.0)
-                analytics_text += f"  {status_name}: {count} заказ(ов) — {format_number(sum_amount)} ₽\n"
+                parts.append(ANALYTICS_STATUS_LINE_TMPL.format(
+                    status_name=STATUS_NAMES.get(status, f"❓ {status}"),
+                    count=data.get('count', 0),
+                    sum_amount=format_number(data.get('sum', 0.0)),
+                ))
         
-        analytics_text += "\n"
+        parts.append("\n")
         
         # Получаем последние 10 заказов
         def get_last_orders(ozon_id: str, limit: int = 10):
@@ -2781,82 +3046,83 @@ async def generate_participant_analytics(ozon_id: str) -> list[str]:
         
         last_orders = await asyncio.to_thread(get_last_orders, ozon_id, 10)
         
+        parts.append(ANALYTICS_LAST_ORDERS_HDR)
         if last_orders:
-            analytics_text += "📋 <b>ПОСЛЕДНИЕ 10 ЗАКАЗОВ</b>\n\n"
-            
             for i, order in enumerate(last_orders, 1):
-                order_date = order.created_at.strftime("%d.%m.%Y %H:%M") if order.created_at else "Не указана"
                 status = order.status or "unknown"
-                status_name = status_names.get(status, f"❓ {status}")
-                price = format_number(order.price_amount) if order.price_amount else "0,00"
-                order_id = order.order_id or "Не указан"
-                
-                analytics_text += f"{i}. <b>{order_date}</b>\n"
-                analytics_text += f"   Статус: {status_name}\n"
-                analytics_text += f"   Сумма: {price} ₽\n"
-                analytics_text += f"   Номер заказа: <code>{order_id}</code>\n\n"
+                parts.append(ANALYTICS_LAST_ORDER_TMPL.format(
+                    index=i,
+                    order_date=format_datetime(order.created_at) if order.created_at else "Не указана",
+                    status_name=STATUS_NAMES.get(status, f"❓ {status}"),
+                    price=format_number(order.price_amount) if order.price_amount else "0,00",
+                    order_id=order.order_id or "Не указан",
+                ))
         else:
-            analytics_text += "📋 <b>ПОСЛЕДНИЕ 10 ЗАКАЗОВ</b>\n\n"
-            analytics_text += "Заказы не найдены\n\n"
+            parts.append(ANALYTICS_NO_ORDERS)
         
         # 3. Бонусы
-        analytics_text += "💰 <b>БОНУСЫ</b>\n\n"
-        analytics_text += f"Всего начислено бонусов: <b>{format_number(total_bonuses)}</b> ₽\n\n"
-        
-        analytics_text += "Бонусы по уровням:\n"
-        for level in range(1, max_levels + 1):
-            level_bonuses = await asyncio.to_thread(get_user_bonuses, ozon_id, level=level)
+        parts.append(ANALYTICS_BONUS_TMPL.format(total_bonuses=format_number(total_bonuses)))
+        # Бонусы по уровням запрашиваем, только если бонусы вообще есть (иначе все уровни нулевые)
+        levels_bonuses = []
+        if total_bonuses > 0:
+            levels_bonuses = await asyncio.gather(*(
+                asyncio.to_thread(get_user_bonuses, ozon_id, level=level) for level in range(1, max_levels + 1)
+            ))
+        for level, level_bonuses in enumerate(levels_bonuses, 1):
             if level_bonuses > 0:
-                analytics_text += f"  Уровень {level}: {format_number(level_bonuses)} ₽\n"
+                parts.append(ANALYTICS_BONUS_LEVEL_TMPL.format(level=level, amount=format_number(level_bonuses)))
         
-        analytics_text += "\n"
+        parts.append("\n")
         
         # 4. Реферальная программа
-        analytics_text += "👥 <b>РЕФЕРАЛЬНАЯ ПРОГРАММА</b>\n\n"
+        parts.append(ANALYTICS_REF_HDR)
         
         total_referrals = 0
         total_referral_orders = 0
         total_referral_sum = 0.0
         total_referral_bonuses = 0.0
         
-        level_names = {
-            1: "Уровень 1 (прямые друзья)",
-            2: "Уровень 2 (друзья друзей)",
-            3: "Уровень 3 (друзья друзей друзей)",
-        }
+        # Статистика заказов и бонусов всех уровней запрашивается параллельно (запросы независимы)
+        levels_with_referrals = [level for level in range(1, max_levels + 1) if referrals_by_level.get(level)]
+        level_results = await asyncio.gather(*(
+            asyncio.gather(
+                asyncio.to_thread(get_referrals_orders_stats, referrals_by_level[level]),
+                asyncio.to_thread(get_referrals_bonuses_stats, referrals_by_level[level], level),
+            )
+            for level in levels_with_referrals
+        ))
+        level_stats = dict(zip(levels_with_referrals, level_results))
         
         for level in range(1, max_levels + 1):
             referral_ids = referrals_by_level.get(level, [])
+            level_name = ANALYTICS_LEVEL_NAMES.get(level, f"Уровень {level}")
             
             if referral_ids:
-                referrals_stats = await asyncio.to_thread(get_referrals_orders_stats, referral_ids)
-                referrals_bonuses = await asyncio.to_thread(get_referrals_bonuses_stats, referral_ids, level)
+                referrals_stats, referrals_bonuses = level_stats[level]
                 
                 total_referrals += len(referral_ids)
                 total_referral_orders += referrals_stats['orders_count']
                 total_referral_sum += referrals_stats['total_sum']
                 total_referral_bonuses += referrals_bonuses
                 
-                level_name = level_names.get(level, f"Уровень {level}")
-                analytics_text += f"{level_name}:\n"
-                analytics_text += f"  Участников: <b>{len(referral_ids)}</b>\n"
-                analytics_text += f"  Кол-во заказов: <b>{referrals_stats['orders_count']}</b>\n"
-                analytics_text += f"  Их сумма: <b>{format_number(referrals_stats['total_sum'])}</b> ₽\n"
-                analytics_text += f"  Начислено бонусов: <b>{format_number(referrals_bonuses)}</b> ₽\n\n"
+                parts.append(ANALYTICS_REF_LEVEL_TMPL.format(
+                    level_name=level_name,
+                    count=len(referral_ids),
+                    orders_count=referrals_stats['orders_count'],
+                    total_sum=format_number(referrals_stats['total_sum']),
+                    bonuses=format_number(referrals_bonuses),
+                ))
             else:
-                level_name = level_names.get(level, f"Уровень {level}")
-                analytics_text += f"{level_name}:\n"
-                analytics_text += f"  Участников: 0\n"
-                analytics_text += f"  Кол-во заказов: 0\n"
-                analytics_text += f"  Их сумма: 0 ₽\n"
-                analytics_text += f"  Начислено бонусов: 0 ₽\n\n"
-        
-        analytics_text += "─" * 50 + "\n"
-        analytics_text += "<b>ИТОГО ПО РЕФЕРАЛЬНОЙ ПРОГРАММЕ:</b>\n"
-        analytics_text += f"Всего рефералов: <b>{total_referrals}</b>\n"
-        analytics_text += f"Всего заказов рефералов: <b>{total_referral_orders}</b>\n"
-        analytics_text += f"Общая сумма заказов рефералов: <b>{format_number(total_referral_sum)}</b> ₽\n"
-        analytics_text += f"Всего бонусов от программы: <b>{format_number(total_referral_bonuses)}</b> ₽\n"
+                parts.append(ANALYTICS_REF_EMPTY_LEVEL_TMPL.format(level_name=level_name))
+        
+        parts.append(ANALYTICS_REF_FOOTER_TMPL.format(
+            total_referrals=total_referrals,
+            total_orders=total_referral_orders,
+            total_sum=format_number(total_referral_sum),
+            total_bonuses=format_number(total_referral_bonuses),
+        ))
+        
+        analytics_text = "".join(parts)
         
         # Разбиваем на части
         return split_text(analytics_text, max_length=4000)
@@ -2873,7 +3139,7 @@ async def notify_user_about_daily_bonuses(
     
     Args:
         referrer_telegram_id: Telegram ID пользователя (реферера)
-        bonus_summary: Словарь со сводкой бонусов (результат get_daily_bonus_summary)
+        bonus_summary: Словарь со сводкой бонусов (результат get_daily_bonus_totals)
     
     Returns:
         True если уведомление отправлено успешно, False в случае ошибки
@@ -2920,15 +3186,7 @@ async def notify_user_about_daily_bonuses(
             
             if level_count > 0 and level_amount > 0:
                 text += f"🎯 <b>Уровень {level}:</b>\n"
-                text += f"• Бонусов начислено: {format_number(level_amount)} ₽ ({level_count} заказ"
-                
-                # Правильное склонение слова "заказ"
-                if level_count == 1:
-                    text += ")\n\n"
-                elif level_count < 5:
-                    text += "а)\n\n"
-                else:
-                    text += "ов)\n\n"
+                text += f"• Бонусов начислено: {format_number(level_amount)} ₽ ({level_count} {plural_ru(level_count, ORDER_FORMS)})\n\n"
         
         # Итого
         text += f"💵 <b>Итого:</b> {format_number(total_amount)} ₽"
@@ -2936,9 +3194,13 @@ async def notify_user_about_daily_bonuses(
         await bot.send_message(referrer_telegram_id, text, parse_mode="HTML")
         return True
     except Exception as e:
-        print(f"⚠️ Не удалось отправить уведомление о бонусах пользователю {referrer_telegram_id}: {e}")
+        logger.warning("⚠️ Не удалось отправить уведомление о бонусах пользователю %s: %s", referrer_telegram_id, e)
         return False
 
+# Параметры рассылки ежедневных уведомлений о бонусах
+NOTIFICATION_WORKERS = 10  # Максимум одновременных отправок
+NOTIFICATION_QUEUE_SIZE = 100  # Размер очереди участников, ожидающих отправки
+
 async def send_daily_bonus_notifications(target_date: datetime = None):
     """
     Отправляет ежедневные уведомления о начисленных бонусах всем пользователям.
@@ -2950,13 +3212,13 @@ async def send_daily_bonus_notifications(target_date: datetime = None):
         # Используем вчерашний день
         target_date = datetime.now() - timedelta(days=1)
     
-    print(f"🔄 Начало отправки ежедневных уведомлений о бонусах за {target_date.strftime('%d.%m.%Y')}")
+    logger.info("🔄 Начало отправки ежедневных уведомлений о бонусах за %s", target_date.strftime('%d.%m.%Y'))
     
     # Получаем всех участников программы
     participants = await asyncio.to_thread(get_all_participants)
     
     if not participants:
-        print("ℹ️ Нет участников программы для отправки уведомлений")
+        logger.info("ℹ️ Нет участников программы для отправки уведомлений")
         return
     
     # Счетчики для статистики
@@ -2964,58 +3226,83 @@ async def send_daily_bonus_notifications(target_date: datetime = None):
     skipped_count = 0
     error_count = 0
     
-    # Отправляем уведомления параллельно с ограничением через Semaphore
-    semaphore = asyncio.Semaphore(10)  # Максимум 10 одновременных отправок
+    # Отбираем участников, которым вообще можно отправить уведомление, до запуска воркеров:
+    # без Ozon ID или с некорректным Telegram ID нет смысла занимать воркер и поток БД
+    eligible = []
+    for participant in participants:
+        ozon_id = participant.get("Ozon ID")
+        telegram_id_str = participant.get("Telegram ID")
+        
+        if not ozon_id or not telegram_id_str:
+            skipped_count += 1
+            continue
+        
+        # Преобразуем Telegram ID в int
+        try:
+            telegram_id = int(telegram_id_str)
+        except (ValueError, TypeError):
+            logger.warning("⚠️ Неверный Telegram ID для участника %s: %s", ozon_id, telegram_id_str)
+            skipped_count += 1
+            continue
+        
+        eligible.append((ozon_id, telegram_id))
+    
+    # Отправляем уведомления через пул воркеров с ограниченной очередью:
+    # число воркеров и есть ограничение параллельности, а в памяти одновременно
+    # живут только NOTIFICATION_WORKERS корутин, а не по одной на каждого участника
+    send_queue: asyncio.Queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
     
-    async def send_notification_to_user(participant: dict):
+    async def send_notification_to_user(ozon_id: str, telegram_id: int):
         nonlocal sent_count, skipped_count, error_count
         
-        async with semaphore:
-            try:
-                ozon_id = participant.get("Ozon ID")
-                telegram_id_str = participant.get("Telegram ID")
-                
-                if not ozon_id or not telegram_id_str:
-                    skipped_count += 1
-                    return
-                
-                # Преобразуем Telegram ID в int
-                try:
-                    telegram_id = int(telegram_id_str)
-                except (ValueError, TypeError):
-                    print(f"⚠️ Неверный Telegram ID для участника {ozon_id}: {telegram_id_str}")
-                    skipped_count += 1
-                    return
-                
-                # Получаем сводку бонусов за день
-                bonus_summary = await asyncio.to_thread(get_daily_bonus_summary, ozon_id, target_date)
-                
-                # Проверяем наличие начислений
-                if not bonus_summary or bonus_summary.get("total_amount", 0) == 0:
-                    # Нет начислений - пропускаем (не отправляем уведомление)
-                    skipped_count += 1
-                    return
-                
-                # Отправляем уведомление
-                success = await notify_user_about_daily_bonuses(telegram_id, bonus_summary)
-                
-                if success:
-                    sent_count += 1
-                else:
-                    error_count += 1
-                    
-            except Exception as e:
-                print(f"⚠️ Ошибка при обработке участника {participant.get('Ozon ID', 'unknown')}: {e}")
+        try:
+            # Получаем итоги бонусов за день (для уведомления список транзакций не нужен)
+            bonus_summary = await asyncio.to_thread(get_daily_bonus_totals, ozon_id, target_date)
+            
+            # Проверяем наличие начислений
+            if not bonus_summary or bonus_summary.get("total_amount", 0) == 0:
+                # Нет начислений - пропускаем (не отправляем уведомление)
+                skipped_count += 1
+                return
+            
+            # Отправляем уведомление
+            success = await notify_user_about_daily_bonuses(telegram_id, bonus_summary)
+            
+            if success:
+                sent_count += 1
+            else:
                 error_count += 1
+                
+        except Exception as e:
+            logger.warning("⚠️ Ошибка при обработке участника %s: %s", ozon_id, e)
+            error_count += 1
     
-    # Запускаем отправку уведомлений параллельно
-    tasks = [send_notification_to_user(p) for p in participants]
-    await asyncio.gather(*tasks, return_exceptions=True)
+    async def worker():
+        while True:
+            ozon_id, telegram_id = await send_queue.get()
+            try:
+                await send_notification_to_user(ozon_id, telegram_id)
+            finally:
+                send_queue.task_done()
     
-    print(f"✅ Отправка уведомлений завершена:")
-    print(f"   📨 Отправлено: {sent_count}")
-    print(f"   ⏭️  Пропущено (нет начислений): {skipped_count}")
-    print(f"   ❌ Ошибок: {error_count}")
+    workers = [asyncio.create_task(worker()) for _ in range(NOTIFICATION_WORKERS)]
+    try:
+        # Очередь ограничена, поэтому put() ждет, пока воркеры разберут уже поставленных участников
+        for item in eligible:
+            await send_queue.put(item)
+        await send_queue.join()
+    finally:
+        for worker_task in workers:
+            worker_task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    
+    logger.info(
+        "✅ Отправка уведомлений завершена: отправлено %s, пропущено (нет начислений) %s, ошибок %s",
+        sent_count, skipped_count, error_count,
+    )
+
+# Смещение московского времени относительно UTC
+MOSCOW_OFFSET = timedelta(hours=3)
 
 def get_moscow_time() -> datetime:
     """Получить текущее время в московском часовом поясе (UTC+3).
@@ -3025,302 +3312,325 @@ def get_moscow_time() -> datetime:
     """
     # Простое решение: добавляем 3 часа к UTC
     # Для более точной работы можно использовать pytz или zoneinfo, но это требует дополнительных зависимостей
-    utc_now = datetime.utcnow()
-    moscow_offset = timedelta(hours=3)
-    return utc_now + moscow_offset
+    return utcnow() + MOSCOW_OFFSET
 
-async def daily_notification_task():
+def get_next_sync_time(moscow_time: datetime) -> datetime:
+    """Возвращает ближайшее будущее время синхронизации из SYNC_TIMES (МСК).
+    
+    Args:
+        moscow_time: Текущее московское время
+    
+    Returns:
+        datetime: Ближайшее время синхронизации строго позже текущей минуты
     """
-    Фоновая задача для ежедневной отправки уведомлений о бонусах.
-    Запускается в 20:00 по московскому времени каждый день.
+    current_time = moscow_time.replace(second=0, microsecond=0)
+    today = current_time.date()
+    
+    # Бинарный поиск первого времени строго позже текущей минуты
+    index = bisect_right(_sync_clock_times, current_time.time())
+    if index < len(_sync_clock_times):
+        return datetime.combine(today, _sync_clock_times[index])
+    
+    # Все времена на сегодня уже прошли - берем первое время завтра
+    return datetime.combine(today + timedelta(days=1), _sync_clock_times[0])
+
+def was_synced_today(last_sync_time: datetime | None, moscow_time: datetime) -> bool:
+    """Проверяет, была ли последняя синхронизация в текущий московский день."""
+    return last_sync_time is not None and last_sync_time.date() == moscow_time.date()
+
+# Экспоненциальная задержка перед повтором после ошибки в фоновых задачах
+RETRY_BASE_DELAY = 1  # Первая задержка, секунд
+RETRY_MAX_EXPONENT = 12  # Ограничение роста задержки (2**12 сек ~ 68 минут)
+
+async def retry_sleep(retry: int, max_delay: float):
+    """
+    Ждет перед повторной попыткой после ошибки: 1, 2, 4, ... секунд плюс случайная добавка до 1 сек.
+    
+    Args:
+        retry: Номер повтора подряд (0 для первой ошибки)
+        max_delay: Верхняя граница задержки (например, время до следующего запланированного запуска)
+    """
+    delay = RETRY_BASE_DELAY * 2 ** min(retry, RETRY_MAX_EXPONENT) + random.random()
+    await asyncio.sleep(max(0.0, min(delay, max_delay)))
+
+# Длинные ожидания в фоновых задачах режем на куски, чтобы после каждого сверяться с часами
+# (на случай сна системы или задержек event loop)
+SLEEP_CHUNK_SECONDS = 3600
+SCHEDULER_DRIFT_WARNING_SECONDS = 60  # Опоздание пробуждения, о котором стоит предупредить
+
+async def sleep_until(target_datetime: datetime):
+    """
+    Спит до указанного московского времени кусками не длиннее SLEEP_CHUNK_SECONDS.
+    
+    После каждого куска оставшееся время пересчитывается по часам, поэтому пробуждение не уплывает
+    на часы, если таймер event loop отстал. Опоздание пробуждения пишется в лог.
+    
+    Args:
+        target_datetime: Московское время, до которого нужно ждать
+    """
+    while (remaining := (target_datetime - get_moscow_time()).total_seconds()) > 0:
+        await asyncio.sleep(min(remaining, SLEEP_CHUNK_SECONDS))
+    
+    drift = (get_moscow_time() - target_datetime).total_seconds()
+    if drift > SCHEDULER_DRIFT_WARNING_SECONDS:
+        logger.warning("⚠️ Планировщик проснулся с опозданием на %.0f сек (цель: %s МСК)", drift, target_datetime.strftime('%d.%m.%Y %H:%M'))
+    else:
+        logger.debug("Планировщик проснулся, опоздание %.3f сек", drift)
+
+async def supervise_task(run_cycle, task_name: str, get_max_delay):
     """
-    print(f"🔄 Запущена фоновая задача ежедневных уведомлений о бонусах (время отправки: 20:00 МСК)")
+    Запускает цикл фоновой задачи снова и снова, отделяя восстановление после ошибок от расписания.
+    
+    Args:
+        run_cycle: Корутинная функция одного цикла (ожидание + работа)
+        task_name: Название задачи для логов (в родительном падеже)
+        get_max_delay: Функция, возвращающая верхнюю границу задержки перед повтором (сек)
+    """
+    retry = 0
     
     while True:
         try:
-            # Получаем текущее московское время
-            moscow_time = get_moscow_time()
-            current_hour = moscow_time.hour
-            current_minute = moscow_time.minute
-            
-            # Целевое время отправки: 20:00 МСК
-            target_hour = 20
-            target_minute = 0
-            
-            # Вычисляем время до следующего запуска
-            if current_hour < target_hour or (current_hour == target_hour and current_minute < target_minute):
-                # Еще не наступило время отправки сегодня - ждем до 20:00
-                target_datetime = moscow_time.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
-            else:
-                # Время уже прошло - отправляем за сегодня, следующий запуск будет завтра
-                target_datetime = (moscow_time + timedelta(days=1)).replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
-            
-            # Вычисляем количество секунд до следующего запуска
-            wait_seconds = (target_datetime - moscow_time).total_seconds()
-            
-            if wait_seconds > 0:
-                wait_hours = wait_seconds / 3600
-                print(f"⏰ Следующая отправка уведомлений через {wait_hours:.1f} часов (в {target_datetime.strftime('%d.%m.%Y %H:%M')} МСК)")
-                await asyncio.sleep(wait_seconds)
-                # После ожидания пересчитываем московское время
-                moscow_time = get_moscow_time()
-            
-            # Отправляем уведомления (за вчерашний день от текущего московского времени)
-            yesterday = moscow_time - timedelta(days=1)
-            print(f"📨 Начало отправки ежедневных уведомлений о бонусах за {yesterday.strftime('%d.%m.%Y')}")
-            await send_daily_bonus_notifications(yesterday)
-            
+            await run_cycle()
+            retry = 0
         except asyncio.CancelledError:
-            print("🛑 Фоновая задача ежедневных уведомлений отменена")
+            logger.info("🛑 Фоновая задача %s отменена", task_name)
             break
         except Exception as e:
-            print(f"❌ Ошибка в фоновой задаче ежедневных уведомлений: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Ошибка в фоновой задаче %s: %s", task_name, e)
             # Продолжаем работу, даже если произошла ошибка
-            # Ждем 1 час перед следующей попыткой
-            await asyncio.sleep(3600)
+            # Ждем с нарастающей задержкой перед следующей попыткой
+            await retry_sleep(retry, get_max_delay())
+            retry += 1
 
-def should_sync_on_startup() -> bool:
+async def _run_notification_cycle():
+    """Один цикл ежедневных уведомлений: ждет 20:00 МСК и отправляет уведомления за вчера."""
+    # Получаем текущее московское время
+    moscow_time = get_moscow_time()
+    current_hour = moscow_time.hour
+    current_minute = moscow_time.minute
+    
+    # Целевое время отправки: 20:00 МСК
+    target_hour = 20
+    target_minute = 0
+    
+    # Вычисляем время до следующего запуска
+    if current_hour < target_hour or (current_hour == target_hour and current_minute < target_minute):
+        # Еще не наступило время отправки сегодня - ждем до 20:00
+        target_datetime = moscow_time.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
+    else:
+        # Время уже прошло - отправляем за сегодня, следующий запуск будет завтра
+        target_datetime = (moscow_time + timedelta(days=1)).replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
+    
+    # Вычисляем количество секунд до следующего запуска
+    wait_seconds = (target_datetime - moscow_time).total_seconds()
+    
+    if wait_seconds > 0:
+        wait_hours = wait_seconds / 3600
+        logger.info("⏰ Следующая отправка уведомлений через %.1f часов (в %s МСК)", wait_hours, target_datetime.strftime('%d.%m.%Y %H:%M'))
+        await sleep_until(target_datetime)
+        moscow_time = target_datetime
+    
+    # Отправляем уведомления (за вчерашний день от текущего московского времени)
+    yesterday = moscow_time - timedelta(days=1)
+    logger.info("📨 Начало отправки ежедневных уведомлений о бонусах за %s", yesterday.strftime('%d.%m.%Y'))
+    await send_daily_bonus_notifications(yesterday)
+
+async def daily_notification_task():
+    """
+    Фоновая задача для ежедневной отправки уведомлений о бонусах.
+    Запускается в 20:00 по московскому времени каждый день.
+    """
+    logger.info("🔄 Запущена фоновая задача ежедневных уведомлений о бонусах (время отправки: 20:00 МСК)")
+    # После ошибки ждем не больше часа
+    await supervise_task(_run_notification_cycle, "ежедневных уведомлений", lambda: 3600)
+
+def should_sync_on_startup(moscow_time: datetime = None, last_sync_time: datetime = None) -> bool:
     """
     Проверяет, нужно ли выполнить синхронизацию при старте бота.
     Возвращает True, если:
     - Синхронизации еще не было, ИЛИ
     - Сейчас уже после первого времени синхронизации (13:00) МСК, а последняя синхронизация была вчера или раньше
+    
+    Args:
+        moscow_time: Текущее московское время (если уже получено вызывающим кодом)
+        last_sync_time: Время последней синхронизации (если уже прочитано из БД вызывающим кодом)
     """
-    last_sync_time = get_last_sync_timestamp()
+    if last_sync_time is None:
+        last_sync_time = get_last_sync_timestamp()
     
     if last_sync_time is None:
         # Первый запуск - нужно синхронизировать
         return True
     
+    # Синхронизация была совсем недавно (например, бот перезапустили сразу после нее) - не повторяем
+    # (время последней синхронизации сохраняется по локальным часам сервера, поэтому сравниваем с datetime.now())
+    if datetime.now() - last_sync_time < _sync_freshness:
+        return False
+    
     # Получаем текущее московское время
-    moscow_time = get_moscow_time()
-    first_sync_hour, first_sync_minute = SYNC_TIMES[0]  # Первое время синхронизации (13:00)
-    current_time = moscow_time.replace(second=0, microsecond=0)
-    first_sync_time_today = moscow_time.replace(hour=first_sync_hour, minute=first_sync_minute, second=0, microsecond=0)
+    if moscow_time is None:
+        moscow_time = get_moscow_time()
+    today = moscow_time.date()
+    last_sync_date = last_sync_time.date()
+    first_sync_time_today = datetime.combine(today, _sync_clock_times[0])  # Первое время синхронизации (13:00)
     
     # Если сейчас уже после первого времени синхронизации, проверяем, была ли сегодня синхронизация
-    if current_time >= first_sync_time_today:
-        # Проверяем, была ли синхронизация сегодня
-        last_sync_date = last_sync_time.date()
-        today = moscow_time.date()
-        
+    if moscow_time.replace(second=0, microsecond=0) >= first_sync_time_today:
         # Если последняя синхронизация была не сегодня, нужно синхронизировать
         return last_sync_date < today
     
     # Если сейчас до первого времени синхронизации, проверяем, была ли синхронизация вчера
-    yesterday = moscow_time.date() - timedelta(days=1)
-    last_sync_date = last_sync_time.date()
-    
     # Если последняя синхронизация была вчера или раньше, и сейчас уже после полуночи, нужно синхронизировать
-    return last_sync_date < yesterday
+    return last_sync_date < today - timedelta(days=1)
+
+class StartupSyncState(NamedTuple):
+    """Состояние синхронизации на момент старта бота (вычисляется один раз в get_startup_sync_state)."""
+    need_sync: bool  # Нужно ли синхронизировать сразу при старте
+    moscow_time: datetime  # Текущее московское время
+    last_sync_time: datetime | None  # Время последней синхронизации (None - еще не было)
+    next_sync_time: datetime  # Ближайшее время синхронизации по расписанию
+
+def get_startup_sync_state() -> StartupSyncState:
+    """Читает время последней синхронизации и вычисляет все, что нужно main() при старте, за один проход."""
+    moscow_time = get_moscow_time()
+    last_sync_time = get_last_sync_timestamp()
+    return StartupSyncState(
+        need_sync=should_sync_on_startup(moscow_time, last_sync_time),
+        moscow_time=moscow_time,
+        last_sync_time=last_sync_time,
+        next_sync_time=get_next_sync_time(moscow_time),
+    )
+
+async def _run_sync_cycle():
+    """Один цикл синхронизации: ждет ближайшее время из SYNC_TIMES и запускает синхронизацию."""
+    # Получаем текущее московское время и ближайшее время синхронизации
+    moscow_time = get_moscow_time()
+    target_datetime = get_next_sync_time(moscow_time)
+    
+    wait_seconds = (target_datetime - moscow_time).total_seconds()
+    logger.info("⏰ Следующая синхронизация заказов через %.1f часов (в %s МСК)", wait_seconds / 3600, target_datetime.strftime('%d.%m.%Y %H:%M'))
+    await sleep_until(target_datetime)
+    
+    # Выполняем синхронизацию
+    logger.info("🔄 Начало ежедневной синхронизации заказов в %s МСК", target_datetime.strftime('%d.%m.%Y %H:%M'))
+    await run_auto_sync_with_timeout(notify_admins=True, slot=_sync_slots.get(target_datetime.time()))
+
+def _seconds_until_next_sync() -> float:
+    """Сколько секунд осталось до ближайшего времени синхронизации."""
+    moscow_time = get_moscow_time()
+    return (get_next_sync_time(moscow_time) - moscow_time).total_seconds()
 
 async def periodic_sync_task():
     """
     Фоновая задача для ежедневной синхронизации заказов.
     Запускается в 13:00 и 19:30 по московскому времени каждый день.
     """
-    sync_times_str = ", ".join([f"{h:02d}:{m:02d}" for h, m in SYNC_TIMES])
-    print(f"🔄 Запущена фоновая задача ежедневной синхронизации заказов (время синхронизации: {sync_times_str} МСК)")
-    
-    while True:
-        try:
-            # Получаем текущее московское время
-            moscow_time = get_moscow_time()
-            current_time = moscow_time.replace(second=0, microsecond=0)
-            
-            # Находим ближайшее время синхронизации
-            target_datetime = None
-            min_seconds = float('inf')
-            
-            for sync_hour, sync_minute in SYNC_TIMES:
-                # Создаем время синхронизации на сегодня
-                sync_time_today = moscow_time.replace(hour=sync_hour, minute=sync_minute, second=0, microsecond=0)
-                
-                # Если время уже прошло сегодня, берем на завтра
-                if sync_time_today <= current_time:
-                    sync_time_today = (moscow_time + timedelta(days=1)).replace(hour=sync_hour, minute=sync_minute, second=0, microsecond=0)
-                
-                # Вычисляем разницу в секундах
-                seconds_until_sync = (sync_time_today - current_time).total_seconds()
-                
-                # Если это ближайшее время, сохраняем его
-                if seconds_until_sync < min_seconds:
-                    min_seconds = seconds_until_sync
-                    target_datetime = sync_time_today
-            
-            # Вычисляем количество секунд до следующего запуска
-            wait_seconds = (target_datetime - current_time).total_seconds()
-            
-            if wait_seconds > 0:
-                wait_hours = wait_seconds / 3600
-                print(f"⏰ Следующая синхронизация заказов через {wait_hours:.1f} часов (в {target_datetime.strftime('%d.%m.%Y %H:%M')} МСК)")
-                await asyncio.sleep(wait_seconds)
-                # После ожидания пересчитываем московское время
-                moscow_time = get_moscow_time()
-            
-            # Выполняем синхронизацию
-            print(f"🔄 Начало ежедневной синхронизации заказов в {moscow_time.strftime('%d.%m.%Y %H:%M')} МСК")
-            await perform_auto_sync(notify_admins=True)
-            
-        except asyncio.CancelledError:
-            print("🛑 Фоновая задача синхронизации отменена")
-            break
-        except Exception as e:
-            print(f"❌ Критическая ошибка в фоновой задаче синхронизации: {e}")
-            import traceback
-            traceback.print_exc()
-            # Продолжаем работу, даже если произошла ошибка
-            # Ждем еще немного перед следующей попыткой
-            await asyncio.sleep(60)  # 1 минута перед повтором
+    sync_times_str = ", ".join([t.strftime("%H:%M") for t in _sync_clock_times])
+    logger.info("🔄 Запущена фоновая задача ежедневной синхронизации заказов (время синхронизации: %s МСК)", sync_times_str)
+    # После ошибки ждем не дольше, чем до следующего времени синхронизации
+    await supervise_task(_run_sync_cycle, "синхронизации", _seconds_until_next_sync)
+
+# Период фоновой разморозки бонусов, у которых прошло 14 дней (при чтении баланса она не выполняется)
+BONUS_AVAILABILITY_INTERVAL_SECONDS = 300
+
+async def _run_bonus_availability_cycle():
+    """Один цикл обновления доступности бонусов: ждет интервал и размораживает бонусы."""
+    await asyncio.sleep(BONUS_AVAILABILITY_INTERVAL_SECONDS)
+    updated_count = await asyncio.to_thread(check_and_update_bonus_availability)
+    if updated_count:
+        logger.info("🔓 Обновлено статусов доступности бонусов: %s", updated_count)
+
+async def bonus_availability_task():
+    """
+    Фоновая задача для периодического обновления доступности бонусов к выводу.
+    Запускается каждые BONUS_AVAILABILITY_INTERVAL_SECONDS секунд.
+    """
+    logger.info("🔄 Запущена фоновая задача обновления доступности бонусов (каждые %s сек)", BONUS_AVAILABILITY_INTERVAL_SECONDS)
+    await supervise_task(_run_bonus_availability_cycle, "обновления доступности бонусов", lambda: BONUS_AVAILABILITY_INTERVAL_SECONDS)
 
 async def main():
-    global _sync_task
+    # Логи пишем через очередь в отдельном потоке
+    log_listener = start_log_listener()
     
-    # Настраиваем Bot с кастомным connector для принудительного использования IPv4
-    # Делаем это внутри async функции, чтобы event loop был запущен
-    try:
-        import aiohttp
-        from aiohttp import TCPConnector
-        from aiogram.client.session.aiohttp import AiohttpSession
-        
-        # Создаем AiohttpSession
-        aiogram_session = AiohttpSession(limit=100)
-        
-        # Модифицируем _connector_init для использования IPv4
-        # Это должно работать, если connector создается лениво при первом использовании
-        aiogram_session._connector_init['family'] = socket.AF_INET
-        # Устанавливаем флаг для пересоздания connector
-        aiogram_session._should_reset_connector = True
-        
-        # Если сессия уже создана, нужно пересоздать connector
-        # Проверяем, есть ли уже созданная сессия
-        
-        if hasattr(aiogram_session, '_session') and aiogram_session._session is not None:
-            # Проверяем, есть ли connector в сессии
-            connector_exists = hasattr(aiogram_session._session, '_connector') and aiogram_session._session._connector is not None
-            
-            if connector_exists:
-                # Закрываем старый connector
-                await aiogram_session._session._connector.close()
-            # Закрываем старую сессию
-            await aiogram_session._session.close()
-            # Удаляем старую сессию, чтобы она пересоздалась с новым connector
-            aiogram_session._session = None
-        
-        # Пересоздаем сессию с новым connector (если она была создана)
-        # Это гарантирует, что сессия будет использовать модифицированный _connector_init
-        if hasattr(aiogram_session, 'create_session'):
-            try:
-                # Вызываем create_session для пересоздания с новым connector
-                await aiogram_session.create_session()
-            except Exception as recreate_err:
-                pass
-        
-        # Пересоздаем bot с кастомной сессией
-        global bot
-        bot = Bot(token=API_TOKEN, session=aiogram_session)
-    except Exception as session_err:
-        # Если не удалось создать кастомную сессию, используем стандартную
-        pass
+    # Инициализируем базу данных (создаем все таблицы, включая новые) в фоне,
+    # пока настраивается сессия бота - дожидаемся только перед первым обращением к БД
+    db_task = asyncio.create_task(asyncio.to_thread(create_database))
     
-    # Инициализируем базу данных (создаем все таблицы, включая новые)
-    try:
-        await asyncio.to_thread(create_database)
-    except Exception as e:
-        raise
+    # Пересоздаем Bot с сессией, которая ходит к Telegram только по IPv4
+    # Делаем это внутри async функции, чтобы event loop был запущен; сама aiohttp-сессия
+    # и connector создаются лениво при первом запросе к Telegram
+    global bot
+    aiogram_session = IPv4AiohttpSession(limit=100)
+    bot = Bot(token=API_TOKEN, session=aiogram_session)
+    
+    # Дожидаемся инициализации базы данных
+    await db_task
+    
+    # Подбираем расписание синхронизаций по сохраненной длительности прошлых запусков
+    sync_times = choose_sync_times(await asyncio.to_thread(get_sync_durations_by_slot))
+    if sync_times != SYNC_TIMES:
+        logger.info("⏰ Расписание синхронизации скорректировано по статистике: %s МСК", ", ".join(f"{h:02d}:{m:02d}" for h, m in sync_times))
+    set_sync_schedule(sync_times)
     
     # Проверяем подключение к интернету перед запуском polling
     
     # Проверяем, нужно ли выполнить синхронизацию при старте
-    if should_sync_on_startup():
-        print("🔄 Выполняем синхронизацию при старте (прошло достаточно времени или еще не было синхронизации)...")
-        await perform_auto_sync(notify_admins=False)  # Не уведомляем при старте, чтобы не спамить
+    # (московское время, время последней и следующей синхронизации вычисляются один раз)
+    startup_state = await asyncio.to_thread(get_startup_sync_state)
+    last_sync_time = startup_state.last_sync_time
+    next_sync_time = startup_state.next_sync_time
+    if startup_state.need_sync:
+        logger.info("🔄 Выполняем синхронизацию при старте (прошло достаточно времени или еще не было синхронизации)...")
+        # Синхронизация идет в фоне (запускается вместе с фоновыми задачами ниже), чтобы polling запустился сразу
+    elif last_sync_time:
+        if was_synced_today(last_sync_time, startup_state.moscow_time):
+            logger.info("⏰ Синхронизация уже была выполнена сегодня (%s), следующая будет в %s МСК", last_sync_time.strftime('%d.%m.%Y %H:%M'), next_sync_time.strftime('%H:%M'))
+        else:
+            logger.info("⏰ Последняя синхронизация была %s, следующая будет в %s МСК", last_sync_time.strftime('%d.%m.%Y'), next_sync_time.strftime('%H:%M'))
     else:
-            moscow_time = get_moscow_time()
-            last_sync_time = get_last_sync_timestamp()
-            current_time = moscow_time.replace(second=0, microsecond=0)
-            
-            # Находим ближайшее время синхронизации
-            next_sync_time = None
-            min_seconds = float('inf')
-            
-            for sync_hour, sync_minute in SYNC_TIMES:
-                sync_time_today = moscow_time.replace(hour=sync_hour, minute=sync_minute, second=0, microsecond=0)
-                if sync_time_today <= current_time:
-                    sync_time_today = (moscow_time + timedelta(days=1)).replace(hour=sync_hour, minute=sync_minute, second=0, microsecond=0)
-                
-                seconds_until_sync = (sync_time_today - current_time).total_seconds()
-                if seconds_until_sync < min_seconds:
-                    min_seconds = seconds_until_sync
-                    next_sync_time = sync_time_today
-            
-            if last_sync_time:
-                last_sync_date = last_sync_time.date()
-                today = moscow_time.date()
-                if last_sync_date == today:
-                    sync_times_str = ", ".join([f"{h:02d}:{m:02d}" for h, m in SYNC_TIMES])
-                    print(f"⏰ Синхронизация уже была выполнена сегодня ({last_sync_time.strftime('%d.%m.%Y %H:%M')}), следующая будет в {next_sync_time.strftime('%H:%M')} МСК")
-                else:
-                    print(f"⏰ Последняя синхронизация была {last_sync_date.strftime('%d.%m.%Y')}, следующая будет в {next_sync_time.strftime('%H:%M')} МСК")
-            else:
-                wait_hours = (next_sync_time - moscow_time).total_seconds() / 3600
-                print(f"ℹ️ Первая синхронизация будет выполнена в {next_sync_time.strftime('%d.%m.%Y %H:%M')} МСК (через {wait_hours:.1f} часов)")
-    
-    # Запускаем фоновую задачу для периодической синхронизации
-    _sync_task = asyncio.create_task(periodic_sync_task())
-    print("✅ Фоновая задача периодической синхронизации запущена")
-    
-    # Запускаем фоновую задачу для ежедневных уведомлений о бонусах
-    global _notification_task
-    _notification_task = asyncio.create_task(daily_notification_task())
-    print("✅ Фоновая задача ежедневных уведомлений о бонусах запущена")
+        wait_hours = (next_sync_time - startup_state.moscow_time).total_seconds() / 3600
+        logger.info("ℹ️ Первая синхронизация будет выполнена в %s МСК (через %.1f часов)", next_sync_time.strftime('%d.%m.%Y %H:%M'), wait_hours)
     
     try:
-        try:
-            await dp.start_polling(bot)
-        except Exception as polling_err:
-            raise
+        # Фоновые задачи живут в TaskGroup: при выходе из polling или ошибке в одной из них
+        # остальные отменяются автоматически, и выход из блока дожидается их остановки
+        async with asyncio.TaskGroup() as task_group:
+            background_tasks = [
+                # Фоновая задача для периодической синхронизации
+                task_group.create_task(periodic_sync_task()),
+                # Фоновая задача для ежедневных уведомлений о бонусах
+                task_group.create_task(daily_notification_task()),
+                # Фоновая задача для обновления доступности бонусов к выводу
+                task_group.create_task(bonus_availability_task()),
+            ]
+            if startup_state.need_sync:
+                # Не уведомляем при старте, чтобы не спамить
+                background_tasks.append(task_group.create_task(run_auto_sync_with_timeout(notify_admins=False)))
+            logger.info("✅ Фоновые задачи синхронизации, ежедневных уведомлений и доступности бонусов запущены")
+            
+            try:
+                await dp.start_polling(bot)
+            finally:
+                # Polling завершился - останавливаем фоновые задачи, иначе TaskGroup будет ждать их вечно
+                for task in background_tasks:
+                    task.cancel()
     except Exception as e:
-        print(f"Критическая ошибка в боте: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Критическая ошибка в боте: %s", e)
         raise
     finally:
-        # Отменяем фоновую задачу синхронизации
-        if _sync_task and not _sync_task.done():
-            print("🛑 Останавливаем фоновую задачу синхронизации...")
-            _sync_task.cancel()
-            try:
-                await _sync_task
-            except asyncio.CancelledError:
-                pass
-            print("✅ Фоновая задача синхронизации остановлена")
-        
-        # Отменяем фоновую задачу ежедневных уведомлений
-        if _notification_task and not _notification_task.done():
-            print("🛑 Останавливаем фоновую задачу ежедневных уведомлений...")
-            _notification_task.cancel()
-            try:
-                await _notification_task
-            except asyncio.CancelledError:
-                pass
-            print("✅ Фоновая задача ежедневных уведомлений остановлена")
-        
-        # Закрываем кастомную сессию при завершении (если она была создана)
+        # Закрываем сессию при завершении (если она так и не была создана, close() ничего не делает)
         try:
-            # Проверяем, есть ли кастомная aiogram сессия в локальной области видимости
-            if 'aiogram_session' in locals():
-                await aiogram_session.close()
+            await aiogram_session.close()
         except Exception as close_err:
-            pass
+            logger.warning("⚠️ Не удалось закрыть сессию бота: %s", close_err)
+        
+        # Дописываем оставшиеся в очереди логи и останавливаем поток логирования
+        log_listener.stop()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except Exception as e:
         print(f"Ошибка при запуске бота: {e}")
-        import traceback
         traceback.print_exc()
         raise
\ No newline at end of file
@@ -2,15 +2,69 @@
 
 import os
 import json
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float
+import time
+import threading
+from sqlalchemy import create_engine, event, func, case, cast, exists, select, insert, update, or_, text, bindparam, Column, Index, Integer, String, DateTime, Float
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, declarative_base, Session
-from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta, timezone
+
+def utcnow() -> datetime:
+    """Текущее время UTC без tzinfo (в БД все даты хранятся как naive UTC; замена устаревшему datetime.utcnow())."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 # >>> НАЧАЛО БЛОКА: КОНФИГУРАЦИЯ БАЗЫ ДАННЫХ <<<
 DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "referral_orders.db")
 DATABASE_URL = f"sqlite:///{DB_FILE}"
 
-engine = create_engine(DATABASE_URL)
+# PRAGMA, применяемые к каждому новому соединению с SQLite (большинство настроек действуют
+# только на соединение, поэтому одного раза при создании БД недостаточно)
+SQLITE_PRAGMAS = (
+    # busy_timeout первым: следующие PRAGMA (journal_mode) сами могут ждать блокировку
+    "PRAGMA busy_timeout=30000",  # Ждать освобождения блокировки до 30 секунд вместо ошибки
+    "PRAGMA journal_mode=WAL",  # Читатели не блокируют писателя и наоборот
+    "PRAGMA synchronous=NORMAL",  # В режиме WAL безопасно и без fsync на каждый коммит
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64 МБ кэша страниц
+    "PRAGMA mmap_size=268435456",  # 256 МБ memory-mapped I/O
+    "PRAGMA foreign_keys=ON",
+)
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Применяет SQLITE_PRAGMAS к новому соединению (обработчик события connect движка)."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+# Размер пула соединений: обращения к БД из бота идут через asyncio.to_thread, и потоков
+# пула по умолчанию (до 32) больше, чем соединений в стандартном QueuePool (5 + 10),
+# поэтому при пиках обработчики ждали свободное соединение
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_RECYCLE = 3600  # Пересоздавать соединения раз в час
+DB_CONNECT_TIMEOUT = 30  # Таймаут ожидания блокировки в драйвере sqlite3 (по умолчанию 5 секунд), в секундах
+
+# Максимум значений в одном IN (...) при пакетных выборках (старые сборки SQLite ограничены 999 параметрами)
+IN_QUERY_CHUNK_SIZE = 500
+
+def make_engine(database_url: str):
+    """Создает движок SQLAlchemy для SQLite с настройками производительности на каждом соединении."""
+    new_engine = create_engine(
+        database_url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        # Соединения из пула используются в разных потоках (asyncio.to_thread)
+        connect_args={"timeout": DB_CONNECT_TIMEOUT, "check_same_thread": False},
+    )
+    event.listen(new_engine, "connect", _apply_sqlite_pragmas)
+    return new_engine
+
+engine = make_engine(DATABASE_URL)
 
 Base = declarative_base()  # SQLAlchemy 2.0+
 
@@ -18,20 +72,43 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # >>> КОНЕЦ БЛОКА: КОНФИГУРАЦИЯ БАЗЫ ДАННЫХ <<<
 
 # >>> НАЧАЛО БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "orders" <<<
+def buyer_id_from_posting_number(posting_number: str | None) -> str:
+    """Извлекает buyer_id из posting_number: первые цифры до первого тире
+    (например: "10054917-1093-1" -> "10054917"), а если тире нет - весь posting_number."""
+    posting_number = (posting_number or "").strip()
+    if not posting_number:
+        return ""
+    return posting_number.split("-", 1)[0].strip()
+
+def order_buyer_id(buyer_id: str | None, posting_number: str | None) -> str | None:
+    """Возвращает buyer_id заказа: переданное значение, а если оно пустое или из одних пробелов -
+    выведенное из posting_number (None, если вывести не из чего)."""
+    buyer_id = (buyer_id or "").strip()
+    return buyer_id or buyer_id_from_posting_number(posting_number) or None
+
+def _default_order_buyer_id(context) -> str | None:
+    """Значение buyer_id по умолчанию при вставке заказа: выводится из posting_number,
+    чтобы колонка (и индекс по ней) была заполнена при любом способе вставки."""
+    return order_buyer_id(None, context.get_current_parameters().get("posting_number"))
+
 class Order(Base):
     """Модель для хранения заказов Ozon."""
     
     __tablename__ = "orders"
+    __table_args__ = (
+        # Составной индекс под выборки заказов пользователя: buyer_id + status + created_at >= дата регистрации
+        Index("ix_orders_buyer_status_created", "buyer_id", "status", "created_at"),
+    )
     
     # 1. Основные поля
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(String, unique=False, index=True) # Номер заказа (не unique, так как может быть несколько товаров)
     posting_number = Column(String, unique=True, index=True) # Номер отправления (Должен быть уникальным для строки заказа/товара)
     status = Column(String) 
-    created_at = Column(DateTime, default=datetime.utcnow) # ИСПРАВЛЕНО
+    created_at = Column(DateTime, default=func.current_timestamp()) # ИСПРАВЛЕНО
     
     # 2. Поля для аналитики и пользователя
-    buyer_id = Column(String, index=True) # ID покупателя (ключ для рефералов)
+    buyer_id = Column(String, default=_default_order_buyer_id) # ID покупателя (ключ для рефералов; индексируется составным индексом ix_orders_buyer_status_created)
     price_amount = Column(String) 
     item_name = Column(String) 
     item_sku = Column(String) 
@@ -44,7 +121,7 @@ class Order(Base):
     cluster_to = Column(String)
     address = Column(String)
     
-    sync_time = Column(DateTime, default=datetime.utcnow) # ИСПРАВЛЕНО
+    sync_time = Column(DateTime, default=func.current_timestamp()) # ИСПРАВЛЕНО
     
     currency_code = Column(String)
     articul = Column(String)
@@ -66,6 +143,13 @@ class Order(Base):
     is_legal_entity = Column(String)
     payment_method = Column(String)
     
+def _fill_order_buyer_id(mapper, connection, target):
+    """Перед вставкой заказа через ORM: пустой buyer_id ("" или пробелы) заменяется выведенным из posting_number.
+    Значение по умолчанию колонки срабатывает только если buyer_id не передан вовсе."""
+    target.buyer_id = order_buyer_id(target.buyer_id, target.posting_number)
+
+event.listen(Order, "before_insert", _fill_order_buyer_id)
+
 # >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "orders" <<<
 
 # >>> НАЧАЛО БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "customers" <<<
@@ -75,7 +159,7 @@ class Customer(Base):
     __tablename__ = "customers"
     
     # Основные поля
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     buyer_id = Column(String, unique=True, index=True)  # ID покупателя (уникальный ключ)
     
     # Контактная информация
@@ -96,13 +180,13 @@ class Customer(Base):
     
     # Статистика
     total_orders = Column(Integer, default=0)  # Общее количество заказов
-    total_spent = Column(String, default="0")  # Общая сумма покупок
+    total_spent = Column(Float, default=0.0)  # Общая сумма покупок
     
     # Временные метки
     first_order_date = Column(DateTime)  # Дата первого заказа
     last_order_date = Column(DateTime)  # Дата последнего заказа
-    created_at = Column(DateTime, default=datetime.utcnow)  # Дата создания записи
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Дата обновления
+    created_at = Column(DateTime, default=func.current_timestamp())  # Дата создания записи
+    updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())  # Дата обновления
     
 # >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "customers" <<<
 
@@ -113,13 +197,14 @@ class Participant(Base):
     __tablename__ = "participants"
     
     # Основные поля
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     ozon_id = Column(String, unique=True, index=True)  # Ozon ID (уникальный ключ)
     telegram_id = Column(String, unique=True, index=True)  # Telegram ID (уникальный ключ)
     
     # Информация о пользователе
     name = Column(String)  # Имя / ник
     username = Column(String)  # Telegram username (с @)
+    username_norm = Column(String, index=True)  # Username без @ в нижнем регистре (для поиска, см. normalize_username)
     
     # Реферальная информация
     referrer_id = Column(String, index=True)  # ID пригласившего (ozon_id реферера)
@@ -129,10 +214,10 @@ class Participant(Base):
     is_active = Column(Integer, default=1)  # Флаг активности (1 = активен, 0 = неактивен)
     
     # Временные метки
-    registration_date = Column(DateTime, default=datetime.utcnow)  # Дата регистрации
+    registration_date = Column(DateTime, default=func.current_timestamp())  # Дата регистрации
     deactivated_at = Column(DateTime, nullable=True)  # Дата деактивации (если участник вышел)
-    created_at = Column(DateTime, default=datetime.utcnow)  # Дата создания записи
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Дата обновления
+    created_at = Column(DateTime, default=func.current_timestamp())  # Дата создания записи
+    updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())  # Дата обновления
     
 # >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "participants" <<<
 
@@ -142,10 +227,10 @@ class SyncSettings(Base):
     
     __tablename__ = "sync_settings"
     
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     key = Column(String, unique=True, index=True)  # Ключ настройки (например, "last_sync_time")
     value = Column(String)  # Значение настройки (храним как строку, парсим при использовании)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Дата обновления
+    updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())  # Дата обновления
     
 # >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "sync_settings" <<<
 
@@ -155,7 +240,7 @@ class BonusSettings(Base):
     
     __tablename__ = "bonus_settings"
     
-    id = Column(Integer, primary_key=True, index=True, default=1)  # Всегда одна запись с id=1
+    id = Column(Integer, primary_key=True, default=1)  # Всегда одна запись с id=1
     max_levels = Column(Integer, default=3)  # Максимальное количество уровней (1-5)
     level_0_percent = Column(Float, default=0.0)  # Процент бонуса для уровня 0 (покупки самого участника)
     level_1_percent = Column(Float, default=5.0)  # Процент бонуса для уровня 1
@@ -163,7 +248,7 @@ class BonusSettings(Base):
     level_3_percent = Column(Float, default=1.0)  # Процент бонуса для уровня 3
     level_4_percent = Column(Float, nullable=True)  # Процент бонуса для уровня 4
     level_5_percent = Column(Float, nullable=True)  # Процент бонуса для уровня 5
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Дата обновления
+    updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())  # Дата обновления
     
 # >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "bonus_settings" <<<
 
@@ -172,8 +257,22 @@ class BonusTransaction(Base):
     """Модель для хранения начислений бонусов."""
     
     __tablename__ = "bonus_transactions"
-    
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    __table_args__ = (
+        # Составные индексы под выборки бонусов: баланс пользователя (referrer_ozon_id + status)
+        # и статистика по уровням (referrer_ozon_id + level, referral_ozon_id + level)
+        Index("ix_bonus_transactions_referrer_status", "referrer_ozon_id", "status"),
+        Index("ix_bonus_transactions_referrer_level", "referrer_ozon_id", "level"),
+        Index("ix_bonus_transactions_referral_level", "referral_ozon_id", "level"),
+        # Возвраты по заказу (posting_number + status) и разморозка бонусов (status + available_at)
+        Index("ix_bonus_transactions_posting_status", "posting_number", "status"),
+        Index("ix_bonus_transactions_status_available", "status", "available_at"),
+        # Начисления реферера за день (referrer_ozon_id + диапазон created_at)
+        Index("ix_bonus_transactions_referrer_created", "referrer_ozon_id", "created_at"),
+        # За заказ на каждом уровне начисляется не больше одного бонуса (INSERT OR IGNORE при начислении)
+        Index("ix_bonus_transactions_posting_level", "posting_number", "level", unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
     referrer_ozon_id = Column(String, index=True)  # Ozon ID реферера (кому начислили)
     referral_ozon_id = Column(String, index=True)  # Ozon ID реферала (чья покупка)
     posting_number = Column(String, index=True)  # ID заказа (чтобы избежать двойного начисления)
@@ -181,7 +280,7 @@ class BonusTransaction(Base):
     bonus_percentage = Column(Float)  # Процент бонуса
     bonus_amount = Column(Float)  # Сумма бонуса
     level = Column(Integer)  # Уровень реферала (1, 2 или 3)
-    created_at = Column(DateTime, default=datetime.utcnow)  # Дата начисления
+    created_at = Column(DateTime, default=func.current_timestamp())  # Дата начисления
     
     # Поля для управления доступностью к выводу
     available_at = Column(DateTime, nullable=True)  # Дата, когда бонус станет доступным (created_at + 14 дней)
@@ -199,10 +298,10 @@ class WithdrawalSettings(Base):
     
     __tablename__ = "withdrawal_settings"
     
-    id = Column(Integer, primary_key=True, index=True, default=1)  # Всегда одна запись с id=1
+    id = Column(Integer, primary_key=True, default=1)  # Всегда одна запись с id=1
     min_withdrawal_amount = Column(Float, default=100.0)  # Минимальная сумма вывода
     days_between_withdrawals = Column(Integer, nullable=True)  # Через сколько дней можно подать новую заявку (null = без ограничений)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Дата обновления
+    updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())  # Дата обновления
     
 # >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "withdrawal_settings" <<<
 
@@ -211,15 +310,22 @@ class WithdrawalRequest(Base):
     """Модель для хранения заявок на вывод бонусов."""
     
     __tablename__ = "withdrawal_requests"
-    
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    __table_args__ = (
+        # У пользователя не больше одной активной заявки ("processing"/"approved") - частичный уникальный индекс
+        Index(
+            "ix_withdrawal_requests_one_active", "user_ozon_id", unique=True,
+            sqlite_where=text("status IN ('processing', 'approved')")
+        ),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
     user_ozon_id = Column(String, index=True)  # Ozon ID пользователя
     user_telegram_id = Column(String, index=True)  # Telegram ID пользователя
     amount = Column(Float)  # Сумма вывода
     status = Column(String)  # "processing", "approved", "rejected", "completed"
     admin_comment = Column(String, nullable=True)  # Причина отклонения/комментарий
     processed_by = Column(String, nullable=True)  # Telegram ID админа, обработавшего заявку
-    created_at = Column(DateTime, default=datetime.utcnow)  # Дата создания заявки
+    created_at = Column(DateTime, default=func.current_timestamp())  # Дата создания заявки
     processed_at = Column(DateTime, nullable=True)  # Дата одобрения/отклонения
     completed_at = Column(DateTime, nullable=True)  # Дата завершения выплаты (статус "completed")
     
@@ -231,14 +337,27 @@ class WithdrawalTransaction(Base):
     
     __tablename__ = "withdrawal_transactions"
     
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     withdrawal_request_id = Column(Integer, index=True)  # ID заявки на вывод
     bonus_transaction_id = Column(Integer, index=True)  # ID транзакции бонуса
     amount = Column(Float)  # Сумма списанного бонуса
-    created_at = Column(DateTime, default=datetime.utcnow)  # Дата списания
+    created_at = Column(DateTime, default=func.current_timestamp())  # Дата списания
     
 # >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "withdrawal_transactions" <<<
 
+# >>> НАЧАЛО БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "sync_stats" <<<
+class SyncStat(Base):
+    """Модель для хранения длительности автоматических синхронизаций (для подбора времени запуска)."""
+    
+    __tablename__ = "sync_stats"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    started_at = Column(DateTime, default=func.current_timestamp())  # Время начала синхронизации
+    slot = Column(Integer, index=True, nullable=True)  # Индекс времени в SYNC_TIMES (None - синхронизация вне расписания)
+    seconds = Column(Float)  # Длительность синхронизации в секундах
+    
+# >>> КОНЕЦ БЛОКА: ОПРЕДЕЛЕНИЕ МОДЕЛИ ТАБЛИЦЫ "sync_stats" <<<
+
 # >>> НАЧАЛО БЛОКА: ФУНКЦИИ ВЗАИМОДЕЙСТВИЯ С БД <<<
 def migrate_bonus_settings():
     """Миграция: добавляет колонку level_0_percent в таблицу bonus_settings если её нет."""
@@ -267,7 +386,7 @@ def migrate_bonus_settings():
         raise
 
 def migrate_participants():
-    """Миграция: добавляет колонки is_active и deactivated_at в таблицу participants если их нет."""
+    """Миграция: добавляет колонки is_active, deactivated_at и username_norm в таблицу participants если их нет."""
     import sqlite3
     try:
         conn = sqlite3.connect(DB_FILE)
@@ -280,7 +399,8 @@ def migrate_participants():
         # Добавляем новые поля, если их нет
         new_fields = [
             ("is_active", "INTEGER DEFAULT 1"),
-            ("deactivated_at", "DATETIME")
+            ("deactivated_at", "DATETIME"),
+            ("username_norm", "TEXT")
         ]
         
         for field_name, field_type in new_fields:
@@ -291,9 +411,17 @@ def migrate_participants():
                 # Для существующих записей устанавливаем значения по умолчанию
                 if field_name == "is_active":
                     cursor.execute("UPDATE participants SET is_active = 1 WHERE is_active IS NULL")
+                if field_name == "username_norm":
+                    cursor.execute("""
+                        UPDATE participants SET username_norm = lower(ltrim(trim(username), '@'))
+                        WHERE username IS NOT NULL AND ltrim(trim(username), '@') != ''
+                    """)
             else:
                 print(f"ℹ️ Миграция: колонка {field_name} уже существует")
         
+        # Индекс для поиска по нормализованному username
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_participants_username_norm ON participants (username_norm)")
+        
         conn.commit()
         print("✅ Миграция participants завершена")
         
@@ -383,10 +511,239 @@ def migrate_bonus_transactions_status():
         print(f"❌ Ошибка миграции bonus_transactions status: {e}")
         raise
 
-def create_database():
-    """Создает базу данных и все определенные таблицы."""
-    Base.metadata.create_all(bind=engine)
-    print(f"База данных успешно создана или обновлена: {DB_FILE}")
+def migrate_orders_indexes():
+    """Миграция: создает составной индекс (buyer_id, status, created_at) в таблице orders если его нет."""
+    import sqlite3
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_orders_buyer_status_created "
+            "ON orders (buyer_id, status, created_at)"
+        )
+        conn.commit()
+        print("✅ Миграция: индекс ix_orders_buyer_status_created проверен")
+        
+        conn.close()
+    except Exception as e:
+        print(f"❌ Ошибка миграции индексов orders: {e}")
+        raise
+
+def migrate_bonus_transactions_indexes():
+    """Миграция: создает составные индексы в таблице bonus_transactions если их нет."""
+    import sqlite3
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        
+        indexes = {
+            "ix_bonus_transactions_referrer_status": "referrer_ozon_id, status",
+            "ix_bonus_transactions_referrer_level": "referrer_ozon_id, level",
+            "ix_bonus_transactions_referral_level": "referral_ozon_id, level",
+            "ix_bonus_transactions_posting_status": "posting_number, status",
+            "ix_bonus_transactions_status_available": "status, available_at",
+            "ix_bonus_transactions_referrer_created": "referrer_ozon_id, created_at",
+        }
+        for index_name, columns in indexes.items():
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON bonus_transactions ({columns})")
+        conn.commit()
+        print("✅ Миграция: составные индексы bonus_transactions проверены")
+        
+        conn.close()
+    except Exception as e:
+        print(f"❌ Ошибка миграции индексов bonus_transactions: {e}")
+        raise
+
+def migrate_bonus_transactions_unique():
+    """Миграция: создает уникальный индекс (posting_number, level) в таблице bonus_transactions если его нет.
+    
+    Если в таблице уже есть повторные начисления за один заказ и уровень, индекс не создается
+    (записи о начислениях не удаляются автоматически) - выводится предупреждение.
+    
+    Returns:
+        bool: True если индекс есть, False если не создан из-за повторных начислений
+    """
+    import sqlite3
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM bonus_transactions
+                WHERE posting_number IS NOT NULL
+                GROUP BY posting_number, level
+                HAVING COUNT(*) > 1
+            )
+        """)
+        duplicates = cursor.fetchone()[0]
+        
+        if duplicates:
+            print(f"❌ Миграция: найдено повторных начислений (заказ + уровень): {duplicates}, "
+                  f"уникальный индекс ix_bonus_transactions_posting_level не создан")
+        else:
+            cursor.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_bonus_transactions_posting_level "
+                "ON bonus_transactions (posting_number, level)"
+            )
+            conn.commit()
+            print("✅ Миграция: уникальный индекс ix_bonus_transactions_posting_level проверен")
+        
+        conn.close()
+        return not duplicates
+    except Exception as e:
+        print(f"❌ Ошибка миграции уникального индекса bonus_transactions: {e}")
+        raise
+
+def migrate_withdrawal_requests_one_active():
+    """Миграция: создает частичный уникальный индекс "одна активная заявка на пользователя" в withdrawal_requests.
+    
+    Если у кого-то уже несколько активных заявок, индекс не создается (заявки не меняются автоматически) -
+    выводится предупреждение.
+    
+    Returns:
+        bool: True если индекс есть, False если не создан из-за нескольких активных заявок
+    """
+    import sqlite3
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM withdrawal_requests
+                WHERE status IN ('processing', 'approved')
+                GROUP BY user_ozon_id
+                HAVING COUNT(*) > 1
+            )
+        """)
+        duplicates = cursor.fetchone()[0]
+        
+        if duplicates:
+            print(f"❌ Миграция: найдено пользователей с несколькими активными заявками: {duplicates}, "
+                  f"уникальный индекс ix_withdrawal_requests_one_active не создан")
+        else:
+            cursor.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_withdrawal_requests_one_active "
+                "ON withdrawal_requests (user_ozon_id) WHERE status IN ('processing', 'approved')"
+            )
+            conn.commit()
+            print("✅ Миграция: уникальный индекс ix_withdrawal_requests_one_active проверен")
+        
+        conn.close()
+        return not duplicates
+    except Exception as e:
+        print(f"❌ Ошибка миграции уникального индекса withdrawal_requests: {e}")
+        raise
+
+def migrate_customers_total_spent():
+    """Миграция: переводит customers.total_spent из строки в число (REAL), если колонка еще строковая."""
+    import sqlite3
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        conn.isolation_level = None  # Транзакцией управляем вручную (BEGIN/COMMIT)
+        cursor = conn.cursor()
+        
+        cursor.execute("PRAGMA table_info(customers)")
+        column_types = {row[1]: (row[2] or "").upper() for row in cursor.fetchall()}
+        
+        if column_types.get("total_spent") in (None, "REAL", "FLOAT", "DOUBLE"):
+            print("ℹ️ Миграция: колонка total_spent уже числовая")
+        else:
+            # Пересоздаем колонку с типом REAL в одной транзакции
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute("ALTER TABLE customers ADD COLUMN total_spent_num REAL DEFAULT 0")
+                cursor.execute("UPDATE customers SET total_spent_num = COALESCE(CAST(total_spent AS REAL), 0)")
+                cursor.execute("ALTER TABLE customers DROP COLUMN total_spent")
+                cursor.execute("ALTER TABLE customers RENAME COLUMN total_spent_num TO total_spent")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            print("✅ Миграция: колонка total_spent в customers переведена в REAL")
+        
+        conn.close()
+    except Exception as e:
+        print(f"❌ Ошибка миграции customers total_spent: {e}")
+        raise
+
+def migrate_drop_primary_key_indexes():
+    """Миграция: удаляет индексы ix_<таблица>_id, созданные по index=True на первичных ключах.
+    
+    INTEGER PRIMARY KEY в SQLite - это rowid, он уже упорядочен, и отдельный индекс
+    только добавляет запись в еще одно B-дерево при каждой вставке.
+    """
+    import sqlite3
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        
+        for table in Base.metadata.tables.values():
+            cursor.execute(f"DROP INDEX IF EXISTS ix_{table.name}_id")
+        
+        conn.commit()
+        print("✅ Миграция: лишние индексы по первичным ключам удалены")
+        
+        conn.close()
+    except Exception as e:
+        print(f"❌ Ошибка миграции индексов первичных ключей: {e}")
+        raise
+
+def migrate_orders_buyer_id():
+    """Миграция: заполняет пустые orders.buyer_id из posting_number (как buyer_id_from_posting_number)."""
+    import sqlite3
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            UPDATE orders
+            SET buyer_id = CASE
+                WHEN instr(posting_number, '-') > 0 THEN substr(posting_number, 1, instr(posting_number, '-') - 1)
+                ELSE posting_number
+            END
+            WHERE (buyer_id IS NULL OR TRIM(buyer_id) = '') AND posting_number IS NOT NULL AND posting_number != ''
+        """)
+        conn.commit()
+        print(f"✅ Миграция: заполнено пустых buyer_id в orders: {cursor.rowcount}")
+        
+        conn.close()
+    except Exception as e:
+        print(f"❌ Ошибка миграции orders buyer_id: {e}")
+        raise
+
+# Версия схемы БД, хранится в PRAGMA user_version. Увеличивать при добавлении новой migrate_*
+# (и добавлять ее вызов в _run_migrations), чтобы миграции выполнились на существующих базах.
+SCHEMA_VERSION = 13
+
+def get_schema_version() -> int:
+    """Возвращает версию схемы БД (PRAGMA user_version)."""
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+
+def set_schema_version(version: int):
+    """Записывает версию схемы БД в PRAGMA user_version."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+def _get_existing_tables() -> set:
+    """Возвращает имена таблиц, уже существующих в файле БД (одним запросом к sqlite_master)."""
+    with engine.connect() as conn:
+        return {
+            name for (name,) in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+
+def _run_migrations() -> bool:
+    """Выполняет все миграции (каждая идемпотентна и сама проверяет, нужна ли она).
+    
+    Returns:
+        bool: True если все миграции завершены, False если какую-то нельзя применить
+              без ручного исправления данных (тогда версия схемы не повышается)
+    """
     # Выполняем миграцию для добавления level_0_percent
     migrate_bonus_settings()
     # Выполняем миграцию для добавления полей is_active и deactivated_at в participants
@@ -395,6 +752,48 @@ def create_database():
     migrate_bonus_transactions()
     # Выполняем миграцию для добавления поля status в bonus_transactions
     migrate_bonus_transactions_status()
+    # Выполняем миграцию для добавления составного индекса в orders
+    migrate_orders_indexes()
+    # Выполняем миграцию типа customers.total_spent (строка -> число)
+    migrate_customers_total_spent()
+    # Удаляем лишние индексы по первичным ключам
+    migrate_drop_primary_key_indexes()
+    # Заполняем пустые buyer_id в orders
+    migrate_orders_buyer_id()
+    # Выполняем миграцию для добавления составных индексов в bonus_transactions
+    migrate_bonus_transactions_indexes()
+    # Уникальный индекс (posting_number, level) против повторного начисления бонусов
+    completed = migrate_bonus_transactions_unique()
+    # Частичный уникальный индекс: не больше одной активной заявки на вывод у пользователя
+    completed = migrate_withdrawal_requests_one_active() and completed
+    return completed
+
+def create_database():
+    """Создает базу данных и все определенные таблицы."""
+    # Новая база создается сразу по актуальным моделям и в миграциях не нуждается
+    existing_tables = _get_existing_tables()
+    is_new_database = not existing_tables
+    
+    # create_all вызываем только для отсутствующих таблиц: если все таблицы на месте,
+    # проверка DDL каждой таблицы при каждом запуске не нужна
+    missing_tables = [table for name, table in Base.metadata.tables.items() if name not in existing_tables]
+    if missing_tables:
+        Base.metadata.create_all(bind=engine, tables=missing_tables)
+    print(f"База данных успешно создана или обновлена: {DB_FILE}")
+    
+    # Миграции выполняются только если схема отстает от SCHEMA_VERSION,
+    # а не проверяются через PRAGMA table_info при каждом запуске
+    schema_version = get_schema_version()
+    if is_new_database:
+        set_schema_version(SCHEMA_VERSION)
+    elif schema_version < SCHEMA_VERSION:
+        print(f"ℹ️ Миграция схемы БД: версия {schema_version} -> {SCHEMA_VERSION}")
+        if _run_migrations():
+            set_schema_version(SCHEMA_VERSION)
+        else:
+            # Версию не повышаем: миграции повторятся при следующем запуске, пока данные не исправлены
+            print(f"❌ Миграция схемы БД не завершена, версия остается {schema_version}")
+    
     # Сбрасываем кэш настроек после миграции
     clear_bonus_settings_cache()
     # Инициализируем дефолтные настройки бонусов
@@ -404,6 +803,16 @@ def create_database():
     # Очищаем кэш настроек вывода, чтобы загрузить их заново с правильным типом
     clear_withdrawal_settings_cache()
 
+def begin_immediate(db: Session):
+    """Начинает транзакцию сессии с BEGIN IMMEDIATE (вызывать до первого запроса в транзакции).
+    
+    Для транзакций, которые читают и пишут вперемешку: блокировка записи берется сразу,
+    и конкурирующие писатели ждут ее через busy_timeout, а не падают с "database is locked"
+    посреди транзакции. Драйвер sqlite3 сам BEGIN перед SELECT не выполняет, поэтому
+    явный BEGIN здесь не конфликтует с его неявными транзакциями; COMMIT/ROLLBACK - как обычно.
+    """
+    db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+
 def get_db():
     """Генерирует сессию для взаимодействия с БД."""
     db = SessionLocal()
@@ -414,103 +823,228 @@ def get_db():
 
 def order_exists(db: Session, posting_number: str) -> bool:
     """Проверяет, существует ли заказ в базе данных по номеру отправления."""
-    return db.query(Order).filter(Order.posting_number == posting_number).first() is not None
+    # SELECT EXISTS(...) вместо загрузки всей строки заказа
+    return db.query(exists().where(Order.posting_number == posting_number)).scalar()
 
 def customer_exists(db: Session, buyer_id: str) -> bool:
     """Проверяет, существует ли клиент в базе данных по buyer_id."""
-    return db.query(Customer).filter(Customer.buyer_id == buyer_id).first() is not None
+    return db.query(exists().where(Customer.buyer_id == buyer_id)).scalar()
 
 def get_customer(db: Session, buyer_id: str) -> Customer | None:
     """Получает клиента по buyer_id."""
     return db.query(Customer).filter(Customer.buyer_id == buyer_id).first()
 
-def create_or_update_customer(db: Session, customer_data: dict) -> Customer:
-    """Создает нового клиента или обновляет существующего."""
-    buyer_id = customer_data.get("buyer_id")
-    if not buyer_id:
-        raise ValueError("buyer_id обязателен для создания/обновления клиента")
+def get_orders_by_posting_numbers(db: Session, posting_numbers) -> dict[str, Order]:
+    """Получает заказы по списку posting_number одним запросом на пачку (IN-список).
     
-    customer = get_customer(db, buyer_id)
+    Returns:
+        dict: {posting_number: Order} только для найденных заказов
+    """
+    posting_numbers = list(posting_numbers)
+    orders = {}
+    for i in range(0, len(posting_numbers), IN_QUERY_CHUNK_SIZE):
+        chunk = posting_numbers[i:i + IN_QUERY_CHUNK_SIZE]
+        for order in db.query(Order).filter(Order.posting_number.in_(chunk)).all():
+            orders[order.posting_number] = order
+    return orders
+
+# Поля клиента, которые upsert_customers перезаписывает новым значением (если оно не None)
+_CUSTOMER_UPSERT_FIELDS = (
+    "name", "phone", "email", "address", "delivery_region", "delivery_city",
+    "cluster_to", "client_segment", "is_legal_entity", "payment_method",
+)
+
+def upsert_customers(db: Session, customers: list[dict]) -> int:
+    """Создает новых клиентов и обновляет существующих пачкой: один INSERT ... ON CONFLICT(buyer_id) DO UPDATE
+    (executemany) вместо загрузки клиентов в ORM и изменения каждого объекта.
     
-    if customer:
-        # Обновляем существующего клиента
-        for key, value in customer_data.items():
-            if hasattr(customer, key) and value is not None:
-                setattr(customer, key, value)
-        customer.updated_at = datetime.utcnow()
-    else:
-        # Создаем нового клиента
-        customer = Customer(**customer_data)
-        db.add(customer)
+    Args:
+        db: Сессия БД (коммит - в вызывающей функции)
+        customers: Словари с полями клиента (buyer_id обязателен) и статистикой новых заказов:
+                   total_orders и total_spent прибавляются к сохраненным значениям,
+                   first_order_date / last_order_date расширяют период заказов клиента,
+                   остальные поля перезаписываются, если значение не None
+        
+    Returns:
+        int: Количество новых клиентов
+    """
+    if not customers:
+        return 0
     
-    return customer
+    buyer_ids = list(dict.fromkeys(str(customer["buyer_id"]) for customer in customers))
+    if not all(buyer_ids):
+        raise ValueError("buyer_id обязателен для создания/обновления клиента")
+    
+    # Для подсчета новых клиентов достаточно buyer_id существующих (без загрузки строк целиком)
+    existing_buyer_ids = set()
+    for i in range(0, len(buyer_ids), IN_QUERY_CHUNK_SIZE):
+        existing_buyer_ids.update(
+            buyer_id for (buyer_id,) in db.query(Customer.buyer_id).filter(
+                Customer.buyer_id.in_(buyer_ids[i:i + IN_QUERY_CHUNK_SIZE])
+            )
+        )
+    
+    # У всех строк executemany одинаковый набор ключей
+    now = utcnow()
+    rows = [
+        {
+            "buyer_id": str(customer["buyer_id"]),
+            **{field: customer.get(field) for field in _CUSTOMER_UPSERT_FIELDS},
+            "total_orders": customer.get("total_orders") or 0,
+            "total_spent": customer.get("total_spent") or 0.0,
+            "first_order_date": customer.get("first_order_date"),
+            "last_order_date": customer.get("last_order_date"),
+            "updated_at": now,
+        }
+        for customer in customers
+    ]
+    
+    table = Customer.__table__
+    stmt = sqlite_insert(table)
+    excluded = stmt.excluded
+    update_values = {
+        # Как и раньше при обновлении через ORM, None не затирает сохраненное значение
+        field: func.coalesce(excluded[field], table.c[field]) for field in _CUSTOMER_UPSERT_FIELDS
+    }
+    update_values.update(
+        total_orders=func.coalesce(table.c.total_orders, 0) + excluded.total_orders,
+        total_spent=func.coalesce(table.c.total_spent, 0.0) + excluded.total_spent,
+        first_order_date=case(
+            (excluded.first_order_date.is_(None), table.c.first_order_date),
+            (table.c.first_order_date.is_(None), excluded.first_order_date),
+            else_=func.min(table.c.first_order_date, excluded.first_order_date),
+        ),
+        last_order_date=case(
+            (excluded.last_order_date.is_(None), table.c.last_order_date),
+            (table.c.last_order_date.is_(None), excluded.last_order_date),
+            else_=func.max(table.c.last_order_date, excluded.last_order_date),
+        ),
+        updated_at=excluded.updated_at,
+    )
+    db.execute(stmt.on_conflict_do_update(index_elements=[table.c.buyer_id], set_=update_values), rows)
+    
+    return len(set(buyer_ids) - existing_buyer_ids)
 
 # >>> ФУНКЦИИ ДЛЯ РАБОТЫ С УЧАСТНИКАМИ РЕФЕРАЛЬНОЙ ПРОГРАММЫ <<<
+# Колонки, нужные find_participant_by_* (выбираем только их вместо загрузки ORM-объекта целиком)
+_PARTICIPANT_LOOKUP_COLUMNS = (
+    Participant.ozon_id,
+    Participant.name,
+    Participant.username,
+    Participant.referrer_id,
+    Participant.registration_date,
+    Participant.telegram_id,
+)
+
+def _participant_row_to_dict(row) -> dict:
+    """Преобразует строку с _PARTICIPANT_LOOKUP_COLUMNS в словарь в формате совместимом с Google Sheets."""
+    return {
+        "ID участника": row.ozon_id,
+        "Имя / ник": row.name or "",
+        "Телеграм @": row.username or "",
+        "Ozon ID": row.ozon_id,
+        "ID пригласившего": row.referrer_id or "",
+        "Дата регистрации": row.registration_date.strftime("%Y-%m-%d") if row.registration_date else "",
+        "Telegram ID": row.telegram_id,
+    }
+
+# Кэш find_participant_by_telegram_id / find_participant_by_ozon_id: эти функции вызываются
+# почти на каждое обновление от Telegram, а таблица участников меняется редко.
+# Ключ - ("tg", telegram_id) или ("ozon", ozon_id), значение - (время истечения, результат или None).
+# Сбрасывается целиком при любом изменении участника (create_participant, deactivate_participant).
+# Поиск вызывается из нескольких потоков (asyncio.to_thread), поэтому чтение, запись и сброс кэша
+# идут под одной блокировкой. Счетчик сбросов не дает записать в кэш результат запроса (в том числе
+# "не найден"), выполненного до сброса: иначе только что созданный участник не находился бы до истечения TTL.
+PARTICIPANT_CACHE_TTL = 60  # секунд
+PARTICIPANT_CACHE_MAX_SIZE = 10_000
+_participant_cache = {}
+_participant_cache_generation = 0
+_participant_cache_lock = threading.Lock()
+
+def clear_participant_cache():
+    """Сбросить кэш поиска участников (использовать после изменения участников)."""
+    global _participant_cache_generation
+    with _participant_cache_lock:
+        _participant_cache.clear()
+        _participant_cache_generation += 1
+
+def _get_cached_participant(key: tuple) -> tuple[bool, dict | None, int]:
+    """Возвращает (найдено в кэше, копия результата, номер сброса кэша для _cache_participant)."""
+    with _participant_cache_lock:
+        entry = _participant_cache.get(key)
+        if entry is None:
+            return False, None, _participant_cache_generation
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del _participant_cache[key]
+            return False, None, _participant_cache_generation
+        return True, dict(result) if result is not None else None, _participant_cache_generation
+
+def _cache_participant(key: tuple, result: dict | None, generation: int):
+    """Сохраняет результат поиска участника в кэш (при переполнении вытесняется самая старая запись).
+    
+    Результат не сохраняется, если кэш сбрасывался после чтения generation из _get_cached_participant.
+    """
+    with _participant_cache_lock:
+        if generation != _participant_cache_generation:
+            return
+        if len(_participant_cache) >= PARTICIPANT_CACHE_MAX_SIZE:
+            del _participant_cache[next(iter(_participant_cache))]
+        _participant_cache[key] = (time.monotonic() + PARTICIPANT_CACHE_TTL, result)
+
 def find_participant_by_ozon_id(ozon_id: str) -> dict | None:
     """Ищет участника по его Ozon ID. Возвращает словарь в формате совместимом с Google Sheets."""
-    db = SessionLocal()
-    try:
-        participant = db.query(Participant).filter(Participant.ozon_id == str(ozon_id)).first()
-        if participant:
-            return {
-                "ID участника": participant.ozon_id,
-                "Имя / ник": participant.name or "",
-                "Телеграм @": participant.username or "",
-                "Ozon ID": participant.ozon_id,
-                "ID пригласившего": participant.referrer_id or "",
-                "Дата регистрации": participant.registration_date.strftime("%Y-%m-%d") if participant.registration_date else "",
-                "Telegram ID": participant.telegram_id,
-            }
-        return None
-    finally:
-        db.close()
+    cache_key = ("ozon", str(ozon_id))
+    found, cached, generation = _get_cached_participant(cache_key)
+    if found:
+        return cached
+    
+    # Точечный запрос через Core: без сессии, unit of work и identity map
+    with engine.connect() as conn:
+        participant = conn.execute(
+            select(*_PARTICIPANT_LOOKUP_COLUMNS).where(Participant.ozon_id == str(ozon_id))
+        ).first()
+    result = _participant_row_to_dict(participant) if participant else None
+    
+    _cache_participant(cache_key, result, generation)
+    return dict(result) if result is not None else None
 
 def find_participant_by_telegram_id(tg_id: int) -> dict | None:
     """Ищет участника по его Telegram ID. Возвращает словарь в формате совместимом с Google Sheets."""
-    db = SessionLocal()
-    try:
-        participant = db.query(Participant).filter(Participant.telegram_id == str(tg_id)).first()
-        if participant:
-            return {
-                "ID участника": participant.ozon_id,
-                "Имя / ник": participant.name or "",
-                "Телеграм @": participant.username or "",
-                "Ozon ID": participant.ozon_id,
-                "ID пригласившего": participant.referrer_id or "",
-                "Дата регистрации": participant.registration_date.strftime("%Y-%m-%d") if participant.registration_date else "",
-                "Telegram ID": participant.telegram_id,
-            }
+    cache_key = ("tg", str(tg_id))
+    found, cached, generation = _get_cached_participant(cache_key)
+    if found:
+        return cached
+    
+    # Точечный запрос через Core: без сессии, unit of work и identity map
+    with engine.connect() as conn:
+        participant = conn.execute(
+            select(*_PARTICIPANT_LOOKUP_COLUMNS).where(Participant.telegram_id == str(tg_id))
+        ).first()
+    result = _participant_row_to_dict(participant) if participant else None
+    
+    _cache_participant(cache_key, result, generation)
+    return dict(result) if result is not None else None
+
+def normalize_username(username: str | None) -> str | None:
+    """Приводит Telegram username к виду для поиска: без @ и в нижнем регистре (username в Telegram регистронезависим)."""
+    if not username:
         return None
-    finally:
-        db.close()
+    username_clean = username.strip().lstrip('@').lower()
+    return username_clean or None
 
 def find_participant_by_username(username: str) -> dict | None:
     """Ищет участника по его Telegram username. Возвращает словарь в формате совместимом с Google Sheets."""
-    db = SessionLocal()
-    try:
-        # Убираем @ если есть
-        username_clean = username.lstrip('@')
-        username_with_at = f"@{username_clean}"
-        
-        # Ищем по обоим вариантам
-        participant = db.query(Participant).filter(
-            (Participant.username == username_clean) | 
-            (Participant.username == username_with_at)
-        ).first()
-        
-        if participant:
-            return {
-                "ID участника": participant.ozon_id,
-                "Имя / ник": participant.name or "",
-                "Телеграм @": participant.username or "",
-                "Ozon ID": participant.ozon_id,
-                "ID пригласившего": participant.referrer_id or "",
-                "Дата регистрации": participant.registration_date.strftime("%Y-%m-%d") if participant.registration_date else "",
-                "Telegram ID": participant.telegram_id,
-            }
+    username_norm = normalize_username(username)
+    if not username_norm:
         return None
-    finally:
-        db.close()
+    
+    # Одно равенство по индексированной нормализованной колонке (запрос через Core, без сессии)
+    with engine.connect() as conn:
+        participant = conn.execute(
+            select(*_PARTICIPANT_LOOKUP_COLUMNS).where(Participant.username_norm == username_norm)
+        ).first()
+    return _participant_row_to_dict(participant) if participant else None
 
 def create_participant(
     tg_id: int,
@@ -549,17 +1083,19 @@ def create_participant(
                 # Обновляем данные участника при возврате
                 existing.is_active = 1
                 existing.deactivated_at = None
-                existing.registration_date = datetime.utcnow()  # Новая дата регистрации
+                existing.registration_date = utcnow()  # Новая дата регистрации
                 existing.name = name
                 existing.username = tg_username
+                existing.username_norm = normalize_username(username)
                 existing.language = language
-                existing.updated_at = datetime.utcnow()
+                existing.updated_at = utcnow()
                 
                 # Если указан новый referrer_id, обновляем (но обычно сохраняем старый)
                 if referrer_id:
                     existing.referrer_id = str(referrer_id)
                 
                 db.commit()
+                clear_participant_cache()
                 
                 return {
                     "ID участника": existing.ozon_id,
@@ -580,14 +1116,16 @@ def create_participant(
             telegram_id=str(tg_id),
             name=name,
             username=tg_username,
+            username_norm=normalize_username(username),
             referrer_id=str(referrer_id) if referrer_id else None,
             language=language,
-            registration_date=datetime.utcnow(),
+            registration_date=utcnow(),
             is_active=1,  # Новый участник всегда активен
         )
         
         db.add(participant)
         db.commit()
+        clear_participant_cache()
         
         return {
             "ID участника": participant.ozon_id,
@@ -613,9 +1151,17 @@ def get_all_participants() -> list:
     """
     db = SessionLocal()
     try:
-        participants = db.query(Participant).filter(
+        # Только нужные колонки и потоково (пачками по 1000 строк), без создания ORM-объектов участников
+        participants = db.query(
+            Participant.ozon_id,
+            Participant.name,
+            Participant.username,
+            Participant.referrer_id,
+            Participant.registration_date,
+            Participant.telegram_id,
+        ).filter(
             Participant.is_active == 1
-        ).all()
+        ).yield_per(1000)
         result = []
         for participant in participants:
             result.append({
@@ -676,10 +1222,11 @@ def deactivate_participant(telegram_id: int) -> dict:
         
         # Деактивируем участника (не удаляем!)
         participant.is_active = 0
-        participant.deactivated_at = datetime.utcnow()
+        participant.deactivated_at = utcnow()
         
         # Сохраняем изменения
         db.commit()
+        clear_participant_cache()
         
         return {
             "success": True,
@@ -703,42 +1250,31 @@ def get_user_orders_stats(ozon_id: str) -> dict:
     Returns:
         dict: {"delivered_count": int, "total_sum": float}
     """
-    db = SessionLocal()
-    try:
-        # Находим участника и получаем дату регистрации
-        participant = db.query(Participant).filter(
-            Participant.ozon_id == str(ozon_id)
-        ).first()
-        
-        # Подсчитываем доставленные заказы и их сумму
-        query = db.query(Order).filter(
-            Order.buyer_id == str(ozon_id),
-            Order.status == "delivered"
-        )
-        
-        # Фильтруем по дате регистрации, если она есть
-        if participant and participant.registration_date:
-            query = query.filter(Order.created_at >= participant.registration_date)
-        
-        orders = query.all()
-        
-        delivered_count = len(orders)
-        total_sum = 0.0
-        
-        for order in orders:
-            try:
-                if order.price_amount:
-                    price = float(order.price_amount)
-                    total_sum += price
-            except (ValueError, TypeError):
-                continue
-        
-        return {
-            "delivered_count": delivered_count,
-            "total_sum": total_sum
-        }
-    finally:
-        db.close()
+    # Дата регистрации участника подставляется скалярным подзапросом, поэтому и она,
+    # и агрегаты получаются за один запрос (если даты нет, фильтр по дате не применяется)
+    registration_date = select(Participant.registration_date).where(
+        Participant.ozon_id == str(ozon_id)
+    ).limit(1).scalar_subquery()
+    
+    # Подсчитываем доставленные заказы и их сумму агрегатами на стороне БД
+    # (price_amount хранится строкой, поэтому приводим к REAL; нечисловые значения дают 0)
+    stmt = select(
+        func.count(Order.id),
+        func.coalesce(func.sum(cast(Order.price_amount, Float)), 0.0)
+    ).where(
+        Order.buyer_id == str(ozon_id),
+        Order.status == "delivered",
+        or_(registration_date.is_(None), Order.created_at >= registration_date)
+    )
+    
+    # Запрос только читает агрегаты, поэтому выполняется через Core без ORM-сессии
+    with engine.connect() as conn:
+        delivered_count, total_sum = conn.execute(stmt).one()
+    
+    return {
+        "delivered_count": delivered_count,
+        "total_sum": float(total_sum)
+    }
 
 def get_user_orders_summary(ozon_id: str) -> dict:
     """Получает сводку по заказам пользователя с даты регистрации.
@@ -759,11 +1295,11 @@ def get_user_orders_summary(ozon_id: str) -> dict:
                 }
             }
     """
-    db = SessionLocal()
-    try:
+    # Запросы только читают агрегаты, поэтому выполняются через Core без ORM-сессии
+    with engine.connect() as conn:
         # Находим участника и получаем дату регистрации
-        participant = db.query(Participant).filter(
-            Participant.ozon_id == str(ozon_id)
+        participant = conn.execute(
+            select(Participant.id, Participant.registration_date).where(Participant.ozon_id == str(ozon_id))
         ).first()
         
         if not participant:
@@ -777,42 +1313,41 @@ def get_user_orders_summary(ozon_id: str) -> dict:
         registration_date = participant.registration_date
         
         # Если нет даты регистрации, используем все заказы
-        query = db.query(Order).filter(Order.buyer_id == str(ozon_id))
+        # Группировка по статусам и суммы считаются на стороне БД (GROUP BY status)
+        stmt = select(
+            Order.status,
+            func.count(Order.id),
+            func.coalesce(func.sum(cast(Order.price_amount, Float)), 0.0)
+        ).where(Order.buyer_id == str(ozon_id))
         if registration_date:
-            query = query.filter(Order.created_at >= registration_date)
-        
-        orders = query.all()
+            stmt = stmt.where(Order.created_at >= registration_date)
         
-        # Группируем по статусам и считаем суммы
-        by_status = {}
-        total_sum = 0.0
+        rows = conn.execute(stmt.group_by(Order.status)).all()
+    
+    by_status = {}
+    total_orders = 0
+    total_sum = 0.0
+    
+    for status, count, status_sum in rows:
+        # NULL-статус объединяем с "unknown"
+        status = status or "unknown"
         
-        for order in orders:
-            status = order.status or "unknown"
-            
-            if status not in by_status:
-                by_status[status] = {"count": 0, "sum": 0.0}
-            
-            by_status[status]["count"] += 1
-            
-            try:
-                if order.price_amount:
-                    price = float(order.price_amount)
-                    by_status[status]["sum"] += price
-                    total_sum += price
-            except (ValueError, TypeError):
-                continue
+        if status not in by_status:
+            by_status[status] = {"count": 0, "sum": 0.0}
         
-        return {
-            "total_orders": len(orders),
-            "total_sum": total_sum,
-            "registration_date": registration_date.strftime("%Y-%m-%d") if registration_date else None,
-            "by_status": by_status
-        }
-    finally:
-        db.close()
-
-def get_referrals_by_level(ozon_id: str, max_level: int = None) -> dict:
+        by_status[status]["count"] += count
+        by_status[status]["sum"] += float(status_sum)
+        total_orders += count
+        total_sum += float(status_sum)
+    
+    return {
+        "total_orders": total_orders,
+        "total_sum": total_sum,
+        "registration_date": registration_date.strftime("%Y-%m-%d") if registration_date else None,
+        "by_status": by_status
+    }
+
+def get_referrals_by_level(ozon_id: str, max_level: int = None) -> dict:
     """Получает рефералов пользователя по уровням.
     Возвращает только активных участников.
     
@@ -829,56 +1364,31 @@ def get_referrals_by_level(ozon_id: str, max_level: int = None) -> dict:
         settings = get_bonus_settings()
         max_level = settings.max_levels if settings else 3
     
-    db = SessionLocal()
-    try:
-        referrals_by_level = {}
-        
-        # Уровень 1: прямые рефералы (только активные)
-        level_1 = db.query(Participant).filter(
-            Participant.referrer_id == str(ozon_id),
-            Participant.is_active == 1
+    # Все уровни дерева обходятся одним рекурсивным запросом на стороне SQLite.
+    # Как и раньше, в дерево попадают только активные участники, и потомки
+    # неактивного участника не учитываются (через него рекурсия не продолжается)
+    referrals_by_level = {level: [] for level in range(1, max(max_level, 1) + 1)}
+    
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("""
+                WITH RECURSIVE tree(ozon_id, level) AS (
+                    SELECT ozon_id, 1 FROM participants
+                    WHERE referrer_id = :root AND is_active = 1
+                    UNION ALL
+                    SELECT p.ozon_id, tree.level + 1 FROM participants p
+                    JOIN tree ON p.referrer_id = tree.ozon_id
+                    WHERE p.is_active = 1 AND tree.level < :max_level
+                )
+                SELECT ozon_id, level FROM tree
+            """),
+            {"root": str(ozon_id), "max_level": max_level}
         ).all()
-        referrals_by_level[1] = [p.ozon_id for p in level_1]
-        
-        # Если нужны следующие уровни
-        if max_level > 1:
-            # Уровень 2: рефералы рефералов уровня 1 (только активные)
-            level_2_ids = []
-            for level_1_id in referrals_by_level[1]:
-                level_2_refs = db.query(Participant).filter(
-                    Participant.referrer_id == str(level_1_id),
-                    Participant.is_active == 1
-                ).all()
-                level_2_ids.extend([p.ozon_id for p in level_2_refs])
-            referrals_by_level[2] = level_2_ids
-            
-            if max_level > 2:
-                # Уровень 3: рефералы рефералов уровня 2 (только активные)
-                level_3_ids = []
-                for level_2_id in referrals_by_level[2]:
-                    level_3_refs = db.query(Participant).filter(
-                        Participant.referrer_id == str(level_2_id),
-                        Participant.is_active == 1
-                    ).all()
-                    level_3_ids.extend([p.ozon_id for p in level_3_refs])
-                referrals_by_level[3] = level_3_ids
-                
-                # Если нужны уровни 4 и выше, продолжаем рекурсивно
-                if max_level > 3:
-                    for level in range(4, max_level + 1):
-                        level_ids = []
-                        prev_level_ids = referrals_by_level.get(level - 1, [])
-                        for prev_id in prev_level_ids:
-                            refs = db.query(Participant).filter(
-                                Participant.referrer_id == str(prev_id),
-                                Participant.is_active == 1
-                            ).all()
-                            level_ids.extend([p.ozon_id for p in refs])
-                        referrals_by_level[level] = level_ids
-        
-        return referrals_by_level
-    finally:
-        db.close()
+    
+    for referral_ozon_id, level in rows:
+        referrals_by_level[level].append(referral_ozon_id)
+    
+    return referrals_by_level
 
 def get_referrals_orders_stats(referral_ozon_ids: list) -> dict:
     """Получает статистику по заказам рефералов.
@@ -893,60 +1403,60 @@ def get_referrals_orders_stats(referral_ozon_ids: list) -> dict:
     if not referral_ozon_ids:
         return {"orders_count": 0, "total_sum": 0.0}
     
-    db = SessionLocal()
-    try:
-        # Получаем информацию о рефералах и их датах регистрации
-        participants = db.query(Participant).filter(
-            Participant.ozon_id.in_([str(oid) for oid in referral_ozon_ids])
-        ).all()
-        
-        # Создаем словарь: ozon_id -> registration_date
-        registration_dates = {}
-        for p in participants:
-            if p.registration_date:
-                registration_dates[str(p.ozon_id)] = p.registration_date
-        
-        # Подсчитываем доставленные заказы рефералов и их сумму
-        # Фильтруем только заказы, созданные после регистрации реферала
-        orders = db.query(Order).filter(
-            Order.buyer_id.in_([str(oid) for oid in referral_ozon_ids]),
-            Order.status == "delivered"
-        ).all()
-        
-        orders_count = 0
-        total_sum = 0.0
-        
-        for order in orders:
-            # Проверяем, что заказ создан после регистрации реферала
-            buyer_registration_date = registration_dates.get(str(order.buyer_id))
-            if buyer_registration_date and order.created_at:
-                if order.created_at < buyer_registration_date:
-                    continue  # Пропускаем заказ, созданный до регистрации реферала
-            
-            orders_count += 1
-            try:
-                if order.price_amount:
-                    price = float(order.price_amount)
-                    total_sum += price
-            except (ValueError, TypeError):
-                continue
-        
-        return {
-            "orders_count": orders_count,
-            "total_sum": total_sum
-        }
-    finally:
-        db.close()
+    # Количество и сумма доставленных заказов рефералов считаются в SQL (COUNT/SUM), одним JOIN-запросом
+    # с датой регистрации покупателя на каждую часть IN-списка. Учитываются только заказы, созданные
+    # после регистрации реферала (заказы без даты и покупатели без даты регистрации учитываются).
+    # price_amount хранится строкой, поэтому приводим к REAL; нечисловые значения дают 0
+    referral_ozon_ids = list({str(oid) for oid in referral_ozon_ids})
+    orders_count = 0
+    total_sum = 0.0
+    
+    with engine.connect() as conn:
+        for i in range(0, len(referral_ozon_ids), IN_QUERY_CHUNK_SIZE):
+            count, chunk_sum = conn.execute(
+                select(
+                    func.count(Order.id),
+                    func.coalesce(func.sum(cast(Order.price_amount, Float)), 0.0)
+                ).select_from(Order).outerjoin(
+                    Participant, Participant.ozon_id == Order.buyer_id
+                ).where(
+                    Order.buyer_id.in_(referral_ozon_ids[i:i + IN_QUERY_CHUNK_SIZE]),
+                    Order.status == "delivered",
+                    or_(
+                        Participant.registration_date.is_(None),
+                        Order.created_at.is_(None),
+                        Order.created_at >= Participant.registration_date
+                    )
+                )
+            ).one()
+            orders_count += count
+            total_sum += float(chunk_sum)
+    
+    return {
+        "orders_count": orders_count,
+        "total_sum": total_sum
+    }
 
 # >>> КОНЕЦ БЛОКА: ФУНКЦИИ ДЛЯ РАБОТЫ С УЧАСТНИКАМИ <<<
 
 # >>> ФУНКЦИИ ДЛЯ РАБОТЫ С НАСТРОЙКАМИ БОНУСОВ <<<
+# Кэш настроек бонусов. Обращения идут из разных потоков (asyncio.to_thread), поэтому кэш читается
+# и меняется под блокировкой. Если настройки изменил другой процесс, устаревание ограничено TTL.
+BONUS_SETTINGS_CACHE_TTL = 60  # секунд
 _bonus_settings_cache = None
+_bonus_settings_expires_at = 0.0
+_bonus_settings_lock = threading.RLock()
+
+def _set_bonus_settings_cache(settings):
+    """Сохраняет настройки в кэш на BONUS_SETTINGS_CACHE_TTL секунд (вызывать под _bonus_settings_lock)."""
+    global _bonus_settings_cache, _bonus_settings_expires_at
+    _bonus_settings_cache = settings
+    _bonus_settings_expires_at = time.monotonic() + BONUS_SETTINGS_CACHE_TTL if settings is not None else 0.0
 
 def clear_bonus_settings_cache():
     """Сбросить кэш настроек бонусов (использовать после обновления)."""
-    global _bonus_settings_cache
-    _bonus_settings_cache = None
+    with _bonus_settings_lock:
+        _set_bonus_settings_cache(None)
 
 def init_bonus_settings():
     """Создает дефолтные настройки бонусов при первом запуске."""
@@ -965,11 +1475,13 @@ def init_bonus_settings():
             db.add(default_settings)
             db.commit()
             
-            # Отсоединяем объект от сессии перед кэшированием
+            # После commit атрибуты объекта истекают: загружаем их заново,
+            # затем отсоединяем объект от сессии перед кэшированием
+            db.refresh(default_settings)
             db.expunge(default_settings)
             
-            global _bonus_settings_cache
-            _bonus_settings_cache = default_settings
+            with _bonus_settings_lock:
+                _set_bonus_settings_cache(default_settings)
     except Exception as e:
         db.rollback()
         raise e
@@ -977,7 +1489,10 @@ def init_bonus_settings():
         db.close()
 
 # >>> ФУНКЦИИ ДЛЯ РАБОТЫ С НАСТРОЙКАМИ ВЫВОДА БОНУСОВ <<<
+# Кэш настроек вывода. Первое обращение может прийти одновременно из нескольких потоков
+# (asyncio.to_thread), поэтому загрузка и запись кэша идут под блокировкой
 _withdrawal_settings_cache = None
+_withdrawal_settings_lock = threading.Lock()
 
 class WithdrawalSettingsData:
     """Простой класс для хранения настроек вывода без привязки к сессии SQLAlchemy."""
@@ -990,68 +1505,60 @@ def init_withdrawal_settings():
     """Создает дефолтные настройки вывода бонусов при первом запуске."""
     db = SessionLocal()
     try:
-        existing = db.query(WithdrawalSettings).filter(WithdrawalSettings.id == 1).first()
-        if not existing:
-            default_settings = WithdrawalSettings(
+        # INSERT OR IGNORE: если запись id=1 уже создана (в т.ч. параллельно другим процессом),
+        # вставка пропускается без IntegrityError. Кэш заполнит get_withdrawal_settings под блокировкой
+        db.execute(
+            insert(WithdrawalSettings.__table__).prefix_with("OR IGNORE").values(
                 id=1,
                 min_withdrawal_amount=100.0,
                 days_between_withdrawals=None  # Без ограничений по умолчанию
             )
-            db.add(default_settings)
-            db.commit()
-            
-            # Отсоединяем объект от сессии перед кэшированием
-            db.expunge(default_settings)
-            
-            global _withdrawal_settings_cache
-            _withdrawal_settings_cache = default_settings
+        )
+        db.commit()
     except Exception as e:
         db.rollback()
         raise e
     finally:
         db.close()
 
-class WithdrawalSettingsData:
-    """Простой класс для хранения настроек вывода без привязки к сессии SQLAlchemy."""
-    def __init__(self, min_withdrawal_amount: float, days_between_withdrawals: int | None, updated_at: datetime):
-        self.min_withdrawal_amount = min_withdrawal_amount
-        self.days_between_withdrawals = days_between_withdrawals
-        self.updated_at = updated_at
-
 def get_withdrawal_settings():
     """Получить текущие настройки вывода (с кэшированием для производительности)."""
     global _withdrawal_settings_cache
     
-    # Если есть кэш, возвращаем его
-    if _withdrawal_settings_cache is not None:
-        return _withdrawal_settings_cache
+    # Если есть кэш, возвращаем его (без блокировки)
+    settings_data = _withdrawal_settings_cache
+    if settings_data is not None:
+        return settings_data
     
-    db = SessionLocal()
-    try:
-        settings = db.query(WithdrawalSettings).filter(WithdrawalSettings.id == 1).first()
-        if not settings:
-            # Если настроек нет, создаем дефолтные
-            init_withdrawal_settings()
-            settings = db.query(WithdrawalSettings).filter(WithdrawalSettings.id == 1).first()
+    with _withdrawal_settings_lock:
+        # Повторная проверка: кэш мог заполнить другой поток, пока мы ждали блокировку
+        if _withdrawal_settings_cache is not None:
+            return _withdrawal_settings_cache
         
-        # Извлекаем значения ДО закрытия сессии и создаем простой объект
-        if settings:
-            # Загружаем все значения пока сессия активна
-            min_amount = settings.min_withdrawal_amount
-            days_between = settings.days_between_withdrawals
-            updated = settings.updated_at
-            
-            # Создаем простой объект без привязки к сессии
-            settings_data = WithdrawalSettingsData(min_amount, days_between, updated)
+        db = SessionLocal()
+        try:
+            settings = db.query(WithdrawalSettings).filter(WithdrawalSettings.id == 1).first()
+            if not settings:
+                # Если настроек нет, создаем дефолтные (под блокировкой - только один поток)
+                init_withdrawal_settings()
+                settings = db.query(WithdrawalSettings).filter(WithdrawalSettings.id == 1).first()
             
-            _withdrawal_settings_cache = settings_data
-            return settings_data
-        else:
-            return None
-    except Exception as e:
-        raise
-    finally:
-        db.close()
+            # Извлекаем значения ДО закрытия сессии и создаем простой объект
+            if settings:
+                # Загружаем все значения пока сессия активна
+                min_amount = settings.min_withdrawal_amount
+                days_between = settings.days_between_withdrawals
+                updated = settings.updated_at
+                
+                # Создаем простой объект без привязки к сессии
+                settings_data = WithdrawalSettingsData(min_amount, days_between, updated)
+                
+                _withdrawal_settings_cache = settings_data
+                return settings_data
+            else:
+                return None
+        finally:
+            db.close()
 
 def update_withdrawal_settings(settings: dict):
     """Обновить настройки вывода."""
@@ -1068,7 +1575,7 @@ def update_withdrawal_settings(settings: dict):
         if 'days_between_withdrawals' in settings:
             existing.days_between_withdrawals = settings['days_between_withdrawals']
         
-        existing.updated_at = datetime.utcnow()
+        existing.updated_at = utcnow()
         db.commit()
         
         # Извлекаем значения ДО закрытия сессии и создаем простой объект
@@ -1079,9 +1586,10 @@ def update_withdrawal_settings(settings: dict):
         # Создаем простой объект без привязки к сессии
         settings_data = WithdrawalSettingsData(min_amount, days_between, updated)
         
-        # Сбрасываем кэш
+        # Обновляем кэш
         global _withdrawal_settings_cache
-        _withdrawal_settings_cache = settings_data
+        with _withdrawal_settings_lock:
+            _withdrawal_settings_cache = settings_data
         
         return settings_data
     except Exception as e:
@@ -1093,37 +1601,36 @@ def update_withdrawal_settings(settings: dict):
 def clear_withdrawal_settings_cache():
     """Сбросить кэш настроек вывода (использовать после обновления)."""
     global _withdrawal_settings_cache
-    _withdrawal_settings_cache = None
+    with _withdrawal_settings_lock:
+        _withdrawal_settings_cache = None
 
 # >>> КОНЕЦ БЛОКА: ФУНКЦИИ ДЛЯ РАБОТЫ С НАСТРОЙКАМИ ВЫВОДА БОНУСОВ <<<
 
 def get_bonus_settings():
     """Получить текущие настройки бонусов (с кэшированием для производительности)."""
-    global _bonus_settings_cache
-    
-    # Если есть кэш, возвращаем его
-    if _bonus_settings_cache is not None:
-        return _bonus_settings_cache
-    
-    db = SessionLocal()
-    try:
-        settings = db.query(BonusSettings).filter(BonusSettings.id == 1).first()
-        if not settings:
-            # Если настроек нет, создаем дефолтные
-            init_bonus_settings()
-            settings = db.query(BonusSettings).filter(BonusSettings.id == 1).first()
+    # Блокировка держится и на время загрузки, чтобы параллельные вызовы не читали БД одновременно
+    with _bonus_settings_lock:
+        # Если есть неистекший кэш, возвращаем его
+        if _bonus_settings_cache is not None and time.monotonic() < _bonus_settings_expires_at:
+            return _bonus_settings_cache
         
-        # Отсоединяем объект от сессии перед кэшированием
-        # Это позволяет использовать объект после закрытия сессии
-        if settings:
-            db.expunge(settings)
-        
-        _bonus_settings_cache = settings
-        return settings
-    except Exception as e:
-        raise
-    finally:
-        db.close()
+        db = SessionLocal()
+        try:
+            settings = db.query(BonusSettings).filter(BonusSettings.id == 1).first()
+            if not settings:
+                # Если настроек нет, создаем дефолтные
+                init_bonus_settings()
+                settings = db.query(BonusSettings).filter(BonusSettings.id == 1).first()
+            
+            # Отсоединяем объект от сессии перед кэшированием
+            # Это позволяет использовать объект после закрытия сессии
+            if settings:
+                db.expunge(settings)
+            
+            _set_bonus_settings_cache(settings)
+            return settings
+        finally:
+            db.close()
 
 def update_bonus_settings(settings: dict):
     """Обновить настройки бонусов."""
@@ -1141,18 +1648,20 @@ def update_bonus_settings(settings: dict):
         # Динамически обновляем проценты для любого уровня
         for key, value in settings.items():
             if key.startswith('level_') and key.endswith('_percent'):
-                if hasattr(existing, key):
+                if key in BonusSettings.__table__.columns:
                     setattr(existing, key, value)
         
-        existing.updated_at = datetime.utcnow()
+        existing.updated_at = utcnow()
         db.commit()
         
-        # Отсоединяем объект от сессии перед кэшированием
+        # После commit атрибуты объекта истекают: загружаем их заново,
+        # затем отсоединяем объект от сессии перед кэшированием
+        db.refresh(existing)
         db.expunge(existing)
         
-        # Сбрасываем кэш
-        global _bonus_settings_cache
-        _bonus_settings_cache = existing
+        # Обновляем кэш
+        with _bonus_settings_lock:
+            _set_bonus_settings_cache(existing)
         
         return existing
     except Exception as e:
@@ -1164,7 +1673,55 @@ def update_bonus_settings(settings: dict):
 # >>> КОНЕЦ БЛОКА: ФУНКЦИИ ДЛЯ РАБОТЫ С НАСТРОЙКАМИ БОНУСОВ <<<
 
 # >>> ФУНКЦИИ ДЛЯ РАБОТЫ С НАЧИСЛЕНИЕМ БОНУСОВ <<<
-def get_referral_chain(referral_ozon_id: str, max_levels: int, order_date: datetime = None, db: Session = None) -> list:
+# Цепочки реферов участников :referral_ozon_ids снизу вверх: level=1 - прямой реферер и т.д.
+# Обход останавливается на участнике без реферера или если реферер не зарегистрирован
+_REFERRAL_CHAIN_QUERY = text("""
+    WITH RECURSIVE chain(root_id, ozon_id, referrer_id, registration_date, is_active, level) AS (
+        SELECT buyer.ozon_id, r.ozon_id, r.referrer_id, r.registration_date, r.is_active, 1
+        FROM participants buyer
+        JOIN participants r ON r.ozon_id = buyer.referrer_id
+        WHERE buyer.ozon_id IN :referral_ozon_ids
+            AND buyer.referrer_id IS NOT NULL AND buyer.referrer_id != ''
+            AND :max_levels > 0
+        UNION ALL
+        SELECT chain.root_id, r.ozon_id, r.referrer_id, r.registration_date, r.is_active, chain.level + 1
+        FROM chain
+        JOIN participants r ON r.ozon_id = chain.referrer_id
+        WHERE chain.referrer_id IS NOT NULL AND chain.referrer_id != ''
+            AND chain.level < :max_levels
+    )
+    SELECT root_id, ozon_id, registration_date, is_active, level FROM chain ORDER BY root_id, level
+""").bindparams(
+    bindparam("referral_ozon_ids", expanding=True)
+).columns(root_id=String, ozon_id=String, registration_date=DateTime, is_active=Integer, level=Integer)
+
+def load_referral_chains(db: Session, referral_ozon_ids, max_levels: int) -> dict:
+    """Загрузить цепочки реферов (включая неактивных) сразу для нескольких участников.
+    
+    Результат используется как кэш для get_referral_chain в рамках одной пачки заказов.
+    
+    Args:
+        db: Сессия БД
+        referral_ozon_ids: Ozon ID рефералов (покупателей)
+        max_levels: Максимальная глубина цепочки
+        
+    Returns:
+        dict: {(ozon_id, max_levels): [(referrer_ozon_id, registration_date, is_active, level), ...]}
+    """
+    referral_ozon_ids = list(dict.fromkeys(str(ozon_id) for ozon_id in referral_ozon_ids if ozon_id))
+    # Для участников без реферов тоже кэшируем пустую цепочку
+    chains = {(ozon_id, max_levels): [] for ozon_id in referral_ozon_ids}
+    for i in range(0, len(referral_ozon_ids), IN_QUERY_CHUNK_SIZE):
+        rows = db.execute(_REFERRAL_CHAIN_QUERY, {
+            "referral_ozon_ids": referral_ozon_ids[i:i + IN_QUERY_CHUNK_SIZE],
+            "max_levels": max_levels,
+        })
+        for root_id, referrer_ozon_id, registration_date, is_active, level in rows:
+            chains[(root_id, max_levels)].append((referrer_ozon_id, registration_date, is_active, level))
+    return chains
+
+def get_referral_chain(referral_ozon_id: str, max_levels: int, order_date: datetime = None, db: Session = None,
+                       chain_cache: dict = None) -> list:
     """Получить реферальную цепочку для указанного реферала (найти всех реферов до max_levels уровня).
     Неактивные участники пропускаются, но уровень сохраняется (не уменьшается).
     
@@ -1173,78 +1730,67 @@ def get_referral_chain(referral_ozon_id: str, max_levels: int, order_date: datet
         max_levels: Максимальная глубина цепочки
         order_date: Дата создания заказа (для проверки, что реферер зарегистрирован до этого)
         db: Сессия БД (опционально, если None, создается новая)
+        chain_cache: Кэш цепочек из load_referral_chains (опционально); недостающие цепочки дозагружаются в него
         
     Returns:
         list: Список словарей [{"ozon_id": ..., "level": 1}, ...] с рефералами по уровням
               level=1 - прямой реферер, level=2 - реферер реферера и т.д.
               Неактивные участники НЕ включаются в список (пропускаются)
     """
-    should_close_db = False
-    if db is None:
-        db = SessionLocal()
-        should_close_db = True
-    
-    try:
-        chain = []
-        current_ozon_id = str(referral_ozon_id)
-        real_level = 0  # Реальный уровень в цепочке (включая неактивных), начинаем с 0
-        
-        while real_level < max_levels:
-            # Ищем участника (того, кто сделал покупку или является реферером)
-            participant = db.query(Participant).filter(
-                Participant.ozon_id == current_ozon_id
-            ).first()
-            
-            if not participant or not participant.referrer_id:
-                break
-            
-            # Переходим к рефереру
-            referrer_ozon_id = participant.referrer_id
-            
-            # Проверяем реферера
-            referrer_participant = db.query(Participant).filter(
-                Participant.ozon_id == referrer_ozon_id
-            ).first()
-            
-            if not referrer_participant:
-                break  # Реферер не зарегистрирован
-            
-            # Проверяем дату регистрации реферера (если указана дата заказа)
-            if order_date and referrer_participant.registration_date:
-                if order_date < referrer_participant.registration_date:
-                    break  # Заказ создан до регистрации реферера
-            
-            # Увеличиваем реальный уровень (включая неактивных)
-            real_level += 1
-            
-            # Если реферер неактивен - пропускаем его, но продолжаем искать дальше
-            # Уровень уже увеличен, поэтому следующий активный участник получит правильный уровень
-            if referrer_participant.is_active == 0:
-                # Пропускаем неактивного участника, но продолжаем поиск
-                current_ozon_id = referrer_ozon_id
-                continue
-            
-            # Добавляем активного реферера в цепочку (кому начислим бонус)
-            # Используем real_level, чтобы сохранить исходный уровень
-            chain.append({
-                "ozon_id": referrer_ozon_id,
-                "level": real_level
-            })
-            
-            # Переходим к следующему уровню (реферер становится текущим для поиска его реферера)
-            current_ozon_id = referrer_ozon_id
+    cache_key = (str(referral_ozon_id), max_levels)
+    if chain_cache is not None and cache_key in chain_cache:
+        ancestors = chain_cache[cache_key]
+    else:
+        should_close_db = False
+        if db is None:
+            db = SessionLocal()
+            should_close_db = True
         
-        return chain
-    finally:
-        if should_close_db:
-            db.close()
-
-def calculate_bonuses_for_order(order: Order, db: Session = None) -> list:
+        try:
+            # Вся цепочка реферов (включая неактивных) до max_levels загружается одним рекурсивным запросом;
+            # level - реальный уровень в цепочке, неактивные участники его тоже увеличивают
+            ancestors = load_referral_chains(db, [referral_ozon_id], max_levels)[cache_key]
+        finally:
+            if should_close_db:
+                db.close()
+        
+        if chain_cache is not None:
+            chain_cache[cache_key] = ancestors
+    
+    chain = []
+    for referrer_ozon_id, registration_date, is_active, real_level in ancestors:
+        # Проверяем дату регистрации реферера (если указана дата заказа)
+        if order_date and registration_date:
+            if order_date < registration_date:
+                break  # Заказ создан до регистрации реферера
+        
+        # Если реферер неактивен - пропускаем его, но продолжаем искать дальше
+        # (уровень следующего активного участника уже учитывает пропущенного)
+        if is_active == 0:
+            continue
+        
+        # Добавляем активного реферера в цепочку (кому начислим бонус)
+        chain.append({
+            "ozon_id": referrer_ozon_id,
+            "level": real_level
+        })
+    
+    return chain
+
+# Данные покупателя для расчета бонусов: готовый Core-запрос, собирается один раз при загрузке модуля
+# (выполняется на каждый заказ, без загрузки ORM-объекта Participant в сессию)
+_BONUS_BUYER_QUERY = select(
+    Participant.is_active,
+    Participant.registration_date
+).where(Participant.ozon_id == bindparam("ozon_id"))
+
+def calculate_bonuses_for_order(order: Order, db: Session = None, chain_cache: dict = None) -> list:
     """Рассчитать бонусы для заказа.
     
     Args:
         order: Объект заказа
         db: Сессия БД (опционально, если None, создается новая)
+        chain_cache: Кэш реферальных цепочек (см. load_referral_chains), опционально
         
     Returns:
         list: Список словарей с данными для начисления бонусов
@@ -1259,9 +1805,7 @@ def calculate_bonuses_for_order(order: Order, db: Session = None) -> list:
     
     try:
         # Проверяем, что покупатель зарегистрирован и активен
-        buyer_participant = db.query(Participant).filter(
-            Participant.ozon_id == order.buyer_id
-        ).first()
+        buyer_participant = db.execute(_BONUS_BUYER_QUERY, {"ozon_id": order.buyer_id}).first()
         
         if not buyer_participant:
             return []  # Покупатель не зарегистрирован
@@ -1306,7 +1850,7 @@ def calculate_bonuses_for_order(order: Order, db: Session = None) -> list:
             })
         
         # Получаем реферальную цепочку (передаем дату заказа для проверки)
-        chain = get_referral_chain(order.buyer_id, settings.max_levels, order.created_at, db)
+        chain = get_referral_chain(order.buyer_id, settings.max_levels, order.created_at, db, chain_cache)
         
         for item in chain:
             level = item["level"]
@@ -1343,45 +1887,100 @@ def accrue_bonuses_for_order(posting_number: str, db: Session = None) -> bool:
     Returns:
         bool: True если бонусы начислены, False если уже были начислены или ошибка
     """
+    return accrue_bonuses_for_orders([posting_number], db) > 0
+
+def accrue_bonuses_for_orders(posting_numbers, db: Session = None) -> int:
+    """Начислить бонусы за несколько заказов за один проход.
+    
+    Уже начисленные заказы определяются одним запросом на пачку, заказы загружаются
+    пачкой, а все транзакции бонусов добавляются разом и сохраняются одним commit/flush.
+    
+    Args:
+        posting_numbers: Номера отправлений заказов
+        db: Сессия БД (опционально, если None, создается новая)
+        
+    Returns:
+        int: Количество заказов, за которые начислены бонусы
+    """
+    # Убираем пустые значения и дубликаты, сохраняя порядок
+    posting_numbers = list(dict.fromkeys(pn for pn in posting_numbers if pn))
+    if not posting_numbers:
+        return 0
+    
     should_close_db = False
     if db is None:
         db = SessionLocal()
         should_close_db = True
     
     try:
-        # Проверяем, не начислялись ли уже бонусы за этот заказ
-        existing = db.query(BonusTransaction).filter(
-            BonusTransaction.posting_number == posting_number
-        ).first()
-        
-        if existing:
-            return False  # Бонусы уже начислены
-        
-        # Находим заказ
-        order = db.query(Order).filter(Order.posting_number == posting_number).first()
-        if not order:
-            return False
+        if should_close_db:
+            begin_immediate(db)
+        else:
+            # Изменения вызывающей функции должны быть видны запросам ниже
+            db.flush()
         
-        # Рассчитываем бонусы (передаем сессию БД для оптимизации)
-        bonuses = calculate_bonuses_for_order(order, db)
+        # Проверяем, не начислялись ли уже бонусы за эти заказы
+        already_accrued = set()
+        for i in range(0, len(posting_numbers), IN_QUERY_CHUNK_SIZE):
+            chunk = posting_numbers[i:i + IN_QUERY_CHUNK_SIZE]
+            already_accrued.update(
+                pn for (pn,) in db.query(BonusTransaction.posting_number).filter(
+                    BonusTransaction.posting_number.in_(chunk)
+                ).distinct()
+            )
         
-        if not bonuses:
-            return False
+        # Находим заказы
+        orders = get_orders_by_posting_numbers(
+            db, [pn for pn in posting_numbers if pn not in already_accrued]
+        )
         
-        # Сохраняем транзакции
         from datetime import timedelta
-        current_time = datetime.utcnow()
+        current_time = utcnow()
         available_at = current_time + timedelta(days=14)
         
-        for bonus_data in bonuses:
-            # Устанавливаем поля доступности к выводу
-            bonus_data["status"] = "frozen"  # Заморожен на 14 дней
-            bonus_data["available_at"] = available_at
-            bonus_data["returned_amount"] = None
-            bonus_data["returned_at"] = None
+        # Цепочки реферов загружаются один раз на пачку для всех покупателей:
+        # у одного покупателя бывает много заказов, и они используют одну цепочку
+        settings = get_bonus_settings()
+        chain_cache = {}
+        if settings:
+            chain_cache = load_referral_chains(
+                db, {order.buyer_id for order in orders.values()}, settings.max_levels
+            )
+        
+        transactions = []
+        accrued_count = 0
+        for posting_number in posting_numbers:
+            order = orders.get(posting_number)
+            if posting_number in already_accrued or order is None:
+                continue
+            
+            # Рассчитываем бонусы (передаем сессию БД для оптимизации)
+            try:
+                bonuses = calculate_bonuses_for_order(order, db, chain_cache)
+            except Exception as e:
+                print(f"Ошибка при расчете бонусов за заказ {posting_number}: {e}")
+                continue
             
-            transaction = BonusTransaction(**bonus_data)
-            db.add(transaction)
+            if not bonuses:
+                continue
+            
+            for bonus_data in bonuses:
+                # Устанавливаем поля доступности к выводу
+                bonus_data["status"] = "frozen"  # Заморожен на 14 дней
+                bonus_data["available_at"] = available_at
+                bonus_data["returned_amount"] = None
+                bonus_data["returned_at"] = None
+                
+                transactions.append(bonus_data)
+            accrued_count += 1
+        
+        # Сохраняем транзакции одним INSERT OR IGNORE (executemany, без ORM-объектов):
+        # уникальный индекс (posting_number, level) не дает начислить бонус повторно,
+        # даже если параллельная синхронизация успела начислить его после проверки выше
+        if transactions:
+            result = db.execute(insert(BonusTransaction.__table__).prefix_with("OR IGNORE"), transactions)
+            if result.rowcount is not None and 0 <= result.rowcount < len(transactions):
+                print(f"ℹ️ Пропущено уже существующих начислений бонусов: {len(transactions) - result.rowcount}")
         
         # Коммитим только если сессия была создана внутри функции
         # Если сессия передана извне, коммит будет в вызывающей функции
@@ -1390,13 +1989,13 @@ def accrue_bonuses_for_order(posting_number: str, db: Session = None) -> bool:
         else:
             # Используем flush для видимости в текущей транзакции
             db.flush()
-        return True
+        return accrued_count
     except Exception as e:
         # Откатываем только если сессия была создана внутри функции
         if should_close_db:
             db.rollback()
-        print(f"Ошибка при начислении бонусов за заказ {posting_number}: {e}")
-        return False
+        print(f"Ошибка при начислении бонусов за заказы {', '.join(posting_numbers[:10])}: {e}")
+        return 0
     finally:
         if should_close_db:
             db.close()
@@ -1413,16 +2012,15 @@ def get_user_bonuses(ozon_id: str, level: int = None) -> float:
     """
     db = SessionLocal()
     try:
-        query = db.query(BonusTransaction).filter(
+        # Сумма считается в SQL, строки транзакций не загружаются
+        query = db.query(func.coalesce(func.sum(BonusTransaction.bonus_amount), 0.0)).filter(
             BonusTransaction.referrer_ozon_id == str(ozon_id)
         )
         
         if level is not None:
             query = query.filter(BonusTransaction.level == level)
         
-        transactions = query.all()
-        total = sum(t.bonus_amount for t in transactions if t.bonus_amount)
-        return total
+        return query.scalar()
     finally:
         db.close()
 
@@ -1441,12 +2039,14 @@ def get_referrals_bonuses_stats(referral_ozon_ids: list, level: int) -> float:
     
     db = SessionLocal()
     try:
-        transactions = db.query(BonusTransaction).filter(
-            BonusTransaction.referral_ozon_id.in_([str(oid) for oid in referral_ozon_ids]),
-            BonusTransaction.level == level
-        ).all()
-        
-        total = sum(t.bonus_amount for t in transactions if t.bonus_amount)
+        # Сумма считается в SQL (по частям IN-списка), строки транзакций не загружаются
+        referral_ozon_ids = list({str(oid) for oid in referral_ozon_ids})
+        total = 0.0
+        for i in range(0, len(referral_ozon_ids), IN_QUERY_CHUNK_SIZE):
+            total += db.query(func.coalesce(func.sum(BonusTransaction.bonus_amount), 0.0)).filter(
+                BonusTransaction.referral_ozon_id.in_(referral_ozon_ids[i:i + IN_QUERY_CHUNK_SIZE]),
+                BonusTransaction.level == level
+            ).scalar()
         return total
     finally:
         db.close()
@@ -1463,29 +2063,44 @@ def get_daily_bonus_transactions(referrer_ozon_id: str, date: datetime) -> list:
     """
     db = SessionLocal()
     try:
-        # Определяем начало и конец дня
+        # Границы дня - полуинтервал [начало дня, начало следующего дня)
         date_start = datetime.combine(date.date(), datetime.min.time())
-        date_end = datetime.combine(date.date(), datetime.max.time())
+        date_end = date_start + timedelta(days=1)
         
         # Получаем все транзакции за указанную дату для реферера
         transactions = db.query(BonusTransaction).filter(
             BonusTransaction.referrer_ozon_id == str(referrer_ozon_id),
             BonusTransaction.created_at >= date_start,
-            BonusTransaction.created_at <= date_end
+            BonusTransaction.created_at < date_end
         ).all()
         
+        # Загружаем связанные заказы и рефералов одним запросом на таблицу (IN-список по частям),
+        # а не отдельным запросом на каждую транзакцию; выбираем только нужные колонки, без ORM-объектов
+        posting_numbers = list({trans.posting_number for trans in transactions if trans.posting_number})
+        referral_ids = list({trans.referral_ozon_id for trans in transactions if trans.referral_ozon_id})
+        
+        orders_by_posting = {}
+        for i in range(0, len(posting_numbers), IN_QUERY_CHUNK_SIZE):
+            rows = db.query(Order.posting_number, Order.item_name, Order.price_amount).filter(
+                Order.posting_number.in_(posting_numbers[i:i + IN_QUERY_CHUNK_SIZE])
+            ).all()
+            orders_by_posting.update((row.posting_number, row) for row in rows)
+        
+        participants_by_ozon_id = {}
+        for i in range(0, len(referral_ids), IN_QUERY_CHUNK_SIZE):
+            rows = db.query(Participant.ozon_id, Participant.name, Participant.username).filter(
+                Participant.ozon_id.in_(referral_ids[i:i + IN_QUERY_CHUNK_SIZE])
+            ).all()
+            participants_by_ozon_id.update((row.ozon_id, row) for row in rows)
+        
         # Формируем список с данными о транзакциях и связанных заказах
         result = []
         for trans in transactions:
-            # Получаем информацию о заказе
-            order = db.query(Order).filter(
-                Order.posting_number == trans.posting_number
-            ).first()
+            # Информация о заказе
+            order = orders_by_posting.get(trans.posting_number)
             
-            # Получаем информацию о реферале (участнике, который сделал покупку)
-            referral_participant = db.query(Participant).filter(
-                Participant.ozon_id == trans.referral_ozon_id
-            ).first()
+            # Информация о реферале (участнике, который сделал покупку)
+            referral_participant = participants_by_ozon_id.get(trans.referral_ozon_id)
             
             result.append({
                 "transaction_id": trans.id,
@@ -1562,6 +2177,55 @@ def get_daily_bonus_summary(referrer_ozon_id: str, date: datetime) -> dict:
         "levels": levels
     }
 
+def get_daily_bonus_totals(referrer_ozon_id: str, date: datetime) -> dict | None:
+    """Получить итоги бонусов за день по уровням без списка транзакций (для уведомлений).
+    
+    Количество и сумма по уровням считаются в SQL (GROUP BY level); заказы и рефералы не загружаются.
+    Для детального просмотра со списком транзакций используется get_daily_bonus_summary.
+    
+    Args:
+        referrer_ozon_id: Ozon ID реферера (кому начислены бонусы)
+        date: Дата для выборки (используется только дата, без времени)
+        
+    Returns:
+        dict | None: Сводка в формате get_daily_bonus_summary, но уровни без ключа "transactions":
+            {"referrer_ozon_id": str, "date": datetime.date, "total_amount": float,
+             "levels": {1: {"count": int, "total_amount": float}, ...}}
+            Если начислений нет, возвращает None
+    """
+    db = SessionLocal()
+    try:
+        # Границы дня - полуинтервал [начало дня, начало следующего дня)
+        date_start = datetime.combine(date.date(), datetime.min.time())
+        date_end = date_start + timedelta(days=1)
+        
+        rows = db.query(
+            BonusTransaction.level,
+            func.count(),
+            func.coalesce(func.sum(BonusTransaction.bonus_amount), 0.0)
+        ).filter(
+            BonusTransaction.referrer_ozon_id == str(referrer_ozon_id),
+            BonusTransaction.created_at >= date_start,
+            BonusTransaction.created_at < date_end
+        ).group_by(BonusTransaction.level).all()
+        
+        if not rows:
+            return None
+        
+        levels = {
+            level: {"count": count, "total_amount": level_amount}
+            for level, count, level_amount in rows
+        }
+        
+        return {
+            "referrer_ozon_id": referrer_ozon_id,
+            "date": date.date(),
+            "total_amount": sum(level_data["total_amount"] for level_data in levels.values()),
+            "levels": levels
+        }
+    finally:
+        db.close()
+
 def process_order_return(posting_number: str, return_amount: float = None, db: Session = None) -> bool:
     """Обработать возврат заказа и списать соответствующие бонусы.
     
@@ -1573,70 +2237,114 @@ def process_order_return(posting_number: str, return_amount: float = None, db: S
     Returns:
         bool: True если возврат обработан, False если ошибка
     """
+    return_amounts = {posting_number: return_amount} if return_amount is not None else None
+    return process_order_returns([posting_number], db, return_amounts) > 0
+
+def process_order_returns(posting_numbers, db: Session = None, return_amounts: dict = None) -> int:
+    """Обработать возвраты нескольких заказов и списать соответствующие бонусы.
+    
+    Бонусы и заказы загружаются одним запросом на пачку (IN-список), а не отдельно на каждый заказ.
+    
+    Args:
+        posting_numbers: Номера отправлений возвращенных заказов
+        db: Сессия БД (опционально, если None, создается новая)
+        return_amounts: Суммы возврата {posting_number: сумма} (опционально;
+                        для заказов без суммы считается полный возврат)
+        
+    Returns:
+        int: Количество заказов, по которым списаны бонусы
+    """
+    # Убираем пустые значения и дубликаты, сохраняя порядок
+    posting_numbers = list(dict.fromkeys(pn for pn in posting_numbers if pn))
+    if not posting_numbers:
+        return 0
+    return_amounts = return_amounts or {}
+    
     should_close_db = False
     if db is None:
         db = SessionLocal()
         should_close_db = True
     
     try:
-        # Находим все бонусы, связанные с этим заказом
-        # Ищем бонусы со статусом "frozen" или "available" (не возвращенные и не выведенные)
-        transactions = db.query(BonusTransaction).filter(
-            BonusTransaction.posting_number == posting_number,
-            BonusTransaction.status.in_(["frozen", "available"])  # Только не возвращенные и не выведенные бонусы
-        ).all()
-        
-        if not transactions:
-            return False  # Нет бонусов для списания
-        
-        # Получаем информацию о заказе для расчета пропорции
-        order = db.query(Order).filter(Order.posting_number == posting_number).first()
-        if not order:
-            return False
-        
-        try:
-            order_sum = float(order.price_amount) if order.price_amount else 0.0
-        except (ValueError, TypeError):
-            order_sum = 0.0
-        
-        # Если сумма возврата не указана, считаем полный возврат
-        if return_amount is None:
-            return_amount = order_sum
-        
-        # Рассчитываем коэффициент возврата (0.0 - полный возврат, 1.0 - нет возврата)
-        if order_sum > 0:
-            return_ratio = return_amount / order_sum
-            # Если возврат больше суммы заказа, ограничиваем до 1.0
-            if return_ratio > 1.0:
-                return_ratio = 1.0
-        else:
-            return_ratio = 1.0  # Если сумма заказа 0, не списываем
-        
-        current_time = datetime.utcnow()
+        if should_close_db:
+            begin_immediate(db)
         
-        # Обрабатываем каждый бонус
-        for transaction in transactions:
-            # Рассчитываем сумму списания пропорционально возврату
-            if return_ratio >= 1.0:
-                # Полный возврат - списываем весь бонус
-                transaction.status = "returned"
-                transaction.returned_amount = transaction.bonus_amount
-                transaction.returned_at = current_time
+        # Находим все бонусы, связанные с этими заказами
+        # Ищем бонусы со статусом "frozen" или "available" (не возвращенные и не выведенные)
+        transactions_by_posting = {}
+        for i in range(0, len(posting_numbers), IN_QUERY_CHUNK_SIZE):
+            transactions = db.query(BonusTransaction).filter(
+                BonusTransaction.posting_number.in_(posting_numbers[i:i + IN_QUERY_CHUNK_SIZE]),
+                BonusTransaction.status.in_(["frozen", "available"])  # Только не возвращенные и не выведенные бонусы
+            ).all()
+            for transaction in transactions:
+                transactions_by_posting.setdefault(transaction.posting_number, []).append(transaction)
+        
+        if not transactions_by_posting:
+            return 0  # Нет бонусов для списания
+        
+        # Получаем информацию о заказах для расчета пропорции
+        orders = get_orders_by_posting_numbers(db, transactions_by_posting.keys())
+        
+        current_time = utcnow()
+        returned_count = 0
+        
+        for posting_number in posting_numbers:
+            transactions = transactions_by_posting.get(posting_number)
+            order = orders.get(posting_number)
+            if not transactions or not order:
+                continue
+            
+            try:
+                order_sum = float(order.price_amount) if order.price_amount else 0.0
+            except (ValueError, TypeError):
+                order_sum = 0.0
+            
+            # Если сумма возврата не указана, считаем полный возврат
+            return_amount = return_amounts.get(posting_number)
+            if return_amount is None:
+                return_amount = order_sum
+            
+            # Рассчитываем коэффициент возврата (0.0 - полный возврат, 1.0 - нет возврата)
+            if order_sum > 0:
+                return_ratio = return_amount / order_sum
+                # Если возврат больше суммы заказа, ограничиваем до 1.0
+                if return_ratio > 1.0:
+                    return_ratio = 1.0
             else:
-                # Частичный возврат - списываем пропорционально
-                returned_bonus_amount = transaction.bonus_amount * return_ratio
-                transaction.status = "returned"
-                transaction.returned_amount = returned_bonus_amount
-                transaction.returned_at = current_time
-                # Уменьшаем доступный бонус
-                transaction.bonus_amount = transaction.bonus_amount - returned_bonus_amount
+                return_ratio = 1.0  # Если сумма заказа 0, не списываем
+            
+            # Обрабатываем каждый бонус
+            for transaction in transactions:
+                # Рассчитываем сумму списания пропорционально возврату
+                if return_ratio >= 1.0:
+                    # Полный возврат - списываем весь бонус
+                    transaction.status = "returned"
+                    transaction.returned_amount = transaction.bonus_amount
+                    transaction.returned_at = current_time
+                else:
+                    # Частичный возврат - списываем пропорционально
+                    returned_bonus_amount = transaction.bonus_amount * return_ratio
+                    transaction.status = "returned"
+                    transaction.returned_amount = returned_bonus_amount
+                    transaction.returned_at = current_time
+                    # Уменьшаем доступный бонус
+                    transaction.bonus_amount = transaction.bonus_amount - returned_bonus_amount
+            returned_count += 1
         
-        db.commit()
-        return True
+        # Коммитим только если сессия была создана внутри функции
+        # Если сессия передана извне, коммит будет в вызывающей функции
+        if should_close_db:
+            db.commit()
+        else:
+            db.flush()
+        return returned_count
     except Exception as e:
-        db.rollback()
-        print(f"Ошибка при обработке возврата заказа {posting_number}: {e}")
-        return False
+        # Откатываем только если сессия была создана внутри функции
+        if should_close_db:
+            db.rollback()
+        print(f"Ошибка при обработке возврата заказов {', '.join(posting_numbers[:10])}: {e}")
+        return 0
     finally:
         if should_close_db:
             db.close()
@@ -1659,40 +2367,35 @@ def check_and_update_bonus_availability(db: Session = None) -> int:
         should_close_db = True
     
     try:
-        current_time = datetime.utcnow()
+        current_time = utcnow()
         
-        # Находим все бонусы, которые должны стать доступными
-        # (прошло 14 дней, статус "frozen", не возвращены)
-        transactions = db.query(BonusTransaction).filter(
+        # Бонусы, у которых прошло 14 дней (статус "frozen"), обновляются двумя UPDATE
+        # по статусу связанного заказа, без загрузки транзакций и заказов по одному
+        due_filter = (
             BonusTransaction.status == "frozen",
-            BonusTransaction.available_at <= current_time
-        ).all()
-        
-        updated_count = 0
-        
-        for transaction in transactions:
-            # Проверяем статус связанного заказа
-            order = db.query(Order).filter(
-                Order.posting_number == transaction.posting_number
-            ).first()
-            
-            if order:
-                # Если заказ не возвращен (статус не "cancelled" после доставки)
-                # или статус все еще "delivered", разблокируем бонус
-                if order.status == "delivered":
-                    transaction.status = "available"
-                    updated_count += 1
-                # Если заказ отменен после доставки - это возврат
-                elif order.status == "cancelled":
-                    # Помечаем как возвращенный
-                    transaction.status = "returned"
-                    transaction.returned_amount = transaction.bonus_amount
-                    transaction.returned_at = current_time
-                    updated_count += 1
-            else:
-                # Заказ не найден - считаем, что он доставлен (разблокируем)
-                transaction.status = "available"
-                updated_count += 1
+            BonusTransaction.available_at <= current_time,
+        )
+        order_exists = exists().where(Order.posting_number == BonusTransaction.posting_number)
+        
+        # Если заказ отменен после доставки - это возврат, помечаем как возвращенный
+        updated_count = db.query(BonusTransaction).filter(
+            *due_filter,
+            order_exists.where(Order.status == "cancelled")
+        ).update({
+            BonusTransaction.status: "returned",
+            BonusTransaction.returned_amount: BonusTransaction.bonus_amount,
+            BonusTransaction.returned_at: current_time,
+        }, synchronize_session=False)
+        
+        # Если заказ доставлен или не найден (считаем, что он доставлен) - разблокируем бонус.
+        # Заказы с другими статусами остаются замороженными
+        updated_count += db.query(BonusTransaction).filter(
+            *due_filter,
+            or_(
+                order_exists.where(Order.status == "delivered"),
+                ~order_exists,
+            )
+        ).update({BonusTransaction.status: "available"}, synchronize_session=False)
         
         db.commit()
         return updated_count
@@ -1715,52 +2418,74 @@ def get_available_bonuses_for_withdrawal(ozon_id: str) -> float:
     """
     db = SessionLocal()
     try:
-        # Сначала обновляем доступность бонусов
-        check_and_update_bonus_availability(db)
-        
-        # Получаем сумму доступных бонусов (только со статусом "available")
-        transactions = db.query(BonusTransaction).filter(
+        # Доступность бонусов обновляется фоновой задачей бота и синхронизацией, а не при каждом чтении баланса
+        # Получаем сумму доступных бонусов (только со статусом "available"), сумма считается в SQL
+        return db.query(func.coalesce(func.sum(BonusTransaction.bonus_amount), 0.0)).filter(
             BonusTransaction.referrer_ozon_id == str(ozon_id),
             BonusTransaction.status == "available"
-        ).all()
-        
-        total = sum(t.bonus_amount for t in transactions if t.bonus_amount)
-        return total
+        ).scalar()
     finally:
         db.close()
 
 # >>> КОНЕЦ БЛОКА: ФУНКЦИИ ДЛЯ РАБОТЫ С НАЧИСЛЕНИЕМ БОНУСОВ <<<
 
 # >>> ФУНКЦИИ ДЛЯ РАБОТЫ С НАСТРОЙКАМИ СИНХРОНИЗАЦИИ <<<
-def get_last_sync_timestamp() -> datetime | None:
-    """Возвращает время последней успешной синхронизации из базы данных (для проверки интервала 12 часов)."""
+# Кэш значений sync_settings (время последней синхронизации, дата последнего заказа).
+# Обращения идут из разных потоков, поэтому кэш читается и меняется под блокировкой;
+# сеттеры этого процесса сразу обновляют кэш, изменения из другого процесса видны через TTL
+SYNC_SETTINGS_CACHE_TTL = 30  # секунд
+_sync_settings_cache: dict[str, tuple[float, datetime | None]] = {}
+_sync_settings_lock = threading.Lock()
+
+def _cache_sync_setting(key: str, value: datetime | None):
+    """Сохраняет значение настройки синхронизации в кэш на SYNC_SETTINGS_CACHE_TTL секунд."""
+    with _sync_settings_lock:
+        _sync_settings_cache[key] = (time.monotonic() + SYNC_SETTINGS_CACHE_TTL, value)
+
+def _get_sync_datetime_setting(key: str) -> datetime | None:
+    """Возвращает дату из sync_settings по ключу (из кэша, если он не устарел)."""
+    with _sync_settings_lock:
+        entry = _sync_settings_cache.get(key)
+    if entry is not None and entry[0] >= time.monotonic():
+        return entry[1]
+    
     db = SessionLocal()
     try:
-        setting = db.query(SyncSettings).filter(SyncSettings.key == "last_sync_time").first()
+        setting = db.query(SyncSettings.value).filter(SyncSettings.key == key).first()
+        value = None
         if setting and setting.value:
             try:
-                return datetime.strptime(setting.value, "%Y-%m-%d %H:%M:%S")
+                value = datetime.fromisoformat(setting.value)
             except ValueError:
-                return None
-        return None
+                value = None
+        _cache_sync_setting(key, value)
+        return value
     finally:
         db.close()
 
+def _upsert_sync_setting(db: Session, key: str, value: str):
+    """Записывает значение настройки синхронизации одним INSERT ... ON CONFLICT(key) DO UPDATE."""
+    stmt = sqlite_insert(SyncSettings).values(key=key, value=value, updated_at=utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SyncSettings.key],
+        set_={"value": stmt.excluded.value, "updated_at": stmt.excluded.updated_at},
+    )
+    db.execute(stmt)
+
+def get_last_sync_timestamp() -> datetime | None:
+    """Возвращает время последней успешной синхронизации (с кэшированием на SYNC_SETTINGS_CACHE_TTL секунд)."""
+    return _get_sync_datetime_setting("last_sync_time")
+
 def set_last_sync_timestamp(timestamp: datetime):
     """Записывает время последней успешной синхронизации в базу данных (для проверки интервала 12 часов)."""
     db = SessionLocal()
     try:
-        setting = db.query(SyncSettings).filter(SyncSettings.key == "last_sync_time").first()
-        timestamp_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        
-        if setting:
-            setting.value = timestamp_str
-            setting.updated_at = datetime.utcnow()
-        else:
-            setting = SyncSettings(key="last_sync_time", value=timestamp_str)
-            db.add(setting)
-        
+        timestamp_str = timestamp.isoformat(sep=" ", timespec="seconds")
+        _upsert_sync_setting(db, "last_sync_time", timestamp_str)
         db.commit()
+        
+        # Обновляем кэш тем же значением, что записано в БД (без микросекунд)
+        _cache_sync_setting("last_sync_time", timestamp.replace(microsecond=0))
         print(f"Время синхронизации обновлено до: {timestamp_str}")
     except Exception as e:
         db.rollback()
@@ -1770,34 +2495,19 @@ def set_last_sync_timestamp(timestamp: datetime):
         db.close()
 
 def get_last_order_date() -> datetime | None:
-    """Возвращает дату последнего заказа из базы данных (для алгоритма скользящей даты и определения стартовой даты запроса)."""
-    db = SessionLocal()
-    try:
-        setting = db.query(SyncSettings).filter(SyncSettings.key == "last_order_date").first()
-        if setting and setting.value:
-            try:
-                return datetime.strptime(setting.value, "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                return None
-        return None
-    finally:
-        db.close()
+    """Возвращает дату последнего заказа из базы данных (для алгоритма скользящей даты и определения стартовой даты запроса, с кэшированием на SYNC_SETTINGS_CACHE_TTL секунд)."""
+    return _get_sync_datetime_setting("last_order_date")
 
 def set_last_order_date(order_date: datetime):
     """Записывает дату последнего заказа в базу данных (для алгоритма скользящей даты и определения стартовой даты запроса)."""
     db = SessionLocal()
     try:
-        setting = db.query(SyncSettings).filter(SyncSettings.key == "last_order_date").first()
-        date_str = order_date.strftime("%Y-%m-%d %H:%M:%S")
-        
-        if setting:
-            setting.value = date_str
-            setting.updated_at = datetime.utcnow()
-        else:
-            setting = SyncSettings(key="last_order_date", value=date_str)
-            db.add(setting)
-        
+        date_str = order_date.isoformat(sep=" ", timespec="seconds")
+        _upsert_sync_setting(db, "last_order_date", date_str)
         db.commit()
+        
+        # Обновляем кэш тем же значением, что записано в БД (без микросекунд)
+        _cache_sync_setting("last_order_date", order_date.replace(microsecond=0))
         print(f"Дата последнего заказа обновлена до: {date_str}")
     except Exception as e:
         db.rollback()
@@ -1805,60 +2515,122 @@ def set_last_order_date(order_date: datetime):
         raise e
     finally:
         db.close()
+
+def add_sync_stat(slot: int | None, seconds: float, started_at: datetime | None = None):
+    """Записывает длительность синхронизации в таблицу sync_stats.
+    
+    Args:
+        slot: Индекс времени синхронизации в SYNC_TIMES (None для синхронизации вне расписания)
+        seconds: Длительность синхронизации в секундах
+        started_at: Время начала синхронизации (по умолчанию - текущее время UTC)
+    """
+    db = SessionLocal()
+    try:
+        db.add(SyncStat(slot=slot, seconds=seconds, started_at=started_at or utcnow()))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        db.close()
+
+def get_sync_durations_by_slot(limit_per_slot: int = 30) -> dict[int, list[float]]:
+    """Возвращает последние длительности синхронизаций по расписанию, сгруппированные по слотам.
+    
+    Args:
+        limit_per_slot: Сколько последних замеров брать для каждого слота
+    
+    Returns:
+        dict: {индекс слота: [длительность в секундах, ...]} (от новых к старым)
+    """
+    db = SessionLocal()
+    try:
+        # Номер замера внутри слота (от новых к старым) считается в SQL,
+        # из растущей таблицы sync_stats загружаются только последние limit_per_slot строк слота
+        row_number = func.row_number().over(
+            partition_by=SyncStat.slot,
+            order_by=(SyncStat.started_at.desc(), SyncStat.id.desc()),
+        ).label("row_number")
+        ranked = db.query(SyncStat.slot, SyncStat.seconds, row_number).filter(
+            SyncStat.slot.isnot(None)
+        ).subquery()
+        rows = db.query(ranked.c.slot, ranked.c.seconds).filter(
+            ranked.c.row_number <= limit_per_slot
+        ).order_by(ranked.c.slot, ranked.c.row_number).all()
+        
+        durations: dict[int, list[float]] = {}
+        for slot, seconds in rows:
+            durations.setdefault(slot, []).append(seconds)
+        return durations
+    finally:
+        db.close()
 # >>> КОНЕЦ БЛОКА: ФУНКЦИИ ДЛЯ РАБОТЫ С НАСТРОЙКАМИ СИНХРОНИЗАЦИИ <<<
 
 # >>> ФУНКЦИИ ДЛЯ РАБОТЫ С ЗАЯВКАМИ НА ВЫВОД БОНУСОВ <<<
-def get_user_available_balance(ozon_id: str) -> float:
+def get_user_available_balance(ozon_id: str, db: Session = None) -> float:
     """Получить доступный баланс пользователя (только бонусы со статусом 'available').
     
     Args:
         ozon_id: Ozon ID пользователя
+        db: Сессия БД (опционально, если None, создается новая)
         
     Returns:
         float: Сумма доступных бонусов
     """
-    db = SessionLocal()
+    should_close_db = False
+    if db is None:
+        db = SessionLocal()
+        should_close_db = True
+    
     try:
-        transactions = db.query(BonusTransaction).filter(
+        # Сумма считается в SQL, строки транзакций не загружаются
+        return db.query(func.coalesce(func.sum(BonusTransaction.bonus_amount), 0.0)).filter(
             BonusTransaction.referrer_ozon_id == str(ozon_id),
             BonusTransaction.status == "available"
-        ).all()
-        
-        total = sum(t.bonus_amount for t in transactions if t.bonus_amount)
-        return total
+        ).scalar()
     finally:
-        db.close()
+        if should_close_db:
+            db.close()
 
-def get_user_total_balance(ozon_id: str) -> float:
+def get_user_total_balance(ozon_id: str, db: Session = None) -> float:
     """Получить общий баланс пользователя (все статусы).
     
     Args:
         ozon_id: Ozon ID пользователя
+        db: Сессия БД (опционально, если None, создается новая)
         
     Returns:
         float: Общая сумма бонусов
     """
-    db = SessionLocal()
+    should_close_db = False
+    if db is None:
+        db = SessionLocal()
+        should_close_db = True
+    
     try:
-        transactions = db.query(BonusTransaction).filter(
+        # Сумма считается в SQL, строки транзакций не загружаются
+        return db.query(func.coalesce(func.sum(BonusTransaction.bonus_amount), 0.0)).filter(
             BonusTransaction.referrer_ozon_id == str(ozon_id)
-        ).all()
-        
-        total = sum(t.bonus_amount for t in transactions if t.bonus_amount)
-        return total
+        ).scalar()
     finally:
-        db.close()
+        if should_close_db:
+            db.close()
 
-def has_active_withdrawal_request(user_ozon_id: str) -> bool:
+def has_active_withdrawal_request(user_ozon_id: str, db: Session = None) -> bool:
     """Проверить, есть ли у пользователя активная заявка на вывод.
     
     Args:
         user_ozon_id: Ozon ID пользователя
+        db: Сессия БД (опционально, если None, создается новая)
         
     Returns:
         bool: True если есть активная заявка (статусы: 'processing', 'approved')
     """
-    db = SessionLocal()
+    should_close_db = False
+    if db is None:
+        db = SessionLocal()
+        should_close_db = True
+    
     try:
         active_request = db.query(WithdrawalRequest).filter(
             WithdrawalRequest.user_ozon_id == str(user_ozon_id),
@@ -1867,7 +2639,8 @@ def has_active_withdrawal_request(user_ozon_id: str) -> bool:
         
         return active_request is not None
     finally:
-        db.close()
+        if should_close_db:
+            db.close()
 
 def get_active_withdrawal_request(user_ozon_id: str) -> dict | None:
     """Получить активную заявку пользователя.
@@ -1900,11 +2673,12 @@ def get_active_withdrawal_request(user_ozon_id: str) -> dict | None:
     finally:
         db.close()
 
-def check_withdrawal_period(user_ozon_id: str) -> tuple[bool, str | None]:
+def check_withdrawal_period(user_ozon_id: str, db: Session = None) -> tuple[bool, str | None]:
     """Проверить периодичность вывода (через сколько дней можно подать новую заявку).
     
     Args:
         user_ozon_id: Ozon ID пользователя
+        db: Сессия БД (опционально, если None, создается новая)
         
     Returns:
         tuple[bool, str | None]: (разрешено, сообщение об ошибке)
@@ -1915,7 +2689,11 @@ def check_withdrawal_period(user_ozon_id: str) -> tuple[bool, str | None]:
     if settings.days_between_withdrawals is None:
         return True, None
     
-    db = SessionLocal()
+    should_close_db = False
+    if db is None:
+        db = SessionLocal()
+        should_close_db = True
+    
     try:
         # Получаем последнюю заявку со статусом "completed" или "rejected"
         last_request = db.query(WithdrawalRequest).filter(
@@ -1928,7 +2706,7 @@ def check_withdrawal_period(user_ozon_id: str) -> tuple[bool, str | None]:
             return True, None
         
         # Вычисляем разницу дней
-        days_passed = (datetime.utcnow() - last_request.processed_at).days
+        days_passed = (utcnow() - last_request.processed_at).days
         
         if days_passed < settings.days_between_withdrawals:
             days_left = settings.days_between_withdrawals - days_passed
@@ -1937,7 +2715,8 @@ def check_withdrawal_period(user_ozon_id: str) -> tuple[bool, str | None]:
         
         return True, None
     finally:
-        db.close()
+        if should_close_db:
+            db.close()
 
 def create_withdrawal_request(user_ozon_id: str, user_telegram_id: str, amount: float) -> dict:
     """Создать заявку на вывод бонусов.
@@ -1955,8 +2734,9 @@ def create_withdrawal_request(user_ozon_id: str, user_telegram_id: str, amount:
     """
     db = SessionLocal()
     try:
+        # Проверки выполняются в этой же сессии, а не открывают по соединению на каждую
         # Проверка активной заявки
-        if has_active_withdrawal_request(user_ozon_id):
+        if has_active_withdrawal_request(user_ozon_id, db):
             raise ValueError("У тебя уже есть активная заявка на вывод. Дождись её обработки.")
         
         # Проверка минимальной суммы
@@ -1964,13 +2744,14 @@ def create_withdrawal_request(user_ozon_id: str, user_telegram_id: str, amount:
         if amount < settings.min_withdrawal_amount:
             raise ValueError(f"Минимальная сумма вывода: {settings.min_withdrawal_amount} ₽")
         
-        # Проверка доступного баланса
-        available_balance = get_user_available_balance(user_ozon_id)
+        # Проверка доступного баланса (перед ней размораживаем бонусы, у которых уже прошло 14 дней)
+        check_and_update_bonus_availability(db)
+        available_balance = get_user_available_balance(user_ozon_id, db)
         if amount > available_balance:
             raise ValueError(f"Недостаточно средств. Доступный баланс: {available_balance} ₽")
         
         # Проверка периодичности
-        allowed, error_msg = check_withdrawal_period(user_ozon_id)
+        allowed, error_msg = check_withdrawal_period(user_ozon_id, db)
         if not allowed:
             raise ValueError(error_msg)
         
@@ -1983,7 +2764,13 @@ def create_withdrawal_request(user_ozon_id: str, user_telegram_id: str, amount:
         )
         
         db.add(request)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            # Параллельный запрос успел создать активную заявку после проверки выше -
+            # вторую не пропустил уникальный индекс ix_withdrawal_requests_one_active
+            db.rollback()
+            raise ValueError("У тебя уже есть активная заявка на вывод. Дождись её обработки.")
         db.refresh(request)
         
         return {
@@ -2039,23 +2826,21 @@ def get_pending_withdrawal_requests() -> list:
     """
     db = SessionLocal()
     try:
-        requests = db.query(WithdrawalRequest).filter(
+        # Заявки и данные пользователей - одним запросом (LEFT JOIN, ozon_id участника уникален)
+        rows = db.query(WithdrawalRequest, Participant.name, Participant.username).outerjoin(
+            Participant, Participant.ozon_id == WithdrawalRequest.user_ozon_id
+        ).filter(
             WithdrawalRequest.status == "processing"
         ).order_by(WithdrawalRequest.created_at.asc()).all()
         
         result = []
-        for req in requests:
-            # Получаем информацию о пользователе
-            participant = db.query(Participant).filter(
-                Participant.ozon_id == req.user_ozon_id
-            ).first()
-            
+        for req, user_name, user_username in rows:
             result.append({
                 "id": req.id,
                 "user_ozon_id": req.user_ozon_id,
                 "user_telegram_id": req.user_telegram_id,
-                "user_name": participant.name if participant else None,
-                "user_username": participant.username if participant else None,
+                "user_name": user_name,
+                "user_username": user_username,
                 "amount": req.amount,
                 "status": req.status,
                 "created_at": req.created_at
@@ -2076,20 +2861,20 @@ def get_withdrawal_request_by_id(request_id: int) -> dict | None:
     """
     db = SessionLocal()
     try:
-        request = db.query(WithdrawalRequest).filter(WithdrawalRequest.id == request_id).first()
+        # Заявка и информация о пользователе - одним запросом (LEFT JOIN)
+        row = db.query(WithdrawalRequest, Participant.name, Participant.username).outerjoin(
+            Participant, Participant.ozon_id == WithdrawalRequest.user_ozon_id
+        ).filter(WithdrawalRequest.id == request_id).first()
         
-        if request:
-            # Получаем информацию о пользователе
-            participant = db.query(Participant).filter(
-                Participant.ozon_id == request.user_ozon_id
-            ).first()
+        if row:
+            request, user_name, user_username = row
             
             return {
                 "id": request.id,
                 "user_ozon_id": request.user_ozon_id,
                 "user_telegram_id": request.user_telegram_id,
-                "user_name": participant.name if participant else None,
-                "user_username": participant.username if participant else None,
+                "user_name": user_name,
+                "user_username": user_username,
                 "amount": request.amount,
                 "status": request.status,
                 "admin_comment": request.admin_comment,
@@ -2114,49 +2899,59 @@ def cancel_withdrawal_request(request_id: int, user_ozon_id: str) -> bool:
     """
     db = SessionLocal()
     try:
-        request = db.query(WithdrawalRequest).filter(
+        # Удаляем заявку (бонусы не резервировались, так что просто удаляем) одним условным DELETE:
+        # проверка статуса и удаление атомарны, поэтому заявку, которую админ успел одобрить
+        # между проверкой и удалением, отменить нельзя
+        deleted_count = db.query(WithdrawalRequest).filter(
             WithdrawalRequest.id == request_id,
             WithdrawalRequest.user_ozon_id == str(user_ozon_id),
             WithdrawalRequest.status == "processing"
-        ).first()
-        
-        if not request:
-            return False
-        
-        # Удаляем заявку (бонусы не резервировались, так что просто удаляем)
-        db.delete(request)
+        ).delete(synchronize_session=False)
         db.commit()
         
-        return True
+        return deleted_count > 0
     except Exception as e:
         db.rollback()
         raise e
     finally:
         db.close()
 
-def reserve_and_withdraw_bonuses(user_ozon_id: str, amount: float, withdrawal_request_id: int) -> bool:
+def reserve_and_withdraw_bonuses(user_ozon_id: str, amount: float, withdrawal_request_id: int, db: Session = None) -> bool:
     """Резервировать и списать бонусы по FIFO при одобрении заявки.
     
+    Выборка доступных бонусов и их списание идут в одной транзакции с блокировкой записи
+    (BEGIN IMMEDIATE): параллельное одобрение не увидит те же бонусы как доступные.
+    
     Args:
         user_ozon_id: Ozon ID пользователя
         amount: Сумма для списания
         withdrawal_request_id: ID заявки на вывод
+        db: Сессия БД (опционально, если None, создается новая; переданная сессия
+            должна уже держать блокировку записи, коммит - в вызывающей функции)
         
     Returns:
         bool: True если успешно, False если недостаточно средств
     """
-    db = SessionLocal()
+    should_close_db = False
+    if db is None:
+        db = SessionLocal()
+        should_close_db = True
+    
     try:
-        # Получаем все транзакции со статусом "available" для пользователя
-        transactions = db.query(BonusTransaction).filter(
+        if should_close_db:
+            begin_immediate(db)
+        
+        # Получаем все транзакции со статусом "available" для пользователя (только id и сумма)
+        transactions = db.query(BonusTransaction.id, BonusTransaction.bonus_amount).filter(
             BonusTransaction.referrer_ozon_id == str(user_ozon_id),
             BonusTransaction.status == "available"
         ).order_by(BonusTransaction.created_at.asc()).all()
         
         remaining_amount = amount
-        used_transactions = []
+        used_transaction_ids = []
+        withdrawal_transactions = []
         
-        # Резервируем транзакции по FIFO
+        # Резервируем транзакции по FIFO (в Python считаем только распределение суммы)
         for transaction in transactions:
             if remaining_amount <= 0:
                 break
@@ -2172,30 +2967,64 @@ def reserve_and_withdraw_bonuses(user_ozon_id: str, amount: float, withdrawal_re
                     used_amount = remaining_amount
                     remaining_amount = 0
                 
-                # Обновляем статус транзакции
-                transaction.status = "withdrawn"
-                
-                # Создаем запись в withdrawal_transactions
-                withdrawal_transaction = WithdrawalTransaction(
-                    withdrawal_request_id=withdrawal_request_id,
-                    bonus_transaction_id=transaction.id,
-                    amount=used_amount
-                )
-                db.add(withdrawal_transaction)
-                used_transactions.append(transaction)
+                used_transaction_ids.append(transaction.id)
+                withdrawal_transactions.append({
+                    "withdrawal_request_id": withdrawal_request_id,
+                    "bonus_transaction_id": transaction.id,
+                    "amount": used_amount,
+                })
         
-        # Если не хватило средств, откатываем изменения
+        # Если не хватило средств, ничего не списываем (до этого момента в БД ничего не записано)
         if remaining_amount > 0:
-            db.rollback()
+            if should_close_db:
+                db.rollback()
             return False
         
-        db.commit()
+        # Обновляем статус использованных транзакций одним UPDATE на пачку вместо UPDATE на строку
+        for start in range(0, len(used_transaction_ids), IN_QUERY_CHUNK_SIZE):
+            db.query(BonusTransaction).filter(
+                BonusTransaction.id.in_(used_transaction_ids[start:start + IN_QUERY_CHUNK_SIZE])
+            ).update({BonusTransaction.status: "withdrawn"}, synchronize_session=False)
+        
+        # Создаем записи в withdrawal_transactions одним executemany
+        if withdrawal_transactions:
+            db.execute(insert(WithdrawalTransaction.__table__), withdrawal_transactions)
+        
+        # Коммитим только если сессия была создана внутри функции
+        if should_close_db:
+            db.commit()
         return True
     except Exception as e:
-        db.rollback()
+        if should_close_db:
+            db.rollback()
         raise e
     finally:
-        db.close()
+        if should_close_db:
+            db.close()
+
+def _transition_withdrawal_request(db: Session, request_id: int, from_status: str, to_status: str, **fields):
+    """Перевести заявку из статуса from_status в to_status одним UPDATE ... RETURNING.
+    
+    Проверка текущего статуса и его смена выполняются одним условным UPDATE (compare-and-set),
+    поэтому два одновременных обработчика не переведут одну заявку дважды. Коммит - в вызывающей функции.
+    
+    Args:
+        db: Сессия БД
+        request_id: ID заявки
+        from_status: Ожидаемый текущий статус заявки
+        to_status: Новый статус заявки
+        **fields: Дополнительные поля заявки для обновления (processed_by, processed_at и т.д.)
+        
+    Returns:
+        Row | None: (id, user_ozon_id, amount) переведенной заявки или None, если заявка
+                    не найдена или уже не в статусе from_status
+    """
+    return db.execute(
+        update(WithdrawalRequest)
+        .where(WithdrawalRequest.id == request_id, WithdrawalRequest.status == from_status)
+        .values(status=to_status, **fields)
+        .returning(WithdrawalRequest.id, WithdrawalRequest.user_ozon_id, WithdrawalRequest.amount)
+    ).first()
 
 def approve_withdrawal_request(request_id: int, admin_telegram_id: str) -> bool:
     """Одобрить заявку на вывод.
@@ -2209,24 +3038,26 @@ def approve_withdrawal_request(request_id: int, admin_telegram_id: str) -> bool:
     """
     db = SessionLocal()
     try:
-        request = db.query(WithdrawalRequest).filter(
-            WithdrawalRequest.id == request_id,
-            WithdrawalRequest.status == "processing"
-        ).first()
+        # Смена статуса заявки и списание бонусов - одна транзакция с блокировкой записи:
+        # если бонусов не хватит, откат вернет заявке статус "processing"
+        begin_immediate(db)
+        
+        request = _transition_withdrawal_request(
+            db, request_id, "processing", "approved",
+            processed_by=str(admin_telegram_id),
+            processed_at=utcnow(),
+        )
         
         if not request:
+            db.rollback()
             return False
         
-        # Резервируем и списываем бонусы
-        success = reserve_and_withdraw_bonuses(request.user_ozon_id, request.amount, request_id)
+        # Резервируем и списываем бонусы (в этой же транзакции)
+        success = reserve_and_withdraw_bonuses(request.user_ozon_id, request.amount, request_id, db)
         if not success:
+            db.rollback()
             return False
         
-        # Обновляем статус заявки
-        request.status = "approved"
-        request.processed_by = str(admin_telegram_id)
-        request.processed_at = datetime.utcnow()
-        
         db.commit()
         return True
     except Exception as e:
@@ -2248,22 +3079,15 @@ def reject_withdrawal_request(request_id: int, admin_telegram_id: str, reason: s
     """
     db = SessionLocal()
     try:
-        request = db.query(WithdrawalRequest).filter(
-            WithdrawalRequest.id == request_id,
-            WithdrawalRequest.status == "processing"
-        ).first()
-        
-        if not request:
-            return False
-        
         # Обновляем статус заявки (бонусы не резервировались, так что просто обновляем статус)
-        request.status = "rejected"
-        request.processed_by = str(admin_telegram_id)
-        request.processed_at = datetime.utcnow()
-        request.admin_comment = reason
-        
+        request = _transition_withdrawal_request(
+            db, request_id, "processing", "rejected",
+            processed_by=str(admin_telegram_id),
+            processed_at=utcnow(),
+            admin_comment=reason,
+        )
         db.commit()
-        return True
+        return request is not None
     except Exception as e:
         db.rollback()
         raise e
@@ -2281,19 +3105,12 @@ def complete_withdrawal_request(request_id: int) -> bool:
     """
     db = SessionLocal()
     try:
-        request = db.query(WithdrawalRequest).filter(
-            WithdrawalRequest.id == request_id,
-            WithdrawalRequest.status == "approved"
-        ).first()
-        
-        if not request:
-            return False
-        
-        request.status = "completed"
-        request.completed_at = datetime.utcnow()
-        
+        request = _transition_withdrawal_request(
+            db, request_id, "approved", "completed",
+            completed_at=utcnow(),
+        )
         db.commit()
-        return True
+        return request is not None
     except Exception as e:
         db.rollback()
         raise e
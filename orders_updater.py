@@ -1,17 +1,20 @@
 import os 
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from typing import List, Any, Dict
 import json
 import time
+import traceback
 
 import requests 
 from sqlalchemy.orm import Session # Для работы с сессией DB
-from sqlalchemy import func  # Для работы с датами в SQL запросах
+from sqlalchemy import func, insert  # Для работы с датами в SQL запросах и пакетной вставки
 # Импортируем из db_manager новые функции и модель
 from db_manager import (
     get_db, Order, Customer, Participant, order_exists, 
-    create_or_update_customer, get_customer, accrue_bonuses_for_order,
-    process_order_return, check_and_update_bonus_availability
+    upsert_customers, get_orders_by_posting_numbers, accrue_bonuses_for_orders,
+    buyer_id_from_posting_number, order_buyer_id, begin_immediate,
+    process_order_returns, check_and_update_bonus_availability, IN_QUERY_CHUNK_SIZE
 ) 
 # Используем БД для хранения времени синхронизации
 from db_manager import get_last_sync_timestamp, set_last_sync_timestamp, get_last_order_date, set_last_order_date 
@@ -21,6 +24,17 @@ load_dotenv()
 OZON_API_KEY = os.getenv("OZON_API_KEY")
 OZON_CLIENT_ID = os.getenv("OZON_CLIENT_ID")
 
+@dataclass(slots=True)
+class SyncResult:
+    """Результат синхронизации заказов, возвращаемый update_orders_sheet()."""
+    count: int
+    period_start: datetime
+    period_end: datetime
+    customers_count: int = 0
+    new_customers_count: int = 0
+    participants_with_orders_count: int = 0
+    first_day_stats: Dict = field(default_factory=dict)
+
 def transform_ozon_customer_data(posting: Dict) -> Dict:
     """Преобразует данные клиента из Ozon API в словарь для записи в DB.
     
@@ -33,12 +47,7 @@ def transform_ozon_customer_data(posting: Dict) -> Dict:
     
     # Извлекаем buyer_id из posting_number (первые цифры до первого тире)
     # Если тире нет, то весь posting_number и есть buyer_id
-    buyer_id = ""
-    if posting_number:
-        if "-" in posting_number:
-            buyer_id = posting_number.split("-")[0]
-        else:
-            buyer_id = posting_number
+    buyer_id = buyer_id_from_posting_number(posting_number)
     
     if not buyer_id:
         return None
@@ -113,13 +122,8 @@ def transform_ozon_data_for_sheets(posting: Dict, item: Dict) -> Dict:
     created_at = posting.get("created_at", "")
     
     # Извлекаем buyer_id из posting_number (первые цифры до первого тире)
-    # Если тире нет, то весь posting_number и есть buyer_id
-    buyer_id = ""
-    if posting_number:
-        if "-" in posting_number:
-            buyer_id = posting_number.split("-")[0]
-        else:
-            buyer_id = posting_number
+    # Если тире нет, то весь posting_number и есть buyer_id; пустое значение записывается как NULL, а не ""
+    buyer_id = order_buyer_id(None, posting_number)
 
     # Данные товара
     item_name = item.get("name", "")
@@ -384,6 +388,13 @@ def update_final_orders_status(
     
     return stats
 
+def _print_deferred_sync_messages(skipped_postings_count: int, messages: list):
+    """Выводит сообщения синхронизации, собранные во время транзакции записи."""
+    if skipped_postings_count:
+        print(f"Пропущено заказов/товаров с пустым posting_number: {skipped_postings_count}")
+    for message in messages:
+        print(message)
+
 def update_orders_sheet():
     """Главная функция для получения и записи новых заказов в SQLite, а не в Google Sheets.
     
@@ -456,14 +467,11 @@ def update_orders_sheet():
     if not raw_postings:
         print("Нет новых заказов для обновления.")
         sync_end_time = datetime.now()
-        return {
-            "count": 0,
-            "period_start": date_since,
-            "period_end": sync_end_time,
-            "customers_count": 0,
-            "new_customers_count": 0,
-            "participants_with_orders_count": 0
-        }
+        return SyncResult(
+            count=0,
+            period_start=date_since,
+            period_end=sync_end_time,
+        )
 
     new_records_count = 0
     new_customers_count = 0
@@ -472,7 +480,16 @@ def update_orders_sheet():
     db_generator = get_db()
     db = next(db_generator) # Получаем сессию
     
+    # Сообщения о пропусках и ошибках по отдельным заказам собираются и выводятся после
+    # commit/rollback, чтобы вывод в лог не удлинял транзакцию с блокировкой записи
+    skipped_postings_count = 0
+    deferred_messages = []
+    
     try:
+        # Синхронизация читает заказы и затем пишет: блокировку записи берем сразу (BEGIN IMMEDIATE).
+        # Внутри try: при "database is locked" сессия все равно закрывается в finally
+        begin_immediate(db)
+        
         # Словарь для отслеживания клиентов и их статистики
         customers_data = {}
         
@@ -484,6 +501,21 @@ def update_orders_sheet():
         # Это предотвращает повторную обработку одного и того же posting в рамках одной синхронизации
         processed_posting_numbers = set()
         
+        # Заказы, за которые нужно начислить бонусы: начисляются одним пакетом после обработки всех отправлений
+        postings_to_accrue = []
+        # Возвращенные заказы, по которым нужно списать бонусы: тоже одним пакетом после цикла
+        postings_to_return = []
+        # Новые заказы: добавляются одним INSERT после цикла, без ORM-объекта и flush на каждый заказ
+        new_orders = []
+        
+        # Заказы, которые уже есть в БД, загружаем одним запросом на пачку до цикла
+        # (вместо flush + SELECT на каждое отправление). Новые заказы текущей синхронизации
+        # отсекаются через processed_posting_numbers, поэтому словарь не нужно дополнять.
+        existing_orders = get_orders_by_posting_numbers(db, {
+            posting.get("posting_number") for posting in raw_postings
+            if posting.get("posting_number") and posting.get("posting_number").strip()
+        })
+        
         # 3. Перебираем отправления и товары
         for posting in raw_postings:
             posting_status = posting.get("status", "")
@@ -515,7 +547,7 @@ def update_orders_sheet():
             
             # Проверяем, что posting_number не пустой
             if not posting_number or posting_number.strip() == "":
-                print(f"Пропущен заказ: posting_number пустой или отсутствует")
+                skipped_postings_count += 1
                 continue
             
             # **********************************************
@@ -527,10 +559,8 @@ def update_orders_sheet():
                 # Уже обработали в текущей синхронизации - пропускаем
                 continue
             
-            # Затем проверяем в БД
-            # Делаем flush, чтобы все добавленные в текущей транзакции записи были видны
-            db.flush()
-            existing_order = db.query(Order).filter(Order.posting_number == posting_number).first()
+            # Затем проверяем среди заказов, заранее загруженных из БД
+            existing_order = existing_orders.get(posting_number)
             
             if existing_order:
                 # Заказ уже существует в БД - обновляем его статус и другие поля
@@ -538,14 +568,14 @@ def update_orders_sheet():
                 existing_order.status = posting_status
                 existing_order.is_redeemed = "да" if posting_status == "delivered" else "нет"
                 
-                # Если статус изменился на "delivered", начисляем бонусы
+                # Если статус изменился на "delivered", начисляем бонусы (пакетно, после цикла)
                 if posting_status == "delivered" and old_status != "delivered":
-                    accrue_bonuses_for_order(posting_number, db)
+                    postings_to_accrue.append(posting_number)
                 
                 # Если статус изменился с "delivered" на "cancelled" (возврат товара)
                 if old_status == "delivered" and posting_status == "cancelled":
-                    # Обрабатываем возврат заказа и списываем бонусы
-                    process_order_return(posting_number, return_amount=None, db=db)
+                    # Обрабатываем возврат заказа и списываем бонусы (пакетно, после цикла)
+                    postings_to_return.append(posting_number)
                 
                 # Обновляем другие поля, если они доступны
                 if financial_data:
@@ -614,20 +644,17 @@ def update_orders_sheet():
                     
                     # Дополнительная проверка перед созданием объекта
                     if not order_data.get("posting_number") or order_data.get("posting_number").strip() == "":
-                        print(f"Пропущен товар: posting_number пустой в order_data")
+                        skipped_postings_count += 1
                         continue
                     
                     try:
-                        new_order = Order(**order_data)
-                        # 5. Добавляем и сохраняем
-                        db.add(new_order)
-                        db.flush()  # Нужно для получения ID
-                        new_records_count += 1
+                        # 5. Добавляем (сохраняются пакетом после цикла)
+                        new_orders.append(order_data)
                         items_added = True
                         
-                        # Если заказ доставлен, начисляем бонусы
+                        # Если заказ доставлен, начисляем бонусы (пакетно, после цикла)
                         if posting_status == "delivered":
-                            accrue_bonuses_for_order(posting_number, db)
+                            postings_to_accrue.append(posting_number)
                         
                         # Помечаем posting_number как обработанный
                         processed_posting_numbers.add(posting_number)
@@ -665,69 +692,66 @@ def update_orders_sheet():
                                         customers_data[buyer_id]["last_order_date"] = order_date_obj
                     except Exception as e:
                         # Если возникла ошибка уникальности или другая ошибка при добавлении
-                        print(f"Ошибка при добавлении заказа {posting_number}: {e}")
+                        deferred_messages.append(f"Ошибка при добавлении заказа {posting_number}: {e}")
                         # Помечаем как обработанный, чтобы не пытаться добавить снова
                         processed_posting_numbers.add(posting_number)
                         # Пропускаем этот товар, продолжаем обработку остальных
                         continue
         
+        # 3.3. Сохраняем новые заказы одним INSERT (executemany). OR IGNORE - как раньше пропуск
+        # заказа с ошибкой уникальности при flush: такой posting_number уже есть в БД
+        if new_orders:
+            result = db.execute(insert(Order.__table__).prefix_with("OR IGNORE"), new_orders)
+            new_records_count += result.rowcount
+        
+        # Начисляем бонусы за доставленные заказы одним пакетом
+        if postings_to_accrue:
+            accrue_bonuses_for_orders(postings_to_accrue, db)
+        
+        # Списываем бонусы за возвращенные заказы одним пакетом
+        if postings_to_return:
+            process_order_returns(postings_to_return, db)
+        
         # 4. Сохраняем/обновляем клиентов
-        for buyer_id, customer_info in customers_data.items():
-            try:
-                customer_data = customer_info["data"]
-                
-                # Получаем существующего клиента для обновления статистики
-                existing_customer = get_customer(db, buyer_id)
-                
-                if existing_customer:
-                    # Обновляем статистику существующего клиента
-                    customer_data["total_orders"] = existing_customer.total_orders + customer_info["orders_count"]
-                    customer_data["total_spent"] = str(float(existing_customer.total_spent or 0) + customer_info["total_spent"])
-                    
-                    # Обновляем даты
-                    if customer_info["first_order_date"]:
-                        if not existing_customer.first_order_date or customer_info["first_order_date"] < existing_customer.first_order_date:
-                            customer_data["first_order_date"] = customer_info["first_order_date"]
-                        else:
-                            customer_data["first_order_date"] = existing_customer.first_order_date
-                    
-                    if customer_info["last_order_date"]:
-                        if not existing_customer.last_order_date or customer_info["last_order_date"] > existing_customer.last_order_date:
-                            customer_data["last_order_date"] = customer_info["last_order_date"]
-                        else:
-                            customer_data["last_order_date"] = existing_customer.last_order_date
-                else:
-                    # Новый клиент
-                    customer_data["total_orders"] = customer_info["orders_count"]
-                    customer_data["total_spent"] = str(customer_info["total_spent"])
-                    new_customers_count += 1
-                
-                # Создаем или обновляем клиента
-                create_or_update_customer(db, customer_data)
-            except Exception as e:
-                print(f"Ошибка при сохранении клиента {buyer_id}: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
+        # Одним пакетным upsert: статистика новых заказов прибавляется к сохраненной в SQL,
+        # существующих клиентов загружать и менять по одному не нужно
+        customers_to_save = []
+        for customer_info in customers_data.values():
+            customer_data = customer_info["data"]
+            customer_data["total_orders"] = customer_info["orders_count"]
+            customer_data["total_spent"] = customer_info["total_spent"]
+            customer_data["first_order_date"] = customer_info["first_order_date"]
+            customer_data["last_order_date"] = customer_info["last_order_date"]
+            customers_to_save.append(customer_data)
+        
+        try:
+            new_customers_count += upsert_customers(db, customers_to_save)
+        except Exception as e:
+            deferred_messages.append(f"Ошибка при сохранении клиентов ({len(customers_to_save)}): {e}\n{traceback.format_exc()}")
         
         # 4.1. Подсчитываем участников программы, совершивших покупку
         participants_with_orders = set()  # Множество для уникальных buyer_id участников
         
-        # Проверяем каждого buyer_id из обработанных заказов
-        for buyer_id in customers_data.keys():
+        # Проверяем buyer_id из обработанных заказов пачками (IN-список вместо запроса на каждого)
+        buyer_ids = [str(buyer_id) for buyer_id in customers_data.keys()]
+        for i in range(0, len(buyer_ids), IN_QUERY_CHUNK_SIZE):
+            chunk = buyer_ids[i:i + IN_QUERY_CHUNK_SIZE]
             try:
-                # Проверяем, является ли этот buyer_id участником программы
-                participant = db.query(Participant).filter(Participant.ozon_id == str(buyer_id)).first()
-                if participant:
-                    participants_with_orders.add(buyer_id)
+                rows = db.query(Participant.ozon_id).filter(Participant.ozon_id.in_(chunk)).all()
+                participants_with_orders.update(ozon_id for (ozon_id,) in rows)
             except Exception as e:
-                print(f"Ошибка при проверке участника {buyer_id}: {e}")
+                deferred_messages.append(f"Ошибка при проверке участников: {e}")
         
         participants_count = len(participants_with_orders)
         
         # Сохраняем все новые записи за раз
         db.commit()
         
+        # Блокировка записи снята - выводим собранные сообщения
+        _print_deferred_sync_messages(skipped_postings_count, deferred_messages)
+        skipped_postings_count = 0
+        deferred_messages = []
+        
         # Обновляем доступность бонусов (проверяем, прошло ли 14 дней)
         updated_bonuses_count = check_and_update_bonus_availability(db)
         if updated_bonuses_count > 0:
@@ -792,21 +816,20 @@ def update_orders_sheet():
         # Получаем статистику по статусам за первый день периода
         first_day_stats = get_orders_status_stats_by_date(date_since)
         
-        result_dict = {
-            "count": new_records_count,
-            "period_start": date_since,
-            "period_end": sync_end_time,
-            "customers_count": len(customers_data),
-            "new_customers_count": new_customers_count,
-            "participants_with_orders_count": participants_count,
-            "first_day_stats": first_day_stats
-        }
-        return result_dict
+        return SyncResult(
+            count=new_records_count,
+            period_start=date_since,
+            period_end=sync_end_time,
+            customers_count=len(customers_data),
+            new_customers_count=new_customers_count,
+            participants_with_orders_count=participants_count,
+            first_day_stats=first_day_stats,
+        )
 
     except Exception as e:
         db.rollback() # Откатываем изменения при ошибке
+        _print_deferred_sync_messages(skipped_postings_count, deferred_messages)
         print(f"Критическая ошибка при записи в базу данных: {e}")
-        import traceback
         traceback.print_exc()
         raise # Поднимаем ошибку выше, чтобы бот мог сообщить о ней в Telegram
     finally:
@@ -823,34 +846,39 @@ def get_orders_status_stats_by_date(date: datetime) -> Dict:
         dict: Статистика {"total": X, "statuses": {"delivered": Y, "delivering": Z, ...}, "active_count": W}
     """
     from db_manager import SessionLocal, Order
-    from collections import Counter
     
     db = SessionLocal()
     try:
+        # Границы дня - полуинтервал [начало дня, начало следующего дня)
         date_start = datetime.combine(date.date(), datetime.min.time())
-        date_end = datetime.combine(date.date(), datetime.max.time())
+        date_end = date_start + timedelta(days=1)
         
-        orders = db.query(Order).filter(
+        # Количество заказов по статусам считается в SQL (GROUP BY), строки заказов не передаются
+        status_rows = db.query(Order.status, func.count()).filter(
             Order.created_at >= date_start,
-            Order.created_at <= date_end
-        ).all()
+            Order.created_at < date_end
+        ).group_by(Order.status).all()
+        
+        total = 0
+        status_counter = {}
+        for status, count in status_rows:
+            total += count
+            if status:
+                status_counter[status] = count
         
-        if not orders:
+        if not total:
             return {
                 "total": 0,
                 "statuses": {},
                 "active_count": 0
             }
         
-        statuses = [order.status for order in orders if order.status]
-        status_counter = Counter(statuses)
-        
         # Подсчитываем активные заказы (не delivered и не cancelled)
-        active_count = len([s for s in statuses if s and s not in ["delivered", "cancelled"]])
+        active_count = sum(count for status, count in status_counter.items() if status not in ["delivered", "cancelled"])
         
         return {
-            "total": len(orders),
-            "statuses": dict(status_counter),
+            "total": total,
+            "statuses": status_counter,
             "active_count": active_count
         }
     finally:
@@ -859,6 +887,6 @@ def get_orders_status_stats_by_date(date: datetime) -> Dict:
 if __name__ == "__main__":
     result = update_orders_sheet()
     print(f"\nРезультат синхронизации:")
-    print(f"  Заказов добавлено: {result['count']}")
-    print(f"  Клиентов обработано: {result['customers_count']} (новых: {result['new_customers_count']})")
-    print(f"  Период: {result['period_start'].strftime('%d.%m.%Y %H:%M')} - {result['period_end'].strftime('%d.%m.%Y %H:%M')}")
\ No newline at end of file
+    print(f"  Заказов добавлено: {result.count}")
+    print(f"  Клиентов обработано: {result.customers_count} (новых: {result.new_customers_count})")
+    print(f"  Период: {result.period_start.strftime('%d.%m.%Y %H:%M')} - {result.period_end.strftime('%d.%m.%Y %H:%M')}")
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import threading
 from datetime import datetime
 
 import gspread
@@ -32,10 +33,33 @@ def get_gspread_client():
     return client
 
 
+# Авторизованная таблица кэшируется: без кэша каждый вызов заново читал файл ключа сервисного
+# аккаунта, авторизовался и запрашивал метаданные таблицы. Токен клиент gspread обновляет сам
+_spreadsheet_cache = None
+_spreadsheet_lock = threading.Lock()
+
+
 def get_spreadsheet():
-    """Возвращает объект таблицы по ID."""
-    client = get_gspread_client()
-    return client.open_by_key(GOOGLE_SHEET_ID)
+    """Возвращает объект таблицы по ID (клиент и таблица создаются один раз)."""
+    global _spreadsheet_cache
+
+    spreadsheet = _spreadsheet_cache
+    if spreadsheet is not None:
+        return spreadsheet
+
+    with _spreadsheet_lock:
+        # Повторная проверка: таблицу мог открыть другой поток, пока мы ждали блокировку
+        if _spreadsheet_cache is None:
+            client = get_gspread_client()
+            _spreadsheet_cache = client.open_by_key(GOOGLE_SHEET_ID)
+        return _spreadsheet_cache
+
+
+def clear_spreadsheet_cache():
+    """Сбросить кэш таблицы (например, после смены ключа или ID таблицы)."""
+    global _spreadsheet_cache
+    with _spreadsheet_lock:
+        _spreadsheet_cache = None
 
 
 def find_participant_by_ozon_id(ozon_id: str):